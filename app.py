@@ -2,24 +2,61 @@
 # Modified: 2024-10-25
 # Shows how to use Anthropic Claude 3 multimodal family model prompt on Amazon Bedrock.
 
-import base64
 import datetime
+import hashlib
 import json
 import logging
-from io import StringIO
-from pathlib import Path
+import os
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from io import BytesIO, StringIO
 from tempfile import NamedTemporaryFile
-from typing import List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
-import boto3
-import pymupdf
-import pyperclip
 import streamlit as st
-from botocore.exceptions import ClientError
-from docling.datamodel.base_models import InputFormat
-from docling.datamodel.pipeline_options import PdfPipelineOptions
-from docling.document_converter import DocumentConverter, PdfFormatOption
-from PIL import Image
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from archive import get_archive
+from contact_sheets import MAX_IMAGES_PER_REQUEST, build_contact_sheets, legend_text
+from conversation import MessageJsonCache, build_request_body, trim_conversation
+from keyframes import GIF_FIRST_FRAME, GIF_MODE_DEFAULT, GIF_MODES
+from lazy_imports import PREWARM_IMPORTS, lazy_import, prewarm
+from metrics import OUTCOME_OK, MetricsStore
+from pipeline import (
+    AWS_REGIONS,
+    DEFAULT_AWS_REGION,
+    DEFAULT_MAX_TOKENS,
+    DEFAULT_MODEL_ID,
+    DEFAULT_SYSTEM_PROMPT,
+    DEFAULT_TEMPERATURE,
+    DEFAULT_TOP_K,
+    DEFAULT_TOP_P,
+    MODELS,
+    OCR_DEFAULT,
+    RELEVANCE_DEFAULT,
+    attachment_key,
+    compose_message,
+    ingest_file,
+)
+from relevance import ChunkIndex, select_relevant_texts
+from routing import AUTO_MODEL_ID, LatencyTracker, route_model
+from scratch import SessionScratch, get_scratch_store
+from scheduler import (
+    INGESTION_SLOTS,
+    MODEL_CALL_SLOTS,
+    PRIORITY_BULK,
+    PRIORITY_INTERACTIVE,
+    WAIT_POLL_SEC,
+    FairScheduler,
+)
+from tracing import Tracer, merge_stage_timings, set_active_tracer, trace_span
+
+# heavy dependencies are imported on first use
+boto3 = lazy_import("boto3")
+botocore_exceptions = lazy_import("botocore.exceptions")
+pyperclip = lazy_import("pyperclip")
+
+if PREWARM_IMPORTS:
+    prewarm(boto3, botocore_exceptions)
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -27,27 +64,16 @@ logging.basicConfig(
 )
 
 ################### Constants ###################
-AWS_REGIONS: str = ["us-west-2", "us-east-1"]
-
-DEFAULT_AWS_REGION: int = AWS_REGIONS[0]
-
-# model ids: https://docs.aws.amazon.com/bedrock/latest/userguide/model-ids.html
-MODELS: list[str] = [
-    "anthropic.claude-3-5-sonnet-20241022-v2:0",  # currently only available in us-west-2!
-    "anthropic.claude-3-5-sonnet-20240620-v1:0",
-    "anthropic.claude-3-haiku-20240307-v1:0",
-    "anthropic.claude-3-sonnet-20240229-v1:0",
-    "anthropic.claude-3-opus-20240229-v1:0",
-]
-
-DEFAULT_MODEL_ID: int = MODELS[0]
+# "auto" picks a model per request from its size, attachments, and observed latency
+MODEL_OPTIONS: list[str] = MODELS + [AUTO_MODEL_ID]
 
-DEFAULT_MAX_TOKENS: int = 2048
-DEFAULT_TEMPERATURE: float = 0.2
-DEFAULT_TOP_P: float = 0.999
-DEFAULT_TOP_K: int = 250
+# worker threads that process uploads in the background, shared by all sessions;
+# how many run at once is decided by the ingestion scheduler, not the pool size
+INGESTION_WORKERS: int = 32
 
-DEFAULT_SYSTEM_PROMPT: str = """You are an experienced Creative Director at a top-tier advertising agency. You are an expert at advertising analysis, the process of examining advertising to understand its effects on consumers."""
+# times an upload whose images were swept from scratch storage is re-ingested
+# before it is reported as failed, e.g. when one session's uploads exceed the quota
+MAX_REINGEST_ATTEMPTS: int = 2
 
 DEFAULT_USER_PROMPT: str = """Analyze these four print advertisements for Mercedes-Benz sedans, two in English and two in German. Identify at least 5 common creative elements that contribute to their success. Examine factors such as:
     1. Visual design and imagery
@@ -70,334 +96,498 @@ def invoke_model(
     temperature: float,
     top_p: float,
     top_k: int,
+    message_cache: Optional[MessageJsonCache] = None,
 ) -> Optional[dict]:
-    body = json.dumps(
-        {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": max_tokens,
-            "system": system_prompt,
-            "messages": messages,
-            "temperature": temperature,
-            "top_p": top_p,
-            "top_k": top_k,
-        }
-    )
+    with trace_span("request.serialize", model_id=model_id) as span:
+        body = build_request_body(
+            {
+                "anthropic_version": "bedrock-2023-05-31",
+                "max_tokens": max_tokens,
+                "system": system_prompt,
+                "temperature": temperature,
+                "top_p": top_p,
+                "top_k": top_k,
+            },
+            messages,
+            message_cache,
+        )
+        if span:
+            span.attributes["body_bytes"] = len(body)
+    st.session_state.payload_bytes = len(body)
 
     bedrock_runtime = boto3.client(
         service_name="bedrock-runtime", region_name=st.session_state.aws_region
     )
 
     try:
-        response = bedrock_runtime.invoke_model(body=body, modelId=model_id)
+        with trace_span("bedrock.invoke", model_id=model_id):
+            response = bedrock_runtime.invoke_model(body=body, modelId=model_id)
         logger.debug("Response: %s", response)
-        return json.loads(response["body"].read())
-    except ClientError as err:
+        st.session_state.retries = response["ResponseMetadata"]["RetryAttempts"]
+        st.session_state.outcome = OUTCOME_OK
+        with trace_span("response.parse"):
+            return json.loads(response["body"].read())
+    except botocore_exceptions.ClientError as err:
         message = err.response["Error"]["Message"]
         logger.error("A client error occurred: %s", message)
+        st.session_state.retries = err.response["ResponseMetadata"].get(
+            "RetryAttempts", 0
+        )
+        st.session_state.outcome = err.response["Error"]["Code"]
         st.error(f"A client error occurred: {message}")
         return None
 
 
-def compose_message(user_prompt: str, file_paths: List[dict]) -> List[dict]:
+def display_inference_summary() -> str:
     """
-    Composes a message dictionary for a user prompt and optional file paths.
-    Args:
-        user_prompt (str): The text prompt provided by the user.
-        file_paths (List[dict]): A list of dictionaries, each containing:
-            - "file_path" (str): The path to the file.
-            - "file_type" (str): The MIME type of the file.
-    Returns:
-        List[dict]: A list containing a single message dictionary. The message dictionary
-        includes the user prompt as text and optionally includes images encoded in base64
-        if file paths are provided.
-    """
-
-    message = {"role": "user", "content": [{"type": "text", "text": user_prompt}]}
-
-    if file_paths:
-        for file_path in file_paths:
-            with open(file_path["file_path"], "rb") as image_file:
-                content_image = base64.b64encode(image_file.read()).decode("utf8")
-                message["content"].append(
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": file_path["file_type"],
-                            "data": content_image,
-                        },
-                    }
-                )
-
-    messages = [message] if message else []
-    return messages
-
+    Generates a summary of inference parameters and results from the session state.
 
-def is_pdf_image_based(uploaded_file: Union[NamedTemporaryFile, StringIO]) -> bool:
-    """
-    Determines if a PDF file is image-based (i.e., contains no text content).
-    Args:
-        uploaded_file (Union[NamedTemporaryFile, StringIO]): The uploaded PDF file to check.
-            It can be a NamedTemporaryFile or a StringIO object.
     Returns:
-        bool: True if the PDF is image-based (contains no text content), False otherwise.
+        str: A formatted string containing the inference parameters and results.
+            The summary includes:
+            - aws_region: The AWS region used for inference.
+            - model_id: The ID of the model used for inference.
+            - routed_model_id: The model chosen when model_id is "auto".
+            - routing_reason: Why the model was chosen.
+            - max_tokens: The maximum number of tokens allowed in the inference.
+            - temperature: The temperature setting for the inference.
+            - top_p: The top-p sampling parameter for the inference.
+            - top_k: The top-k sampling parameter for the inference.
+            - uploaded_media_type: The type of media uploaded for inference.
+            - analysis_time_sec: The time taken for the analysis in seconds.
+            - input_tokens: The number of input tokens used in the inference.
+            - output_tokens: The number of output tokens generated by the inference.
+            - stage timings: Seconds spent in each pipeline stage of the last analysis.
+            - OCR pages: Confidence, seconds, and outcome of each OCR'd PDF page.
     """
+    stage_timings = "\n".join(
+        f"• {stage}: {seconds}"
+        for stage, seconds in st.session_state.stage_timings.items()
+    )
+    ocr_pages = ""
+    for page in st.session_state.ocr_pages:
+        confidence = (
+            f"{page['confidence']}% confidence"
+            if page["confidence"] is not None
+            else "no confidence score"
+        )
+        ocr_pages += (
+            f"\n• {page['file_name']} p{page['page'] + 1}: {confidence}, "
+            f"{page['seconds']}s, sent as {page['sent_as']}"
+        )
+    if ocr_pages:
+        ocr_pages = f"\n\nOCR Pages:{ocr_pages}"
+    return f"""
+Inference Parameters:
+• aws_region: {st.session_state.aws_region}
+• model_id: {st.session_state.model_id}
+• routed_model_id: {st.session_state.routed_model_id}
+• routing_reason: {st.session_state.routing_reason}
+• max_tokens: {st.session_state.max_tokens}
+• temperature: {st.session_state.temperature}
+• top_p: {st.session_state.top_p}
+• top_k: {st.session_state.top_k}
+• uploaded_media_type: {st.session_state.media_type}
 
-    is_image_based = True
-
-    with NamedTemporaryFile(suffix="pdf") as temp:
-        temp.write(uploaded_file.getvalue())
-        temp.seek(0)
-        doc = pymupdf.open(temp.name)
-
-    for page in doc:
-        text = page.get_text()
-        if text.strip():  # Check if there is any text content
-            is_image_based = False
-            break
+Inference Results:
+• analysis_time_sec: {st.session_state.analysis_time}
+• input_tokens: {st.session_state.input_tokens}
+• output_tokens: {st.session_state.output_tokens}
 
-    doc.close()
-    return is_image_based
+Stage Timings (sec):
+{stage_timings}{ocr_pages}"""
 
 
-def convert_pdf_to_images(
-    uploaded_file: Union[NamedTemporaryFile, StringIO]
-) -> List[Path]:
+def display_sidebar() -> None:
+    """
+    Displays the sidebar in the Streamlit application with various inference parameters.
+    The sidebar includes:
+    - A selectbox for selecting AWS regions.
+    - A selectbox for selecting model IDs from the Anthropic Claude 3 family of models.
+    - A slider for setting the maximum number of tokens.
+    - A slider for setting the temperature.
+    - A slider for setting the top_p parameter.
+    - A slider for setting the top_k parameter.
+    Additionally, it displays an inference summary at the bottom of the sidebar.
     """
-    Convert a PDF file to a list of images, one for each page.
 
-    Args:
-        uploaded_file (Union[NamedTemporaryFile, StringIO]): The uploaded PDF file to be converted.
+    with st.sidebar:
+        display_inference_parameters()
 
-    Returns:
-        List[Path]: A list of paths to the generated image files, one for each page of the PDF.
+
+@st.fragment
+def display_inference_parameters() -> None:
+    """
+    Displays the inference parameter widgets and inference summary. Runs as a fragment,
+    so changing a parameter reruns only this function, not the uploads or the analysis.
     """
 
-    images = []
-    zoom = 4
-    mat = pymupdf.Matrix(zoom, zoom)
+    st.markdown("### Inference Parameters")
+    st.session_state.aws_region = st.selectbox(
+        label="aws_region:",
+        options=AWS_REGIONS,
+    )
+    st.session_state.model_id = st.selectbox(
+        label="model_id (Anthropic Claude 3 family of models):",
+        options=MODEL_OPTIONS,
+    )
+    st.session_state.max_tokens = st.slider(
+        "max_tokens", min_value=0, max_value=5000, value=DEFAULT_MAX_TOKENS, step=10
+    )
+    st.session_state.temperature = st.slider(
+        "temperature",
+        min_value=0.0,
+        max_value=1.0,
+        value=DEFAULT_TEMPERATURE,
+        step=0.05,
+    )
+    st.session_state.top_p = st.slider(
+        "top_p", min_value=0.0, max_value=1.0, value=DEFAULT_TOP_P, step=0.01
+    )
+    st.session_state.top_k = st.slider(
+        "top_k", min_value=0, max_value=500, value=DEFAULT_TOP_K, step=1
+    )
 
-    with NamedTemporaryFile(suffix="pdf") as temp:
-        temp.write(uploaded_file.getvalue())
-        temp.seek(0)
-        doc = pymupdf.open(temp.name)
+    st.markdown("---")
 
-        for i, page in enumerate(doc):
-            image = page.get_pixmap()
-            image_path = Path(f"_temp_images/page_{i}.png")
-            image.save(image_path)
-            images.append(image_path)
-        doc.close()
+    # display inference summary
+    inference_summary = display_inference_summary()
+    st.text(inference_summary)
 
-    return images
 
+class UploadSnapshot(BytesIO):
+    """
+    An in-memory copy of a Streamlit UploadedFile that can be safely read from an
+    ingestion worker thread while the script thread keeps using the original.
+    """
 
-def extract_text_from_pdf_pymupdf(
-    uploaded_file: Union[NamedTemporaryFile, StringIO]
-) -> str:
+    def __init__(self, uploaded_file: Union[NamedTemporaryFile, StringIO]) -> None:
+        super().__init__(uploaded_file.getvalue())
+        self.name = uploaded_file.name
+        self.type = uploaded_file.type
+        self.size = uploaded_file.size
+        self.file_id = uploaded_file.file_id
+
+
+def ingest_file_scheduled(
+    uploaded_file: Union[NamedTemporaryFile, StringIO],
+    scheduler: FairScheduler,
+    session_id: str,
+    queue_positions: Dict[str, int],
+    ocr: bool = False,
+    gif_mode: str = GIF_FIRST_FRAME,
+) -> dict:
     """
-    Extracts text from a PDF file using PyMuPDF.
+    Runs `ingest_file` once the ingestion scheduler grants a CPU slot. PDFs, which may
+    need rasterizing, queue behind images and text files of the same session.
     Args:
-        uploaded_file (Union[NamedTemporaryFile, StringIO]): The uploaded PDF file,
-        which can be a NamedTemporaryFile or a StringIO object.
+        uploaded_file (Union[NamedTemporaryFile, StringIO]): The uploaded file to process.
+        scheduler (FairScheduler): The process-wide ingestion scheduler.
+        session_id (str): The Streamlit session that uploaded the file.
+        queue_positions (Dict[str, int]): Updated with the file's queue position while
+            it waits, and 0 once it is being processed.
+        ocr (bool): Whether to OCR image-based PDFs.
+        gif_mode (str): How to send animated GIFs.
     Returns:
-        str: The extracted text from the PDF.
+        dict: The result of `ingest_file`, with the wait recorded as a stage timing.
     """
 
-    with NamedTemporaryFile(suffix="pdf") as temp:
-        temp.write(uploaded_file.getvalue())
-        temp.seek(0)
-        doc = pymupdf.open(temp.name)
-        extract_text = "".join(page.get_text() for page in doc)
-        return extract_text
+    def record_position(position: int, _waited: float) -> None:
+        queue_positions[uploaded_file.file_id] = position
 
+    priority = (
+        PRIORITY_BULK
+        if uploaded_file.type == "application/pdf"
+        else PRIORITY_INTERACTIVE
+    )
+    with scheduler.acquire(session_id, priority, on_wait=record_position) as ticket:
+        queue_positions[uploaded_file.file_id] = 0
+        result = ingest_file(
+            uploaded_file, get_scratch_store().namespace(session_id), ocr, gif_mode
+        )
+    result["stage_timings"]["queue.ingestion_wait"] = round(ticket.wait_sec, 4)
+    return result
 
-def extract_text_from_pdf_docling(
-    uploaded_file: Union[NamedTemporaryFile, StringIO]
-) -> str:
-    """
-    Extracts text from a PDF file using OCR and table structure recognition.
 
-    Args:
-        uploaded_file (Union[NamedTemporaryFile, StringIO]): The uploaded PDF file to be processed.
+@st.cache_resource
+def get_ingestion_executor() -> ThreadPoolExecutor:
+    """Returns the process-wide worker pool that ingests uploads in the background."""
 
-    Returns:
-        str: The extracted text from the PDF in Markdown format.
+    return ThreadPoolExecutor(
+        max_workers=INGESTION_WORKERS, thread_name_prefix="ingestion"
+    )
 
-    This function uses a document conversion pipeline with OCR and table structure options enabled
-    to extract text from the provided PDF file. The extracted text is then exported to Markdown format.
-    """
 
-    pipeline_options = PdfPipelineOptions()
-    pipeline_options.do_ocr = False
-    pipeline_options.do_table_structure = True
-    pipeline_options.table_structure_options.do_cell_matching = True
+@st.cache_resource
+def get_schedulers() -> Tuple[FairScheduler, FairScheduler]:
+    """
+    Returns the process-wide schedulers shared by every session: one for CPU-bound
+    ingestion and one for network-bound model calls.
+    """
 
-    doc_converter = DocumentConverter(
-        format_options={
-            InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
-        }
+    return (
+        FairScheduler("ingestion", INGESTION_SLOTS),
+        FairScheduler("model", MODEL_CALL_SLOTS),
     )
 
-    with NamedTemporaryFile(suffix="pdf") as temp:
-        temp.write(uploaded_file.getvalue())
-        temp.seek(0)
-        conv_result = doc_converter.convert(temp.name)
-        extract_text = conv_result.document.export_to_markdown()
-        return extract_text
+
+@st.cache_resource
+def get_latency_tracker() -> LatencyTracker:
+    """
+    Returns the process-wide record of observed model latency used by "auto" routing.
+    """
+
+    return LatencyTracker()
 
 
-def extract_text_from_text(uploaded_file: Union[NamedTemporaryFile, StringIO]) -> str:
+@st.cache_resource
+def get_metrics_store() -> MetricsStore:
     """
-    Extracts text content from an uploaded file.
-    This function takes an uploaded file, which can be either a NamedTemporaryFile or a StringIO object,
-    and extracts its text content as a string.
-    Args:
-        uploaded_file (Union[NamedTemporaryFile, StringIO]): The uploaded file from which to extract text.
-    Returns:
-        str: The extracted text content of the uploaded file.
+    Returns the process-wide writer of the invocation metrics database.
     """
 
-    extract_text = StringIO(uploaded_file.getvalue().decode("utf-8"))
-    return extract_text.getvalue()
+    return MetricsStore()
 
 
-def save_image(
-    uploaded_file: Union[NamedTemporaryFile, StringIO], file_paths: List[dict]
+def record_invocation(
+    model_id: str,
+    file_paths: List[dict],
+    uploaded_files: List,
+    stage_timings: Dict[str, float],
 ) -> None:
     """
-    Save an uploaded image file to a temporary directory and update the file paths list.
-    Args:
-        uploaded_file (Union[NamedTemporaryFile, StringIO]): The uploaded image file.
-        file_paths (List[dict]): A list to store file path information dictionaries.
-    Returns:
-        None
-    Raises:
-        None
-    Logs:
-        - Error if the file size exceeds 5MB.
-        - Info when the image is successfully saved.
-    Notes:
-        - The function checks if the uploaded file size exceeds 5MB and logs an error if it does.
-        - The image is saved in a temporary directory named "_temp_images".
-        - The file path and type are appended to the `file_paths` list.
-    """
-
-    if uploaded_file.size > 5 * 1024 * 1024:  # 5MB
-        logger.error("File size exceeds 5MB limit")
-        st.error("File size exceeds 5MB limit")
-        return
-    image = Image.open(uploaded_file)
-    image_path = Path("_temp_images") / uploaded_file.name
-    image_path.parent.mkdir(exist_ok=True)
-    image.save(image_path)
-    file_paths.append(
-        {
-            "file_path": str(image_path),
-            "file_type": uploaded_file.type,
-        }
+    Appends the last model invocation of this session to the metrics store.
+    """
+
+    succeeded = st.session_state.outcome == OUTCOME_OK
+    get_metrics_store().record(
+        source="app",
+        model_id=model_id,
+        region=st.session_state.aws_region,
+        outcome=st.session_state.outcome,
+        payload_bytes=st.session_state.payload_bytes,
+        image_count=len(file_paths),
+        document_count=sum(
+            1
+            for uploaded_file in uploaded_files
+            if uploaded_file.type in ["application/pdf", "text/csv", "text/plain"]
+        ),
+        latency_sec=stage_timings.get("bedrock.invoke"),
+        total_sec=st.session_state.analysis_time if succeeded else None,
+        input_tokens=st.session_state.input_tokens if succeeded else None,
+        output_tokens=st.session_state.output_tokens if succeeded else None,
+        retries=st.session_state.retries,
+        stage_timings=stage_timings,
     )
-    logger.info("Image saved: %s (%s)", image_path, uploaded_file.type)
 
 
-def display_inference_summary() -> str:
-    """
-    Generates a summary of inference parameters and results from the session state.
+def get_session_id() -> str:
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "default"
 
-    Returns:
-        str: A formatted string containing the inference parameters and results.
-            The summary includes:
-            - aws_region: The AWS region used for inference.
-            - model_id: The ID of the model used for inference.
-            - max_tokens: The maximum number of tokens allowed in the inference.
-            - temperature: The temperature setting for the inference.
-            - top_p: The top-p sampling parameter for the inference.
-            - top_k: The top-k sampling parameter for the inference.
-            - uploaded_media_type: The type of media uploaded for inference.
-            - analysis_time_sec: The time taken for the analysis in seconds.
-            - input_tokens: The number of input tokens used in the inference.
-            - output_tokens: The number of output tokens generated by the inference.
-    """
-    return f"""
-Inference Parameters:
-• aws_region: {st.session_state.aws_region}
-• model_id: {st.session_state.model_id}
-• max_tokens: {st.session_state.max_tokens}
-• temperature: {st.session_state.temperature}
-• top_p: {st.session_state.top_p}
-• top_k: {st.session_state.top_k}
-• uploaded_media_type: {st.session_state.media_type}
 
-Inference Results:
-• analysis_time_sec: {st.session_state.analysis_time}
-• input_tokens: {st.session_state.input_tokens}
-• output_tokens: {st.session_state.output_tokens}"""
+def release_scratch(job: Future) -> None:
+    """Deletes the scratch files of an ingestion job, once it has finished."""
 
+    def release(done: Future) -> None:
+        # a job that raised, e.g. while queued for a slot, wrote no scratch files
+        if done.exception() is None:
+            get_scratch_store().release(done.result()["scratch_dir"])
 
-def display_sidebar() -> None:
-    """
-    Displays the sidebar in the Streamlit application with various inference parameters.
-    The sidebar includes:
-    - A selectbox for selecting AWS regions.
-    - A selectbox for selecting model IDs from the Anthropic Claude 3 family of models.
-    - A slider for setting the maximum number of tokens.
-    - A slider for setting the temperature.
-    - A slider for setting the top_p parameter.
-    - A slider for setting the top_k parameter.
-    Additionally, it displays an inference summary at the bottom of the sidebar.
-    """
+    job.add_done_callback(release)
 
-    with st.sidebar:
-        st.markdown("### Inference Parameters")
-        st.session_state.aws_regions = st.selectbox(
-            label="aws_region:",
-            options=AWS_REGIONS,
-        )
-        st.session_state.model_id = st.selectbox(
-            label="model_id (Anthropic Claude 3 family of models):",
-            options=MODELS,
-        )
-        st.session_state.max_tokens = st.slider(
-            "max_tokens", min_value=0, max_value=5000, value=DEFAULT_MAX_TOKENS, step=10
-        )
-        st.session_state.temperature = st.slider(
-            "temperature",
-            min_value=0.0,
-            max_value=1.0,
-            value=DEFAULT_TEMPERATURE,
-            step=0.05,
-        )
-        st.session_state.top_p = st.slider(
-            "top_p", min_value=0.0, max_value=1.0, value=DEFAULT_TOP_P, step=0.01
-        )
-        st.session_state.top_k = st.slider(
-            "top_k", min_value=0, max_value=500, value=DEFAULT_TOP_K, step=1
+
+def scratch_evicted(job: Future) -> bool:
+    """Returns True if a finished job's images were swept from scratch storage."""
+
+    return (
+        job.done()
+        and job.exception() is None
+        and not all(
+            os.path.exists(file_path["file_path"])
+            for file_path in job.result()["file_paths"]
         )
+    )
 
-        st.markdown("---")
 
-        # display inference summary
-        inference_summary = display_inference_summary()
-        st.text(inference_summary)
+def start_ingestion(uploaded_files: Optional[List]) -> None:
+    """
+    Starts background ingestion of any newly uploaded files, as soon as they are
+    uploaded, and forgets files that have been removed from the uploader.
+    Jobs are stored in session state keyed by the upload's file ID, so reruns
+    never process the same upload twice, unless its images have since been swept
+    from scratch storage to stay within the quota.
+    Args:
+        uploaded_files (Optional[List]): The files currently in the file uploader.
+    """
+
+    jobs: Dict[str, Future] = st.session_state.ingestion_jobs
+    current_ids = {uploaded_file.file_id for uploaded_file in uploaded_files or []}
+    for file_id in list(jobs):
+        if file_id not in current_ids:
+            release_scratch(jobs.pop(file_id))
+        elif scratch_evicted(jobs[file_id]):
+            del jobs[file_id]
+
+    if st.session_state.ocr_mode != st.session_state.ingestion_ocr_mode:
+        # image-based PDFs are processed differently with OCR on, so redo them
+        st.session_state.ingestion_ocr_mode = st.session_state.ocr_mode
+        for uploaded_file in uploaded_files or []:
+            if (
+                uploaded_file.type == "application/pdf"
+                and uploaded_file.file_id in jobs
+            ):
+                release_scratch(jobs.pop(uploaded_file.file_id))
+    if st.session_state.gif_mode != st.session_state.ingestion_gif_mode:
+        # likewise GIFs, which may be sent as keyframes or a filmstrip
+        st.session_state.ingestion_gif_mode = st.session_state.gif_mode
+        for uploaded_file in uploaded_files or []:
+            if uploaded_file.type == "image/gif" and uploaded_file.file_id in jobs:
+                release_scratch(jobs.pop(uploaded_file.file_id))
+    # keep this session's files ahead of idle sessions' files when sweeping
+    get_scratch_store().touch(st.session_state.scratch.directory)
+
+    for uploaded_file in uploaded_files or []:
+        if uploaded_file.file_id not in jobs:
+            logger.info(
+                "Uploaded file: %s (%s)", uploaded_file.name, uploaded_file.type
+            )
+            submit_ingestion(uploaded_file)
+
+
+def submit_ingestion(uploaded_file) -> None:
+    """Queues an upload for ingestion on the shared worker pool."""
+
+    ingestion_scheduler, _ = get_schedulers()
+    job = get_ingestion_executor().submit(
+        ingest_file_scheduled,
+        UploadSnapshot(uploaded_file),
+        ingestion_scheduler,
+        get_session_id(),
+        st.session_state.ingestion_queue_positions,
+        st.session_state.ocr_mode,
+        st.session_state.gif_mode,
+    )
+    st.session_state.ingestion_jobs[uploaded_file.file_id] = job
 
 
-def handle_form_submission() -> Tuple[bool, Optional[List], List[dict], Optional[str]]:
+def ingestion_status(uploaded_files: Optional[List]) -> Optional[str]:
+    """
+    Describes the progress of this session's uploads, including the queue position of
+    the next file waiting for a shared ingestion slot.
+    Returns:
+        Optional[str]: The status message, or None if every upload has been processed.
     """
-    Handles the form submission for analyzing uploaded content using Generative AI models.
 
-    This function creates a form using Streamlit to collect user inputs, including system and user prompts,
-    and files to be analyzed. It processes the uploaded files based on their types and extracts relevant
-    information to be used in the analysis.
+    jobs: Dict[str, Future] = st.session_state.ingestion_jobs
+    file_ids = [uploaded_file.file_id for uploaded_file in uploaded_files or []]
+    done = sum(1 for file_id in file_ids if jobs[file_id].done())
+    if done == len(file_ids):
+        return None
+    positions = [
+        st.session_state.ingestion_queue_positions.get(file_id, 0)
+        for file_id in file_ids
+        if not jobs[file_id].done()
+    ]
+    queued = [position for position in positions if position]
+    message = f"Processing uploads: {done} of {len(file_ids)} ready"
+    if queued and len(queued) == len(positions):
+        message += f", next file is number {min(queued)} in the shared queue"
+    return message
+
+
+def collect_ingestion_results(
+    uploaded_files: Optional[List],
+) -> Tuple[List[dict], List[str], List[Optional[ChunkIndex]], Dict[str, float]]:
+    """
+    Waits for any ingestion still in progress and gathers the results in upload order.
+    Uploads whose images were swept from scratch storage are re-ingested, at most
+    MAX_REINGEST_ATTEMPTS times each.
+    Args:
+        uploaded_files (Optional[List]): The files currently in the file uploader.
+    Returns:
+        Tuple[List[dict], List[str], List[Optional[ChunkIndex]], Dict[str, float]]:
+            - A list of dictionaries containing file paths and types for image files.
+            - The text extracted from each text-based file.
+            - The relevance index of each extracted text, or None if it is short.
+            - Seconds spent in each ingestion stage, summed over all files.
+    """
+
+    file_paths: List[dict] = []
+    extract_texts: List[str] = []
+    text_indexes: List[Optional[ChunkIndex]] = []
+    stage_timings: Dict[str, float] = {}
+    ocr_pages: List[dict] = []
+
+    jobs: Dict[str, Future] = st.session_state.ingestion_jobs
+    reingested: Dict[str, int] = {}
+    lost: List[str] = []
+    status = st.empty()
+    while True:
+        pending = [
+            jobs[uploaded_file.file_id] for uploaded_file in uploaded_files or []
+        ]
+        _, not_done = wait(pending, timeout=WAIT_POLL_SEC)
+        evicted = [
+            uploaded_file
+            for uploaded_file in uploaded_files or []
+            if uploaded_file.file_id not in lost
+            and scratch_evicted(jobs[uploaded_file.file_id])
+        ]
+        if not not_done and not evicted:
+            break
+        for uploaded_file in evicted:
+            attempts = reingested.get(uploaded_file.file_id, 0)
+            if attempts >= MAX_REINGEST_ATTEMPTS:
+                logger.warning(
+                    "Giving up on %s, swept from scratch %d times",
+                    uploaded_file.name,
+                    attempts + 1,
+                )
+                lost.append(uploaded_file.file_id)
+                continue
+            logger.info("Re-ingesting %s, swept from scratch", uploaded_file.name)
+            reingested[uploaded_file.file_id] = attempts + 1
+            submit_ingestion(uploaded_file)
+        status.caption(ingestion_status(uploaded_files))
+    status.empty()
+    get_scratch_store().touch(st.session_state.scratch.directory)
+
+    for uploaded_file in uploaded_files or []:
+        if uploaded_file.file_id in lost:
+            st.error(
+                f"{uploaded_file.name} was removed from scratch storage to stay within "
+                "its quota. Try fewer or smaller files."
+            )
+            continue
+        st.session_state.media_type = uploaded_file.type
+        result = jobs[uploaded_file.file_id].result()
+        if result["error"]:
+            st.error(result["error"])
+        file_paths.extend(result["file_paths"])
+        if result["text"] is not None:
+            extract_texts.append(result["text"])
+            text_indexes.append(result["text_index"])
+        stage_timings = merge_stage_timings(stage_timings, result["stage_timings"])
+        ocr_pages.extend(result["ocr_pages"])
+    st.session_state.ocr_pages = ocr_pages
+
+    return file_paths, extract_texts, text_indexes, stage_timings
+
+
+def handle_form_submission() -> Tuple[bool, Optional[List]]:
+    """
+    Displays the analysis form for collecting the system and user prompts and the
+    files to be analyzed, and starts processing uploads in the background as soon
+    as they are added.
 
     Returns:
-        Tuple[bool, Optional[List], List[dict], Optional[str]]:
+        Tuple[bool, Optional[List]]:
             - A boolean indicating whether the form was submitted.
             - A list of uploaded files, if any.
-            - A list of dictionaries containing file paths and types for image files.
-            - Extracted text from the uploaded files, if applicable.
     """
 
-    with st.form("ad_analyze_form", border=True, clear_on_submit=False):
+    with st.container(border=True):
         st.markdown(
             "Describe the role you want the model to play, the task you wish to perform, and upload the content to be analyzed. The Generative AI-based analysis is powered by Amazon Bedrock and Anthropic Claude 3 family of foundation models."
         )
@@ -418,43 +608,124 @@ def handle_form_submission() -> Tuple[bool, Optional[List], List[dict], Optional
             accept_multiple_files=True,
         )
 
-        file_paths: List[dict] = []
-        extract_text: Optional[str] = None
+        st.session_state.ocr_mode = st.checkbox(
+            "OCR image-based PDFs (send confidently recognized pages as text, not images)",
+            value=st.session_state.ocr_mode,
+        )
 
-        if uploaded_files:
-            for uploaded_file in uploaded_files:
-                logger.info(
-                    "Uploaded file: %s (%s)", uploaded_file.name, uploaded_file.type
-                )
-                st.session_state.media_type = uploaded_file.type
-            match uploaded_file.type:
-                case "text/csv" | "text/plain" | "application/octet-stream":
-                    extract_text = extract_text_from_text(uploaded_file)
-                    st.session_state.user_prompt += f"\n\n{extract_text}"
-                case "application/pdf":
-                    is_image: bool = is_pdf_image_based(uploaded_file)
-                    logging.info("is_image: %s", is_image)
-                    if is_pdf_image_based(uploaded_file):
-                        images = convert_pdf_to_images(uploaded_file)
-                        for image in images:
-                            file_paths.append(
-                                {
-                                    "file_path": str(image),
-                                    "file_type": "image/png",
-                                }
-                            )
-                    else:
-                        extract_text = extract_text_from_pdf_pymupdf(uploaded_file)
-                        st.session_state.user_prompt += f"\n\n{extract_text}"
-                case "image/jpeg" | "image/png" | "image/webp" | "image/gif":
-                    save_image(uploaded_file, file_paths)
-                case _:
-                    st.error("Invalid file type. Please upload a valid file type.")
-            logger.info("Prompt: %s", st.session_state.user_prompt)
+        st.session_state.gif_mode = st.selectbox(
+            "Animated GIFs (send the first frame, sampled keyframes, or a filmstrip)",
+            options=GIF_MODES,
+            index=GIF_MODES.index(st.session_state.gif_mode),
+        )
+
+        # process uploads now, not when the form is submitted
+        start_ingestion(uploaded_files)
+        status = ingestion_status(uploaded_files)
+        if status:
+            st.caption(status)
+        show_past_analyses(uploaded_files)
+
+        st.session_state.relevance_mode = st.checkbox(
+            "Send only the sections of long text attachments relevant to the prompt",
+            value=st.session_state.relevance_mode,
+        )
+
+        st.session_state.contact_sheets = st.checkbox(
+            "Pack small images into labeled contact sheets (for many small ads)",
+            value=st.session_state.contact_sheets,
+        )
+
+        st.session_state.conversation_mode = st.checkbox(
+            "Conversation mode (ask follow-up questions about the same uploads)",
+            value=st.session_state.conversation_mode,
+        )
+
+        submit_column, reset_column = st.columns([1, 4])
+        submitted = submit_column.button("Submit")
+        if st.session_state.conversation and reset_column.button("New conversation"):
+            reset_conversation()
 
-        submitted = st.form_submit_button("Submit")
+    return submitted, uploaded_files
 
-    return submitted, uploaded_files, file_paths, extract_text
+
+def upload_hashes(uploaded_files: Optional[List]) -> List[Tuple[str, str]]:
+    """
+    Returns the name and SHA-256 hash of each upload, hashing each upload only once.
+    """
+
+    hashes: Dict[str, str] = st.session_state.file_hashes
+    for file_id in set(hashes) - {
+        uploaded_file.file_id for uploaded_file in uploaded_files or []
+    }:
+        del hashes[file_id]
+    files = []
+    for uploaded_file in uploaded_files or []:
+        if uploaded_file.file_id not in hashes:
+            hashes[uploaded_file.file_id] = hashlib.sha256(
+                uploaded_file.getvalue()
+            ).hexdigest()
+        files.append((uploaded_file.name, hashes[uploaded_file.file_id]))
+    return files
+
+
+def show_past_analyses(uploaded_files: Optional[List]) -> None:
+    """
+    Lists archived analyses of any of the uploaded files before a new analysis is
+    submitted, so a past response can be reused instead of calling the model again.
+    """
+
+    file_hashes = [file_hash for _, file_hash in upload_hashes(uploaded_files)]
+    matches = get_archive().find_by_files(file_hashes, st.session_state.user_prompt)
+    if not matches:
+        return
+    st.info(
+        f"Already analyzed: {len(matches)} past "
+        f"{'analysis' if len(matches) == 1 else 'analyses'} of these files."
+    )
+    for match in matches:
+        analyzed_at = datetime.datetime.fromtimestamp(match["timestamp"])
+        same = "same prompt" if match["same_prompt"] else "different prompt"
+        with st.expander(
+            f"{analyzed_at:%Y-%m-%d %H:%M} · {match['model_id']} · "
+            f"{match['shared_files']} of {len(file_hashes)} files · {same}"
+        ):
+            st.caption(f"User prompt: {match['user_prompt'][:300]}")
+            st.markdown(match["response_text"][:1000])
+            if st.button("Reuse this analysis", key=f"reuse_analysis_{match['id']}"):
+                st.session_state.response_text = match["response_text"]
+                st.success("Showing the archived analysis; no model call was made.")
+
+
+def reset_conversation() -> None:
+    """Clears the conversation history so the next submission starts a new one."""
+
+    st.session_state.conversation = []
+    st.session_state.conversation_file_ids = []
+    st.session_state.message_json_cache = MessageJsonCache()
+    st.session_state.response_text = None
+
+
+@st.fragment
+def display_response() -> None:
+    """
+    Displays the most recent model response, preceded by the earlier exchanges when in
+    conversation mode. Runs as a fragment, so interacting with the response does not
+    rerun the rest of the page.
+    """
+
+    if st.session_state.conversation_mode:
+        for message in st.session_state.conversation[:-1]:
+            with st.chat_message(message["role"]):
+                text = message["content"][0]["text"]
+                st.markdown(text if len(text) < 500 else f"{text[:500]}...")
+
+    if st.session_state.response_text:
+        st.text_area(
+            "Model Response:",
+            value=st.session_state.response_text,
+            height=800,
+        )
 
 
 def main() -> None:
@@ -466,17 +737,19 @@ def main() -> None:
     2. Reads and applies custom CSS from a file.
     3. Initializes session state variables with default values if they are not already set.
     4. Displays the main title of the application.
-    5. Handles form submission and processes uploaded files.
+    5. Displays the form and starts background processing of uploaded files.
     6. If a form is submitted and a user prompt is provided, it:
         - Displays a separator.
+        - Waits for any uploads still being processed.
         - Displays a sample of the file contents or images based on the uploaded file type.
         - Shows a spinner while analyzing the input.
-        - Composes a message and invokes the AI model for analysis.
-        - Displays the model's response in a text area.
-        - Updates session state with analysis time and token usage.
+        - Composes a message, appending it to the conversation history in conversation mode,
+          and invokes the AI model for analysis.
+        - Updates session state with the response, analysis time, token usage, and per-stage timings.
         - Copies the response to the clipboard.
-    7. Displays a footer with author information.
-    8. Displays the sidebar of the application.
+    7. Displays the model's response in a text area.
+    8. Displays a footer with author information.
+    9. Displays the sidebar of the application.
     """
 
     st.set_page_config(page_title="Multimodal Analysis", page_icon="analysis.png")
@@ -498,61 +771,225 @@ def main() -> None:
         "analysis_time": 0,
         "input_tokens": 0,
         "output_tokens": 0,
+        "payload_bytes": 0,
+        "retries": 0,
+        "outcome": None,
+        "routed_model_id": None,
+        "routing_reason": None,
+        "stage_timings": {},
+        "ingestion_jobs": {},
+        "ingestion_queue_positions": {},
+        "response_text": None,
+        "conversation_mode": False,
+        "ocr_mode": OCR_DEFAULT,
+        "ingestion_ocr_mode": OCR_DEFAULT,
+        "ocr_pages": [],
+        "file_hashes": {},
+        "gif_mode": GIF_MODE_DEFAULT,
+        "ingestion_gif_mode": GIF_MODE_DEFAULT,
+        "contact_sheets": False,
+        "relevance_mode": RELEVANCE_DEFAULT,
+        "conversation": [],
+        "conversation_file_ids": [],
+        "attachment_blocks": {},
+        "message_json_cache": MessageJsonCache(),
     }
     for var, value in session_vars.items():
         if var not in st.session_state:
             st.session_state[var] = value
+    if "scratch" not in st.session_state:
+        # deletes this session's scratch files when the session ends
+        st.session_state.scratch = SessionScratch(get_scratch_store(), get_session_id())
 
     st.markdown("## Generative AI-powered Multimodal Analysis")
 
-    # display form and handle form submission
-    submitted, uploaded_files, file_paths, extract_text = handle_form_submission()
+    # display form and start processing uploads
+    submitted, uploaded_files = handle_form_submission()
 
     if submitted and st.session_state.user_prompt:
         st.markdown("---")
-        if uploaded_files:
-            if uploaded_files[0].type in [
-                "text/csv",
-                "text/plain",
-                "application/pdf",
-            ]:
-                # st.markdown(f"Sample of file contents:\n\n{extract_text[0:250]}...")
-                st.markdown(f"")
-            else:
-                for file_path in file_paths:
-                    st.image(file_path["file_path"], caption="", width=400)
-
-        with st.spinner(text="Analyzing..."):
-            start_time = datetime.datetime.now()
-            messages = compose_message(st.session_state.user_prompt, file_paths)
-            if messages:
-                response = invoke_model(
-                    st.session_state.model_id,
-                    st.session_state.system_prompt,
-                    messages,
-                    st.session_state.max_tokens,
-                    st.session_state.temperature,
-                    st.session_state.top_p,
-                    st.session_state.top_k,
+
+        # time each pipeline stage of this analysis
+        tracer = Tracer()
+        set_active_tracer(tracer)
+
+        # follow-ups only send uploads that are not already in the conversation
+        new_uploads = [
+            uploaded_file
+            for uploaded_file in uploaded_files or []
+            if not st.session_state.conversation_mode
+            or uploaded_file.file_id not in st.session_state.conversation_file_ids
+        ]
+
+        # pin the session's scratch files until the request is sent, so sweeps by
+        # other sessions cannot delete images that are yet to be read
+        with get_scratch_store().pin(st.session_state.scratch.directory):
+            with trace_span("ingest.wait"):
+                file_paths, extract_texts, text_indexes, ingestion_timings = (
+                    collect_ingestion_results(new_uploads)
+                )
+            if st.session_state.relevance_mode and extract_texts:
+                with trace_span("text.retrieve"):
+                    extract_texts, relevance_summary = select_relevant_texts(
+                        extract_texts, text_indexes, st.session_state.user_prompt
+                    )
+                if relevance_summary:
+                    st.caption(relevance_summary)
+            user_prompt = st.session_state.user_prompt + "".join(
+                f"\n\n{extract_text}" for extract_text in extract_texts
+            )
+            if st.session_state.contact_sheets and file_paths:
+                scratch_store = get_scratch_store()
+                sheet_dir = scratch_store.namespace(get_session_id())
+                with trace_span("image.pack", images=len(file_paths)):
+                    file_paths, legend = build_contact_sheets(file_paths, sheet_dir)
+                scratch_store.commit(sheet_dir)
+                if legend:
+                    user_prompt += f"\n\n{legend_text(legend)}"
+            if len(file_paths) > MAX_IMAGES_PER_REQUEST:
+                st.warning(
+                    f"{len(file_paths)} images exceed the limit of {MAX_IMAGES_PER_REQUEST} "
+                    "per request. Try packing small images into contact sheets."
+                )
+            logger.info("Prompt: %s", user_prompt)
+
+            if new_uploads:
+                if new_uploads[0].type in [
+                    "text/csv",
+                    "text/plain",
+                    "application/pdf",
+                ]:
+                    # st.markdown(f"Sample of file contents:\n\n{extract_text[0:250]}...")
+                    st.markdown(f"")
+                else:
+                    for file_path in file_paths:
+                        st.image(file_path["file_path"], caption="", width=400)
+
+            with st.spinner(text="Analyzing..."):
+                start_time = datetime.datetime.now()
+                messages = compose_message(
+                    user_prompt, file_paths, st.session_state.attachment_blocks
                 )
-                end_time = datetime.datetime.now()
-                if response:
-                    analysis = st.text_area(
-                        "Model Response:",
-                        value=response["content"][0]["text"],
-                        height=800,
+                # keep only the encoded blocks of this request; earlier turns hold their own
+                used_keys = {attachment_key(file_path) for file_path in file_paths}
+                st.session_state.attachment_blocks = {
+                    key: block
+                    for key, block in st.session_state.attachment_blocks.items()
+                    if key in used_keys
+                }
+                if messages and st.session_state.conversation_mode:
+                    messages = trim_conversation(
+                        st.session_state.conversation + messages
                     )
-                    st.session_state.analysis_time = (
-                        end_time - start_time
-                    ).total_seconds()
-                    st.session_state.input_tokens = response["usage"]["input_tokens"]
-                    st.session_state.output_tokens = response["usage"]["output_tokens"]
-                    pyperclip.copy(analysis)
-                    st.success("Response copied to clipboard.")
+                if messages:
+                    model_id = st.session_state.model_id
+                    if model_id == AUTO_MODEL_ID:
+                        model_id, routing_reason = route_model(
+                            messages,
+                            st.session_state.max_tokens,
+                            st.session_state.aws_region,
+                            get_latency_tracker(),
+                        )
+                    else:
+                        routing_reason = "fixed model choice"
+                    st.session_state.routed_model_id = model_id
+                    st.session_state.routing_reason = routing_reason
+
+                    _, model_scheduler = get_schedulers()
+                    queue_status = st.empty()
+
+                    def show_queue_position(position: int, waited: float) -> None:
+                        queue_status.caption(
+                            f"Waiting for a model slot: number {position} in the queue ({waited:.1f}s)"
+                        )
+
+                    with model_scheduler.acquire(
+                        get_session_id(), on_wait=show_queue_position
+                    ) as ticket:
+                        queue_status.empty()
+                        response = invoke_model(
+                            model_id,
+                            st.session_state.system_prompt,
+                            messages,
+                            st.session_state.max_tokens,
+                            st.session_state.temperature,
+                            st.session_state.top_p,
+                            st.session_state.top_k,
+                            st.session_state.message_json_cache,
+                        )
+                    queue_timings = {"queue.model_wait": round(ticket.wait_sec, 4)}
+                    end_time = datetime.datetime.now()
+                    if response:
+                        st.session_state.response_text = response["content"][0]["text"]
+                        if st.session_state.conversation_mode:
+                            st.session_state.conversation = messages + [
+                                {
+                                    "role": "assistant",
+                                    "content": [
+                                        {
+                                            "type": "text",
+                                            "text": st.session_state.response_text,
+                                        }
+                                    ],
+                                }
+                            ]
+                            st.session_state.conversation_file_ids += [
+                                uploaded_file.file_id for uploaded_file in new_uploads
+                            ]
+                        st.session_state.analysis_time = (
+                            end_time - start_time
+                        ).total_seconds()
+                        st.session_state.input_tokens = response["usage"][
+                            "input_tokens"
+                        ]
+                        st.session_state.output_tokens = response["usage"][
+                            "output_tokens"
+                        ]
+                        st.session_state.stage_timings = merge_stage_timings(
+                            ingestion_timings, queue_timings, tracer.stage_breakdown()
+                        )
+                        get_latency_tracker().record(
+                            model_id,
+                            st.session_state.aws_region,
+                            st.session_state.stage_timings.get("bedrock.invoke", 0),
+                            st.session_state.output_tokens,
+                        )
+                        record_invocation(
+                            model_id,
+                            file_paths,
+                            new_uploads,
+                            st.session_state.stage_timings,
+                        )
+                        get_archive().save(
+                            model_id,
+                            st.session_state.system_prompt,
+                            st.session_state.user_prompt,
+                            upload_hashes(uploaded_files),
+                            st.session_state.response_text,
+                            st.session_state.input_tokens,
+                            st.session_state.output_tokens,
+                        )
+                        pyperclip.copy(st.session_state.response_text)
+                        st.success("Response copied to clipboard.")
+                    else:
+                        record_invocation(
+                            model_id,
+                            file_paths,
+                            new_uploads,
+                            merge_stage_timings(
+                                ingestion_timings,
+                                queue_timings,
+                                tracer.stage_breakdown(),
+                            ),
+                        )
+                        st.error("An error occurred during the analysis")
                 else:
-                    st.error("An error occurred during the analysis")
-            else:
-                st.error("An error occurred constructing the analysis request")
+                    st.error("An error occurred constructing the analysis request")
+        tracer.flush()
+        set_active_tracer(None)
+
+    display_response()
+
     st.markdown(
         "<small style='color: #888888'> Gary A. Stafford, 2024</small>",
         unsafe_allow_html=True,
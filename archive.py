@@ -0,0 +1,242 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Local archive of completed analyses, keyed by the content hashes of their inputs and
+# full-text indexed with SQLite FTS5, so past analyses can be searched and reused
+# instead of paying for the same analysis twice.
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+ARCHIVE_DB: str = os.environ.get("ARCHIVE_DB", "_archive/analyses.db")
+
+# past analyses shown as "already analyzed" for the current uploads
+ARCHIVE_MATCH_LIMIT: int = 5
+
+# search results shown at once; building each result's snippet dominates search time
+ARCHIVE_SEARCH_LIMIT: int = 20
+
+# tokens of context around each search hit in a result snippet
+SNIPPET_TOKENS: int = 24
+
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS analyses (
+    id INTEGER PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    model_id TEXT NOT NULL,
+    system_prompt TEXT NOT NULL,
+    user_prompt TEXT NOT NULL,
+    file_names TEXT NOT NULL,
+    response_text TEXT NOT NULL,
+    input_tokens INTEGER,
+    output_tokens INTEGER
+);
+CREATE TABLE IF NOT EXISTS analysis_files (
+    analysis_id INTEGER NOT NULL REFERENCES analyses (id),
+    file_hash TEXT NOT NULL,
+    file_name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS analysis_files_hash ON analysis_files (file_hash);
+CREATE VIRTUAL TABLE IF NOT EXISTS analyses_fts USING fts5(
+    user_prompt,
+    system_prompt,
+    file_names,
+    response_text,
+    content='analyses',
+    content_rowid='id',
+    tokenize='porter unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS analyses_fts_insert AFTER INSERT ON analyses BEGIN
+    INSERT INTO analyses_fts (rowid, user_prompt, system_prompt, file_names, response_text)
+    VALUES (new.id, new.user_prompt, new.system_prompt, new.file_names, new.response_text);
+END;
+"""
+#################################################
+
+
+def fts_query(query: str) -> str:
+    """
+    Turns free text into an FTS5 query that matches every term, the last as a
+    prefix, so search works as you type. Terms are quoted, so punctuation such as
+    the dot in a file name never raises an FTS5 syntax error.
+    """
+
+    terms = [term.replace('"', '""') for term in query.split()]
+    return " ".join(
+        f'"{term}"*' if index == len(terms) - 1 else f'"{term}"'
+        for index, term in enumerate(terms)
+    )
+
+
+class AnalysisArchive:
+    """
+    Stores completed analyses with the SHA-256 hashes of their input files, and finds
+    them again by input files or by full-text search of their prompts, file names,
+    and responses. One connection is shared by every session, behind a lock.
+    Args:
+        path (str): The SQLite database file.
+    """
+
+    def __init__(self, path: str = ARCHIVE_DB) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        # readers (the archive page) do not block writers in other processes
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def save(
+        self,
+        model_id: str,
+        system_prompt: str,
+        user_prompt: str,
+        files: List[Tuple[str, str]],
+        response_text: str,
+        input_tokens: Optional[int] = None,
+        output_tokens: Optional[int] = None,
+    ) -> int:
+        """
+        Archives one completed analysis.
+        Args:
+            model_id (str): The model that produced the response.
+            system_prompt (str): The system prompt.
+            user_prompt (str): The user prompt, without the text extracted from files.
+            files (List[Tuple[str, str]]): The file name and SHA-256 hash of each input.
+            response_text (str): The model response.
+            input_tokens (Optional[int]): Input tokens reported by the model.
+            output_tokens (Optional[int]): Output tokens reported by the model.
+        Returns:
+            int: The id of the archived analysis.
+        """
+
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO analyses (timestamp, model_id, system_prompt, user_prompt, "
+                "file_names, response_text, input_tokens, output_tokens) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    time.time(),
+                    model_id,
+                    system_prompt,
+                    user_prompt,
+                    "\n".join(file_name for file_name, _ in files),
+                    response_text,
+                    input_tokens,
+                    output_tokens,
+                ),
+            )
+            self._connection.executemany(
+                "INSERT INTO analysis_files (analysis_id, file_hash, file_name) "
+                "VALUES (?, ?, ?)",
+                [
+                    (cursor.lastrowid, file_hash, file_name)
+                    for file_name, file_hash in files
+                ],
+            )
+        return cursor.lastrowid
+
+    def find_by_files(
+        self,
+        file_hashes: List[str],
+        user_prompt: str = "",
+        limit: int = ARCHIVE_MATCH_LIMIT,
+    ) -> List[dict]:
+        """
+        Finds past analyses of any of the given files, whatever they were named.
+        Args:
+            file_hashes (List[str]): SHA-256 hashes of the current input files.
+            user_prompt (str): The current user prompt; analyses with the same prompt
+                are listed first.
+            limit (int): The most analyses to return.
+        Returns:
+            List[dict]: Matching analyses, best first: same prompt, then most files in
+                common, then most recent. Each includes "shared_files", the number of
+                the given files it analyzed, "file_count", and "same_prompt".
+        """
+
+        if not file_hashes:
+            return []
+        placeholders = ", ".join("?" * len(file_hashes))
+        with self._lock:
+            rows = self._connection.execute(
+                f"""
+                SELECT analyses.*,
+                    COUNT(DISTINCT matched.file_hash) AS shared_files,
+                    (SELECT COUNT(*) FROM analysis_files
+                        WHERE analysis_id = analyses.id) AS file_count,
+                    analyses.user_prompt = ? AS same_prompt
+                FROM analysis_files AS matched
+                JOIN analyses ON analyses.id = matched.analysis_id
+                WHERE matched.file_hash IN ({placeholders})
+                GROUP BY analyses.id
+                ORDER BY same_prompt DESC, shared_files DESC, analyses.timestamp DESC
+                LIMIT ?
+                """,
+                (user_prompt, *file_hashes, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def search(self, query: str, limit: int = ARCHIVE_SEARCH_LIMIT) -> List[dict]:
+        """
+        Full-text searches past analyses by brand, prompt text, file name, or response.
+        Args:
+            query (str): Free text; every term must match, the last as a prefix.
+            limit (int): The most analyses to return.
+        Returns:
+            List[dict]: Matching analyses, newest first, each with a "snippet" of the
+                response (or prompt) around the matched terms, hits in **bold**. If the
+                query is empty, the most recent analyses.
+        """
+
+        # newest first, not by BM25 rank: FTS5 walks its rowids in order and stops at
+        # the limit, where ranking must score every match of a common term
+
+        with self._lock:
+            if not query.strip():
+                rows = self._connection.execute(
+                    "SELECT *, substr(response_text, 1, 200) AS snippet FROM analyses "
+                    "ORDER BY id DESC LIMIT ?",
+                    (limit,),
+                ).fetchall()
+            else:
+                rows = self._connection.execute(
+                    f"""
+                    SELECT analyses.*,
+                        snippet(analyses_fts, -1, '**', '**', '...', {SNIPPET_TOKENS})
+                            AS snippet
+                    FROM analyses_fts
+                    JOIN analyses ON analyses.id = analyses_fts.rowid
+                    WHERE analyses_fts MATCH ?
+                    ORDER BY analyses_fts.rowid DESC
+                    LIMIT ?
+                    """,
+                    (fts_query(query), limit),
+                ).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+_archive: Optional[AnalysisArchive] = None
+_archive_lock = threading.Lock()
+
+
+def get_archive() -> AnalysisArchive:
+    """Returns the process-wide analysis archive, opening it on first use."""
+
+    global _archive  # pylint: disable=global-statement
+    with _archive_lock:
+        if _archive is None:
+            _archive = AnalysisArchive()
+        return _archive
@@ -0,0 +1,458 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Local stand-in for the Amazon Bedrock Runtime API, used for benchmarks and load tests.
+# Point boto3 at it with: export AWS_ENDPOINT_URL_BEDROCK_RUNTIME="http://127.0.0.1:8765"
+
+import argparse
+import base64
+import json
+import logging
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import Credentials
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+DEFAULT_PORT: int = 8765
+DEFAULT_FIRST_TOKEN_LATENCY_SEC: float = 0.25
+DEFAULT_TOKENS_PER_SEC: float = 80.0
+DEFAULT_OUTPUT_TOKENS: int = 400
+DEFAULT_THROTTLE_RATE: float = 0.0
+DEFAULT_STREAM_CHUNK_TOKENS: int = 8
+
+# rough image cost used by Anthropic for a ~1.15 megapixel image
+IMAGE_TOKENS_ESTIMATE: int = 1600
+
+INVOKE_PATH = re.compile(
+    r"^/model/(?P<model_id>[^/]+)/(?P<action>invoke|invoke-with-response-stream)$"
+)
+
+AUTHORIZATION = re.compile(
+    r"^AWS4-HMAC-SHA256 Credential=(?P<access_key>[^/]+)/\d{8}/(?P<region>[^/]+)/"
+    r"(?P<service>[^/]+)/aws4_request, SignedHeaders=(?P<signed_headers>[^,]+), "
+    r"Signature=(?P<signature>[0-9a-f]{64})$"
+)
+#################################################
+
+
+class FakeBedrockConfig:
+    """
+    Behavior of the fake endpoint. Attributes may be changed while the server runs.
+    Args:
+        first_token_latency_sec (float): Delay before the first output token.
+        tokens_per_sec (float): Simulated generation speed.
+        output_tokens (int): Tokens generated per response, capped by `max_tokens`.
+        throttle_rate (float): Fraction of requests rejected with a ThrottlingException.
+        stream_chunk_tokens (int): Tokens per `content_block_delta` event when streaming.
+        seed (int): Seed for the throttling random number generator.
+        secret_access_key (Optional[str]): If set, requests whose SigV4 signature was
+            not made with this secret key, over the path and body as received, are
+            rejected with an InvalidSignatureException, as Bedrock would.
+    """
+
+    def __init__(
+        self,
+        first_token_latency_sec: float = DEFAULT_FIRST_TOKEN_LATENCY_SEC,
+        tokens_per_sec: float = DEFAULT_TOKENS_PER_SEC,
+        output_tokens: int = DEFAULT_OUTPUT_TOKENS,
+        throttle_rate: float = DEFAULT_THROTTLE_RATE,
+        stream_chunk_tokens: int = DEFAULT_STREAM_CHUNK_TOKENS,
+        seed: int = 42,
+        secret_access_key: Optional[str] = None,
+    ) -> None:
+        self.first_token_latency_sec = first_token_latency_sec
+        self.tokens_per_sec = tokens_per_sec
+        self.output_tokens = output_tokens
+        self.throttle_rate = throttle_rate
+        self.stream_chunk_tokens = stream_chunk_tokens
+        self.secret_access_key = secret_access_key
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.request_count = 0
+        self.throttled_count = 0
+
+    def should_throttle(self) -> bool:
+        with self._lock:
+            self.request_count += 1
+            throttled = self._random.random() < self.throttle_rate
+            if throttled:
+                self.throttled_count += 1
+            return throttled
+
+
+def signature_error(
+    path: str, headers, body: bytes, secret_access_key: str
+) -> Optional[str]:
+    """
+    Checks a request's SigV4 signature by recomputing it, with botocore's signer,
+    from the request line and headers exactly as they arrived.
+    Args:
+        path (str): The path of the request line, as sent.
+        headers: The request headers.
+        body (bytes): The request body.
+        secret_access_key (str): The secret key the client should have signed with.
+    Returns:
+        Optional[str]: Why the signature does not match, or None if it does.
+    """
+
+    authorization = AUTHORIZATION.match(headers.get("Authorization", ""))
+    if not authorization or "X-Amz-Date" not in headers:
+        return "Missing or malformed Authorization header"
+    request = AWSRequest(
+        method="POST",
+        url=f"http://{headers.get('Host', '')}{path}",
+        data=body,
+        headers={
+            name: headers.get(name, "")
+            for name in authorization.group("signed_headers").split(";")
+        },
+    )
+    request.context["timestamp"] = headers["X-Amz-Date"]
+    signer = SigV4Auth(
+        Credentials(authorization.group("access_key"), secret_access_key),
+        authorization.group("service"),
+        authorization.group("region"),
+    )
+    canonical_request = signer.canonical_request(request)
+    expected = signer.signature(
+        signer.string_to_sign(request, canonical_request), request
+    )
+    if expected != authorization.group("signature"):
+        return (
+            "The request signature we calculated does not match the signature you "
+            f"provided. The canonical request was:\n{canonical_request}"
+        )
+    return None
+
+
+def estimate_input_tokens(request: dict) -> int:
+    """
+    Approximates the input token count of a Messages API request body.
+    Args:
+        request (dict): The decoded request body.
+    Returns:
+        int: Roughly 4 characters per text token plus a flat cost per image.
+    """
+
+    chars = len(request.get("system", ""))
+    images = 0
+    for message in request.get("messages", []):
+        content = message.get("content", [])
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for block in content:
+            if block.get("type") == "text":
+                chars += len(block.get("text", ""))
+            elif block.get("type") == "image":
+                images += 1
+    return chars // 4 + images * IMAGE_TOKENS_ESTIMATE
+
+
+def generate_tokens(count: int) -> List[str]:
+    words = [
+        "lorem",
+        "ipsum",
+        "dolor",
+        "sit",
+        "amet",
+        "consectetur",
+        "adipiscing",
+        "elit",
+    ]
+    return [f"{words[i % len(words)]} " for i in range(count)]
+
+
+def encode_event_message(headers: dict, payload: bytes) -> bytes:
+    """
+    Encodes one message in the `application/vnd.amazon.eventstream` binary format
+    that botocore expects from InvokeModelWithResponseStream.
+    Args:
+        headers (dict): String-valued event headers.
+        payload (bytes): The message payload.
+    Returns:
+        bytes: The framed message, including prelude and message CRCs.
+    """
+
+    encoded_headers = b""
+    for name, value in headers.items():
+        name_bytes = name.encode("utf-8")
+        value_bytes = value.encode("utf-8")
+        encoded_headers += (
+            len(name_bytes).to_bytes(1, "big")
+            + name_bytes
+            + (7).to_bytes(1, "big")  # header value type 7 = string
+            + len(value_bytes).to_bytes(2, "big")
+            + value_bytes
+        )
+    total_length = 12 + len(encoded_headers) + len(payload) + 4
+    prelude = total_length.to_bytes(4, "big") + len(encoded_headers).to_bytes(4, "big")
+    prelude += zlib.crc32(prelude).to_bytes(4, "big")
+    message = prelude + encoded_headers + payload
+    return message + zlib.crc32(message).to_bytes(4, "big")
+
+
+def encode_chunk(event: dict) -> bytes:
+    payload = json.dumps(
+        {"bytes": base64.b64encode(json.dumps(event).encode("utf-8")).decode("utf8")}
+    ).encode("utf-8")
+    return encode_event_message(
+        {
+            ":event-type": "chunk",
+            ":content-type": "application/json",
+            ":message-type": "event",
+        },
+        payload,
+    )
+
+
+class FakeBedrockHandler(BaseHTTPRequestHandler):
+    """Serves InvokeModel and InvokeModelWithResponseStream for Anthropic models."""
+
+    config: FakeBedrockConfig = FakeBedrockConfig()
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+        logger.debug(format, *args)
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        match = INVOKE_PATH.match(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not match:
+            self._send_error(404, "ResourceNotFoundException", "Unknown operation")
+            return
+        if self.config.secret_access_key is not None:
+            error = signature_error(
+                self.path, self.headers, body, self.config.secret_access_key
+            )
+            if error:
+                self._send_error(403, "InvalidSignatureException", error)
+                return
+        if self.config.should_throttle():
+            self._send_error(
+                429,
+                "ThrottlingException",
+                "Too many requests, please wait before trying again.",
+            )
+            return
+        try:
+            request = json.loads(body)
+        except json.JSONDecodeError:
+            self._send_error(400, "ValidationException", "Malformed input request")
+            return
+
+        input_tokens = estimate_input_tokens(request)
+        output_tokens = min(self.config.output_tokens, request.get("max_tokens", 0))
+        model_id = match.group("model_id")
+        if match.group("action") == "invoke":
+            self._send_invoke(model_id, input_tokens, output_tokens)
+        else:
+            self._send_stream(model_id, input_tokens, output_tokens)
+
+    def _generation_time(self, output_tokens: int) -> float:
+        return (
+            self.config.first_token_latency_sec
+            + output_tokens / self.config.tokens_per_sec
+        )
+
+    def _send_error(self, status: int, error_type: str, message: str) -> None:
+        payload = json.dumps({"message": message}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header(
+            "x-amzn-ErrorType",
+            f"{error_type}:http://internal.amazon.com/coral/com.amazon.bedrock/",
+        )
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_invoke(
+        self, model_id: str, input_tokens: int, output_tokens: int
+    ) -> None:
+        time.sleep(self._generation_time(output_tokens))
+        payload = json.dumps(
+            {
+                "id": f"msg_fake_{self.config.request_count}",
+                "type": "message",
+                "role": "assistant",
+                "model": model_id,
+                "content": [
+                    {"type": "text", "text": "".join(generate_tokens(output_tokens))}
+                ],
+                "stop_reason": "end_turn",
+                "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+            }
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("X-Amzn-Bedrock-Input-Token-Count", str(input_tokens))
+        self.send_header("X-Amzn-Bedrock-Output-Token-Count", str(output_tokens))
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_stream(
+        self, model_id: str, input_tokens: int, output_tokens: int
+    ) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.amazon.eventstream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        started = time.perf_counter()
+        time.sleep(self.config.first_token_latency_sec)
+        self._write_chunk(
+            encode_chunk(
+                {
+                    "type": "message_start",
+                    "message": {
+                        "id": f"msg_fake_{self.config.request_count}",
+                        "type": "message",
+                        "role": "assistant",
+                        "model": model_id,
+                        "content": [],
+                        "usage": {"input_tokens": input_tokens, "output_tokens": 0},
+                    },
+                }
+            )
+        )
+        self._write_chunk(
+            encode_chunk(
+                {
+                    "type": "content_block_start",
+                    "index": 0,
+                    "content_block": {"type": "text", "text": ""},
+                }
+            )
+        )
+        tokens = generate_tokens(output_tokens)
+        step = max(1, self.config.stream_chunk_tokens)
+        for i in range(0, len(tokens), step):
+            chunk = tokens[i : i + step]
+            time.sleep(len(chunk) / self.config.tokens_per_sec)
+            self._write_chunk(
+                encode_chunk(
+                    {
+                        "type": "content_block_delta",
+                        "index": 0,
+                        "delta": {"type": "text_delta", "text": "".join(chunk)},
+                    }
+                )
+            )
+        self._write_chunk(encode_chunk({"type": "content_block_stop", "index": 0}))
+        self._write_chunk(
+            encode_chunk(
+                {
+                    "type": "message_delta",
+                    "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                    "usage": {"output_tokens": output_tokens},
+                }
+            )
+        )
+        latency_ms = int((time.perf_counter() - started) * 1000)
+        self._write_chunk(
+            encode_chunk(
+                {
+                    "type": "message_stop",
+                    "amazon-bedrock-invocationMetrics": {
+                        "inputTokenCount": input_tokens,
+                        "outputTokenCount": output_tokens,
+                        "invocationLatency": latency_ms,
+                        "firstByteLatency": int(
+                            self.config.first_token_latency_sec * 1000
+                        ),
+                    },
+                }
+            )
+        )
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def start_fake_bedrock(
+    config: FakeBedrockConfig = None, host: str = "127.0.0.1", port: int = 0
+) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    Starts the fake Bedrock Runtime endpoint on a background thread.
+    Args:
+        config (FakeBedrockConfig): Endpoint behavior; defaults are used if omitted.
+        host (str): Interface to bind.
+        port (int): Port to bind; 0 picks a free port.
+    Returns:
+        Tuple[ThreadingHTTPServer, str]: The running server and its endpoint URL.
+        Call `server.shutdown()` to stop it.
+    """
+
+    handler = type(
+        "ConfiguredFakeBedrockHandler",
+        (FakeBedrockHandler,),
+        {"config": config or FakeBedrockConfig()},
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint_url = f"http://{host}:{server.server_address[1]}"
+    logger.info("Fake Bedrock Runtime listening on %s", endpoint_url)
+    return server, endpoint_url
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Run a local fake Bedrock Runtime endpoint."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--first-token-latency", type=float, default=DEFAULT_FIRST_TOKEN_LATENCY_SEC
+    )
+    parser.add_argument("--tokens-per-sec", type=float, default=DEFAULT_TOKENS_PER_SEC)
+    parser.add_argument("--output-tokens", type=int, default=DEFAULT_OUTPUT_TOKENS)
+    parser.add_argument("--throttle-rate", type=float, default=DEFAULT_THROTTLE_RATE)
+    parser.add_argument(
+        "--stream-chunk-tokens", type=int, default=DEFAULT_STREAM_CHUNK_TOKENS
+    )
+    parser.add_argument(
+        "--secret-access-key",
+        help="Verify SigV4 signatures made with this secret key",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    config = FakeBedrockConfig(
+        first_token_latency_sec=args.first_token_latency,
+        tokens_per_sec=args.tokens_per_sec,
+        output_tokens=args.output_tokens,
+        throttle_rate=args.throttle_rate,
+        stream_chunk_tokens=args.stream_chunk_tokens,
+        secret_access_key=args.secret_access_key,
+    )
+    handler = type(
+        "ConfiguredFakeBedrockHandler", (FakeBedrockHandler,), {"config": config}
+    )
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    logger.info("Fake Bedrock Runtime listening on http://%s:%s", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Import-time profile of app.py, parsed from `python -X importtime`, to catch cold start regressions.
+# Usage (from the repository root): python -m benchmarks.import_time
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+REPO_ROOT: Path = Path(__file__).resolve().parent.parent
+
+DEFAULT_RESULTS_PATH: Path = REPO_ROOT / "benchmarks" / "results" / "import_time.jsonl"
+DEFAULT_TOP_N: int = 15
+
+# printed by the child process after the import so peak RSS can be recorded too
+RSS_MARKER: str = "MAX_RSS_KB="
+
+# VmHWM starts fresh at exec, whereas ru_maxrss would include the RSS of the parent
+# at fork time, inflating results when profiling from a large benchmark process
+PEAK_RSS_SNIPPET: str = f"""
+try:
+    with open("/proc/self/status") as status_file:
+        kb = next(int(l.split()[1]) for l in status_file if l.startswith("VmHWM:"))
+except OSError:
+    import resource
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print("{RSS_MARKER}" + str(kb))
+"""
+
+
+def parse_importtime(stderr: str) -> List[Dict]:
+    """
+    Parses `-X importtime` output lines of the form
+    `import time:  self [us] |  cumulative | imported package`.
+    Args:
+        stderr (str): The stderr of a `python -X importtime` run.
+    Returns:
+        List[Dict]: One entry per imported module with self and cumulative microseconds
+        and its nesting depth (0 for modules imported directly by the target).
+    """
+
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|", 2)
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        entries.append(
+            {
+                "module": name.strip(),
+                "self_us": int(self_us),
+                "cumulative_us": int(cumulative_us),
+                "depth": depth,
+            }
+        )
+    return entries
+
+
+def profile_import(module: str = "app", prewarm: bool = False) -> Dict:
+    """
+    Imports `module` in a fresh interpreter with `-X importtime`.
+    Args:
+        module (str): The module to import.
+        prewarm (bool): Whether background prewarming of heavy dependencies is enabled.
+    Returns:
+        Dict: Total import time, peak RSS, and the slowest top-level packages.
+    """
+
+    env = dict(os.environ, PREWARM_IMPORTS=str(prewarm).lower())
+    code = f"import {module}\n{PEAK_RSS_SNIPPET}"
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPO_ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    entries = parse_importtime(completed.stderr)
+    max_rss_kb = next(
+        int(line[len(RSS_MARKER) :])
+        for line in completed.stdout.splitlines()
+        if line.startswith(RSS_MARKER)
+    )
+
+    # attribute time to top-level packages, e.g. every streamlit.* module to streamlit
+    packages: Dict[str, int] = {}
+    for entry in entries:
+        package = entry["module"].split(".")[0]
+        packages[package] = packages.get(package, 0) + entry["self_us"]
+    target = next((e for e in entries if e["module"] == module), None)
+    return {
+        "module": module,
+        "prewarm": prewarm,
+        "total_ms": round(sum(e["self_us"] for e in entries) / 1000, 1),
+        "target_cumulative_ms": (
+            round(target["cumulative_us"] / 1000, 1) if target else None
+        ),
+        "max_rss_mb": round(max_rss_kb / 1024, 1),
+        "module_count": len(entries),
+        "packages_ms": {
+            name: round(us / 1000, 1)
+            for name, us in sorted(packages.items(), key=lambda item: -item[1])
+        },
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Profile the import time of app.py.")
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP_N)
+    parser.add_argument("--results", type=Path, default=DEFAULT_RESULTS_PATH)
+    parser.add_argument("--no-record", action="store_true")
+    args = parser.parse_args()
+
+    profile = profile_import(args.module)
+    print(
+        f"import {profile['module']}: {profile['total_ms']} ms, "
+        f"{profile['module_count']} modules, peak RSS {profile['max_rss_mb']} MB"
+    )
+    for name, ms in list(profile["packages_ms"].items())[: args.top]:
+        print(f"  {name:<30} {ms:>10.1f} ms")
+
+    if not args.no_record:
+        args.results.parent.mkdir(parents=True, exist_ok=True)
+        record = {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            **profile,
+        }
+        with open(args.results, "a", encoding="utf-8") as results_file:
+            results_file.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
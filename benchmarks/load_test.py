@@ -0,0 +1,156 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Load test of the async analysis API (server.py) against the local Bedrock Runtime stand-in.
+# Usage (from the repository root): python -m benchmarks.load_test --requests 1000 --concurrency 300
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import statistics
+import time
+from collections import Counter
+from typing import Dict, List
+
+from aiohttp import ClientSession, TCPConnector, web
+
+from benchmarks.fake_bedrock import FakeBedrockConfig, start_fake_bedrock
+from benchmarks.run_benchmarks import MERCEDES_ADS, REPO_ROOT
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+async def run_load(
+    url: str, requests: int, concurrency: int, tenants: int, payload: dict, stream: bool
+) -> Dict:
+    """
+    Sends `requests` analysis requests with at most `concurrency` in flight, spread
+    round-robin over `tenants` tenant ids.
+    Returns:
+        Dict: Throughput, latency percentiles, and a count of responses by status.
+    """
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    endpoint = f"{url}/v1/analyses{'/stream' if stream else ''}"
+    body = json.dumps(payload)
+
+    async with ClientSession(connector=TCPConnector(limit=concurrency)) as session:
+
+        async def one(index: int) -> None:
+            async with semaphore:
+                start = time.perf_counter()
+                async with session.post(
+                    endpoint,
+                    data=body,
+                    headers={
+                        "Content-Type": "application/json",
+                        "X-Tenant-Id": f"tenant-{index % tenants}",
+                    },
+                ) as response:
+                    await response.read()
+                    statuses[response.status] += 1
+                    if response.status == 200:
+                        latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "elapsed_sec": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "p50_sec": round(statistics.median(latencies), 3) if latencies else None,
+        "p95_sec": round(percentile(latencies, 0.95), 3),
+        "p99_sec": round(percentile(latencies, 0.99), 3),
+        "statuses": dict(statuses),
+    }
+
+
+async def main_async(args: argparse.Namespace) -> Dict:
+    config = FakeBedrockConfig(
+        first_token_latency_sec=args.first_token_latency,
+        tokens_per_sec=args.tokens_per_sec,
+        output_tokens=args.output_tokens,
+        throttle_rate=args.throttle_rate,
+    )
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "load-test")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "load-test")
+    # requests signed over a different path or body than was sent fail with 403
+    config.secret_access_key = os.environ["AWS_SECRET_ACCESS_KEY"]
+    fake_server, endpoint_url = start_fake_bedrock(config)
+    os.environ["AWS_ENDPOINT_URL_BEDROCK_RUNTIME"] = endpoint_url
+    os.environ.setdefault("TRACE_SINK", "none")
+    os.chdir(REPO_ROOT)
+
+    import server  # pylint: disable=import-outside-toplevel
+
+    runner = web.AppRunner(
+        server.create_app(
+            max_concurrency=args.max_concurrency,
+            max_queue_depth=args.max_queue_depth,
+            tenant_concurrency=args.tenant_concurrency,
+        )
+    )
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # pylint: disable=protected-access
+
+    payload = {"user_prompt": "Describe this ad in one sentence.", "max_tokens": 200}
+    if args.with_image:
+        payload["files"] = [
+            {
+                "name": MERCEDES_ADS[0].name,
+                "type": "image/jpeg",
+                "data": base64.b64encode(MERCEDES_ADS[0].read_bytes()).decode("utf8"),
+            }
+        ]
+    try:
+        return await run_load(
+            f"http://127.0.0.1:{port}",
+            args.requests,
+            args.concurrency,
+            args.tenants,
+            payload,
+            args.stream,
+        )
+    finally:
+        await runner.cleanup()
+        fake_server.shutdown()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test the analysis API server.")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=300)
+    parser.add_argument("--tenants", type=int, default=4)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--with-image", action="store_true")
+    parser.add_argument("--max-concurrency", type=int, default=256)
+    parser.add_argument("--max-queue-depth", type=int, default=1024)
+    parser.add_argument("--tenant-concurrency", type=int, default=128)
+    parser.add_argument("--first-token-latency", type=float, default=0.25)
+    parser.add_argument("--tokens-per-sec", type=float, default=400.0)
+    parser.add_argument("--output-tokens", type=int, default=100)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    print(json.dumps(asyncio.run(main_async(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
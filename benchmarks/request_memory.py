@@ -0,0 +1,192 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Peak RSS of building and sending one multimodal request, comparing the low-memory
+# request body builder with the previous json.dumps of base64 strings.
+# Usage (from the repository root): python -m benchmarks.request_memory
+
+import argparse
+import base64
+import datetime
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+from benchmarks.fake_bedrock import FakeBedrockConfig, start_fake_bedrock
+
+REPO_ROOT: Path = Path(__file__).resolve().parent.parent
+
+MERCEDES_ADS: List[Path] = sorted((REPO_ROOT / "mercedes_benz_ads").glob("ad*.jpeg"))
+
+DEFAULT_RESULTS_PATH: Path = (
+    REPO_ROOT / "benchmarks" / "results" / "request_memory.jsonl"
+)
+
+# Bedrock accepts at most 20 images per request
+DEFAULT_IMAGE_COUNT: int = 20
+
+# "buffer" is the current builder; "json" rebuilds the body as the app used to
+STRATEGIES: List[str] = ["json", "buffer"]
+
+# printed by the child process once the request has been sent
+RSS_MARKER: str = "PEAK_RSS_DELTA_KB="
+
+ENVELOPE: dict = {
+    "anthropic_version": "bedrock-2023-05-31",
+    "max_tokens": 256,
+    "system": "You are an experienced Creative Director.",
+    "temperature": 0.2,
+    "top_p": 0.999,
+    "top_k": 250,
+}
+
+
+def read_status_kb(field: str) -> int:
+    with open("/proc/self/status", encoding="utf-8") as status_file:
+        return next(
+            int(line.split()[1]) for line in status_file if line.startswith(field)
+        )
+
+
+def json_body(file_paths: List[dict]) -> str:
+    """
+    Builds the body as the app did before request_body.py: base64 strings in the
+    message, then `json.dumps` of the whole request.
+    """
+
+    content = [{"type": "text", "text": "Analyze these ads."}]
+    for file_path in file_paths:
+        with open(file_path["file_path"], "rb") as image_file:
+            data = base64.b64encode(image_file.read()).decode("utf8")
+        content.append(
+            {
+                "type": "image",
+                "source": {"type": "base64", "media_type": "image/jpeg", "data": data},
+            }
+        )
+    return json.dumps({**ENVELOPE, "messages": [{"role": "user", "content": content}]})
+
+
+def run_child(strategy: str, image_count: int) -> None:
+    """
+    Sends one request in this process and prints the peak RSS growth while building
+    and sending it. The peak is reset first (Linux only), so imports and client
+    setup are not counted.
+    """
+
+    import boto3
+
+    import pipeline
+    from conversation import build_request_body
+
+    file_paths = [
+        {
+            "file_path": str(MERCEDES_ADS[index % len(MERCEDES_ADS)]),
+            "file_type": "image/jpeg",
+        }
+        for index in range(image_count)
+    ]
+    client = boto3.client("bedrock-runtime", region_name=pipeline.DEFAULT_AWS_REGION)
+    # a first, small request opens the connection and loads the service model
+    client.invoke_model(body=json_body([]), modelId=pipeline.DEFAULT_MODEL_ID)[
+        "body"
+    ].read()
+
+    with open("/proc/self/clear_refs", "w", encoding="utf-8") as clear_refs:
+        clear_refs.write("5")  # resets VmHWM to the current RSS
+    baseline_kb = read_status_kb("VmRSS:")
+
+    if strategy == "json":
+        body = json_body(file_paths)
+    else:
+        messages = pipeline.compose_message("Analyze these ads.", file_paths)
+        body = build_request_body(ENVELOPE, messages)
+    response = client.invoke_model(body=body, modelId=pipeline.DEFAULT_MODEL_ID)
+    response["body"].read()
+
+    print(f"{RSS_MARKER}{read_status_kb('VmHWM:') - baseline_kb}")
+    print(f"BODY_BYTES={len(body)}")
+
+
+def measure(strategy: str, image_count: int, endpoint_url: str) -> Dict:
+    """Runs one request in a fresh interpreter and returns its peak RSS growth."""
+
+    env = dict(
+        os.environ,
+        AWS_ENDPOINT_URL_BEDROCK_RUNTIME=endpoint_url,
+        AWS_ACCESS_KEY_ID=os.environ.get("AWS_ACCESS_KEY_ID", "benchmark"),
+        AWS_SECRET_ACCESS_KEY=os.environ.get("AWS_SECRET_ACCESS_KEY", "benchmark"),
+        TRACE_SINK="none",
+        PREWARM_IMPORTS="false",
+    )
+    completed = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.request_memory",
+            "--child",
+            strategy,
+            "--images",
+            str(image_count),
+        ],
+        cwd=REPO_ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    values = dict(
+        line.split("=", 1) for line in completed.stdout.splitlines() if "=" in line
+    )
+    return {
+        "strategy": strategy,
+        "images": image_count,
+        "body_mb": round(int(values["BODY_BYTES"]) / 1024 / 1024, 1),
+        "peak_rss_delta_mb": round(int(values[RSS_MARKER[:-1]]) / 1024, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure the peak RSS of building and sending one request."
+    )
+    parser.add_argument("--images", type=int, default=DEFAULT_IMAGE_COUNT)
+    parser.add_argument("--results", type=Path, default=DEFAULT_RESULTS_PATH)
+    parser.add_argument("--no-record", action="store_true")
+    parser.add_argument("--child", choices=STRATEGIES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.images)
+        return
+
+    server, endpoint_url = start_fake_bedrock(
+        FakeBedrockConfig(first_token_latency_sec=0.0, output_tokens=10)
+    )
+    try:
+        results = [
+            measure(strategy, args.images, endpoint_url) for strategy in STRATEGIES
+        ]
+    finally:
+        server.shutdown()
+    for result in results:
+        print(
+            f"{result['strategy']:<8} {result['images']} images, "
+            f"{result['body_mb']} MB body, "
+            f"peak RSS +{result['peak_rss_delta_mb']} MB"
+        )
+
+    if not args.no_record:
+        args.results.parent.mkdir(parents=True, exist_ok=True)
+        record = {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "results": results,
+        }
+        with open(args.results, "a", encoding="utf-8") as results_file:
+            results_file.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
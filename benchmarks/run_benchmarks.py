@@ -0,0 +1,322 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Reproducible benchmarks for the hot paths of app.py, run against the repo's own
+# fixtures and a local fake Bedrock Runtime endpoint. No AWS credentials are needed.
+# Usage (from the repository root): python -m benchmarks.run_benchmarks
+
+import argparse
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from benchmarks.fake_bedrock import FakeBedrockConfig, start_fake_bedrock
+from benchmarks.import_time import profile_import
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+REPO_ROOT: Path = Path(__file__).resolve().parent.parent
+
+MERCEDES_ADS: List[Path] = sorted((REPO_ROOT / "mercedes_benz_ads").glob("ad*.jpeg"))
+MERCEDES_TEXT: Path = (
+    REPO_ROOT / "mercedes_benz_ads" / "mercedes_benz_design_ philosophy.txt"
+)
+AD_SPEC_PDFS: List[Path] = sorted((REPO_ROOT / "manhattan_ad_specs").glob("*.pdf"))
+CSV_FILE: Path = REPO_ROOT / "csv_data" / "Advertising_Budget_and_Sales.csv"
+GENERATED_IMAGES: List[Path] = sorted(
+    (REPO_ROOT / "paypal_creative_brief" / "generated_images").glob("*.png")
+)[:4]
+
+DEFAULT_RESULTS_PATH: Path = REPO_ROOT / "benchmarks" / "results" / "history.jsonl"
+DEFAULT_REPEAT: int = 5
+DEFAULT_REGRESSION_THRESHOLD: float = 0.20
+#################################################
+
+
+class FixtureUpload(io.BytesIO):
+    """
+    Mimics Streamlit's UploadedFile for a fixture on disk, so app.py functions
+    can be called exactly as they are from the upload form.
+    """
+
+    def __init__(self, path: Path, file_type: str) -> None:
+        super().__init__(path.read_bytes())
+        self.name = path.name
+        self.type = file_type
+        self.size = len(self.getbuffer())
+
+
+def time_it(func: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """
+    Runs `func` once to warm up, then `repeat` times.
+    Args:
+        func (Callable[[], object]): The function under test.
+        repeat (int): Number of timed runs.
+    Returns:
+        Dict[str, float]: min, median, p95, and max wall time in seconds.
+    """
+
+    func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        "min_sec": round(samples[0], 6),
+        "median_sec": round(statistics.median(samples), 6),
+        "p95_sec": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 6),
+        "max_sec": round(samples[-1], 6),
+        "repeat": repeat,
+    }
+
+
+def render_ad(generated_image: Path, output_path: Path) -> None:
+    """
+    Renders one 400x500 ad using the same layout steps as the PayPal sample ad
+    programs (headline, copy, CTA button, imagery, border), but with Pillow's
+    default font so the benchmark does not depend on locally installed fonts.
+    """
+
+    from PIL import Image, ImageDraw, ImageFont
+
+    font = ImageFont.load_default()
+    width, height = 400, 500
+    img = Image.new("RGB", (width, height), color="white")
+    draw = ImageDraw.Draw(img)
+
+    headline = "Your Money,\nYour Control"
+    headline_width, headline_height = draw.textbbox((0, 0), headline, font=font)[2:]
+    headline_y = 20
+    draw.text(
+        ((width - headline_width) / 2, headline_y),
+        headline,
+        font=font,
+        fill="#0C9C00",
+        align="center",
+    )
+
+    ad_copy = (
+        "Take charge of your finances with PayPal.\nNo complexities, just convenience."
+    )
+    copy_width, copy_height = draw.textbbox((0, 0), ad_copy, font=font)[2:]
+    copy_y = headline_y + headline_height + 20
+    draw.text(
+        ((width - copy_width) / 2, copy_y),
+        ad_copy,
+        font=font,
+        fill="#000000",
+        align="center",
+    )
+
+    cta = "Download the App"
+    cta_width, cta_height = draw.textbbox((0, 0), cta, font=font)[2:]
+    cta_x = (width - cta_width) / 2
+    cta_y = height - cta_height - 30
+    draw.rectangle(
+        (cta_x - 10, cta_y - 10, cta_x + cta_width + 10, cta_y + cta_height + 10),
+        fill="#0C9C00",
+        outline="#0C9C00",
+    )
+    draw.text((cta_x, cta_y), cta, font=font, fill="white")
+
+    image = Image.open(generated_image).resize((400, 240))
+    img.paste(image, (0, int(copy_y + copy_height + 20)))
+    draw.rectangle([0, 0, width - 1, height - 1], outline="#999999", width=1)
+    img.save(output_path, format="PNG")
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return (
+            subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=REPO_ROOT,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+            or None
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(repeat: int, config: FakeBedrockConfig) -> Dict[str, Dict[str, float]]:
+    """
+    Runs every benchmark and returns the timings keyed by benchmark name.
+    """
+
+    # scratch storage resolves relative paths against the working directory
+    os.chdir(REPO_ROOT)
+
+    server, endpoint_url = start_fake_bedrock(config)
+    os.environ["AWS_ENDPOINT_URL_BEDROCK_RUNTIME"] = endpoint_url
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("TRACE_SINK", "none")
+
+    import streamlit as st
+
+    import app
+    import pipeline
+
+    st.session_state.aws_region = app.DEFAULT_AWS_REGION
+    results: Dict[str, Dict[str, float]] = {}
+    scratch_store = app.get_scratch_store()
+    scratch_dir = scratch_store.namespace("benchmark")
+
+    image_paths = [
+        {"file_path": str(path), "file_type": "image/jpeg"} for path in MERCEDES_ADS
+    ]
+    results["compose_message.mercedes_ads"] = time_it(
+        lambda: pipeline.compose_message(app.DEFAULT_USER_PROMPT, image_paths), repeat
+    )
+
+    for pdf in AD_SPEC_PDFS:
+        upload = FixtureUpload(pdf, "application/pdf")
+        results[f"is_pdf_image_based.{pdf.stem}"] = time_it(
+            lambda upload=upload: pipeline.is_pdf_image_based(upload), repeat
+        )
+        results[f"convert_pdf_to_images.{pdf.stem}"] = time_it(
+            lambda upload=upload: pipeline.convert_pdf_to_images(upload, scratch_dir),
+            repeat,
+        )
+        results[f"extract_text_from_pdf_pymupdf.{pdf.stem}"] = time_it(
+            lambda upload=upload: pipeline.extract_text_from_pdf_pymupdf(upload), repeat
+        )
+
+    uploads = [FixtureUpload(path, "image/jpeg") for path in MERCEDES_ADS]
+
+    def save_images() -> None:
+        file_paths: List[dict] = []
+        for upload in uploads:
+            upload.seek(0)
+            pipeline.save_image(upload, file_paths, scratch_dir)
+
+    results["save_image.mercedes_ads"] = time_it(save_images, repeat)
+
+    for text_file, file_type in [(MERCEDES_TEXT, "text/plain"), (CSV_FILE, "text/csv")]:
+        upload = FixtureUpload(text_file, file_type)
+        results[f"extract_text_from_text.{text_file.suffix[1:]}"] = time_it(
+            lambda upload=upload: pipeline.extract_text_from_text(upload), repeat
+        )
+
+    results["render_ad.paypal"] = time_it(
+        lambda: [
+            render_ad(image, scratch_dir / f"benchmark_ad_{idx}.png")
+            for idx, image in enumerate(GENERATED_IMAGES)
+        ],
+        repeat,
+    )
+
+    messages = pipeline.compose_message(app.DEFAULT_USER_PROMPT, image_paths)
+    results["invoke_model.fake_bedrock"] = time_it(
+        lambda: app.invoke_model(
+            app.DEFAULT_MODEL_ID,
+            app.DEFAULT_SYSTEM_PROMPT,
+            messages,
+            app.DEFAULT_MAX_TOKENS,
+            app.DEFAULT_TEMPERATURE,
+            app.DEFAULT_TOP_P,
+            app.DEFAULT_TOP_K,
+        ),
+        repeat,
+    )
+
+    server.shutdown()
+    scratch_store.release(scratch_dir)
+    return results
+
+
+def load_previous(results_path: Path) -> Optional[dict]:
+    if not results_path.exists():
+        return None
+    lines = results_path.read_text(encoding="utf-8").strip().splitlines()
+    return json.loads(lines[-1]) if lines else None
+
+
+def find_regressions(
+    previous: Optional[dict], current: Dict[str, Dict[str, float]], threshold: float
+) -> List[str]:
+    """
+    Compares median timings against the previous recorded run.
+    Returns:
+        List[str]: A description of each benchmark whose median slowed by more than `threshold`.
+    """
+
+    if not previous:
+        return []
+    regressions = []
+    for name, timings in current.items():
+        before = previous["results"].get(name)
+        if not before or not before["median_sec"]:
+            continue
+        change = timings["median_sec"] / before["median_sec"] - 1
+        if change > threshold:
+            regressions.append(
+                f"{name}: {before['median_sec']}s -> {timings['median_sec']}s (+{change:.0%})"
+            )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of app.py.")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--results", type=Path, default=DEFAULT_RESULTS_PATH)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD)
+    parser.add_argument("--first-token-latency", type=float, default=0.05)
+    parser.add_argument("--tokens-per-sec", type=float, default=2000.0)
+    parser.add_argument(
+        "--no-record", action="store_true", help="do not append results to history"
+    )
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    config = FakeBedrockConfig(
+        first_token_latency_sec=args.first_token_latency,
+        tokens_per_sec=args.tokens_per_sec,
+    )
+    results = run_suite(args.repeat, config)
+
+    record = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+        "import_time": profile_import(),
+    }
+    regressions = find_regressions(load_previous(args.results), results, args.threshold)
+
+    for name, timings in results.items():
+        print(
+            f"{name:<60} median {timings['median_sec']:.4f}s  p95 {timings['p95_sec']:.4f}s"
+        )
+    if not args.no_record:
+        args.results.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.results, "a", encoding="utf-8") as results_file:
+            results_file.write(json.dumps(record) + "\n")
+    print(
+        f"{'import app':<60} {record['import_time']['total_ms']} ms, "
+        f"peak RSS {record['import_time']['max_rss_mb']} MB"
+    )
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
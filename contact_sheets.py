@@ -0,0 +1,195 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Packs many small images into labeled contact sheets, so large batches of ads fit in
+# one request under the per-request image limit and cost fewer image tokens.
+
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from lazy_imports import lazy_import
+
+Image = lazy_import("PIL.Image")
+ImageDraw = lazy_import("PIL.ImageDraw")
+ImageFont = lazy_import("PIL.ImageFont")
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+# Claude downscales images larger than about 1.15 megapixels; a 1092 x 1092 sheet is
+# the largest square under that, so sheet labels stay legible
+SHEET_DIMENSION: int = 1092
+
+# images taller than this, or wider than a sheet, are sent on their own, not packed
+MAX_PACKED_HEIGHT: int = SHEET_DIMENSION // 2
+
+# Bedrock accepts at most this many images per request
+MAX_IMAGES_PER_REQUEST: int = 20
+
+# packing is only worthwhile for at least this many small images
+MIN_PACKED_IMAGES: int = 4
+
+PADDING: int = 8
+LABEL_HEIGHT: int = 22
+LABEL_FONT_SIZE: int = 16
+SHEET_JPEG_QUALITY: int = 90
+#################################################
+
+
+class Cell:
+    """One image's place on a contact sheet, including its label strip and padding."""
+
+    def __init__(self, index: int, width: int, height: int) -> None:
+        self.index = index
+        self.width = width + PADDING
+        self.height = height + LABEL_HEIGHT + PADDING
+        self.sheet = 0
+        self.x = 0
+        self.y = 0
+
+
+def pack_cells(cells: List[Cell], size: int = SHEET_DIMENSION) -> int:
+    """
+    Places cells onto as few square sheets as possible, using first-fit decreasing
+    height shelf packing: cells are sorted tallest first, and each is placed on the
+    first shelf of any sheet with room, else on a new shelf, else on a new sheet.
+    Args:
+        cells (List[Cell]): The cells to place; their sheet, x, and y are set.
+        size (int): The width and height of a sheet.
+    Returns:
+        int: The number of sheets used.
+    """
+
+    # per sheet, a list of shelves as [y, height, used width]
+    sheets: List[List[List[int]]] = []
+    for cell in sorted(cells, key=lambda cell: (-cell.height, -cell.width)):
+        placed = False
+        for sheet_index, shelves in enumerate(sheets):
+            for shelf in shelves:
+                if cell.height <= shelf[1] and shelf[2] + cell.width <= size:
+                    cell.sheet, cell.x, cell.y = sheet_index, shelf[2], shelf[0]
+                    shelf[2] += cell.width
+                    placed = True
+                    break
+            if placed:
+                break
+            top = shelves[-1][0] + shelves[-1][1]
+            if top + cell.height <= size:
+                shelves.append([top, cell.height, cell.width])
+                cell.sheet, cell.x, cell.y = sheet_index, 0, top
+                placed = True
+                break
+        if not placed:
+            sheets.append([[0, cell.height, cell.width]])
+            cell.sheet, cell.x, cell.y = len(sheets) - 1, 0, 0
+    return len(sheets)
+
+
+def fit_label(draw, text: str, font, max_width: int) -> str:
+    """Shortens a label with an ellipsis until it fits in `max_width` pixels."""
+
+    if draw.textlength(text, font=font) <= max_width:
+        return text
+    while len(text) > 1 and draw.textlength(f"{text}…", font=font) > max_width:
+        text = text[:-1]
+    return f"{text}…"
+
+
+def upload_name(file_path: dict) -> str:
+    """Returns the name an image was uploaded as, or its scratch file name."""
+
+    return file_path.get("file_name") or os.path.basename(file_path["file_path"])
+
+
+def build_contact_sheets(
+    file_paths: List[dict], output_dir: Path
+) -> Tuple[List[dict], Dict[str, str]]:
+    """
+    Packs the small images among `file_paths` into labeled contact sheets. Each image
+    is labeled with a number, in upload order, and the name it was uploaded as.
+    Larger images are passed through unchanged, as is everything if there are too
+    few small images.
+    Args:
+        file_paths (List[dict]): Images to send, each with "file_path", "file_type",
+            and optionally "file_name", the uploaded file name (and page or frame);
+            the scratch file name is used if it is missing.
+        output_dir (Path): The directory to write the contact sheets to.
+    Returns:
+        Tuple[List[dict], Dict[str, str]]:
+            - The images to send instead: the contact sheets, then any unpacked images.
+            - Each label mapped to the original file name.
+    """
+
+    small: List[Tuple[int, dict]] = []
+    passthrough: List[dict] = []
+    sizes: Dict[int, Tuple[int, int]] = {}
+    for file_path in file_paths:
+        with Image.open(file_path["file_path"]) as image:
+            width, height = image.size
+            if width + PADDING <= SHEET_DIMENSION and height <= MAX_PACKED_HEIGHT:
+                sizes[len(small)] = image.size
+                small.append((len(small), file_path))
+            else:
+                passthrough.append(file_path)
+    if len(small) < MIN_PACKED_IMAGES:
+        return file_paths, {}
+
+    cells = [Cell(index, *sizes[index]) for index, _ in small]
+    sheet_count = pack_cells(cells)
+
+    font = ImageFont.load_default(size=LABEL_FONT_SIZE)
+    sheets = [
+        Image.new("RGB", (SHEET_DIMENSION, SHEET_DIMENSION), "white")
+        for _ in range(sheet_count)
+    ]
+    used = [(0, 0)] * sheet_count
+    for cell in cells:
+        file_path = small[cell.index][1]
+        label = str(cell.index + 1)
+        file_name = upload_name(file_path)
+        draw = ImageDraw.Draw(sheets[cell.sheet])
+        draw.rectangle(
+            [cell.x, cell.y, cell.x + cell.width - PADDING, cell.y + LABEL_HEIGHT - 2],
+            fill="black",
+        )
+        draw.text(
+            (cell.x + 4, cell.y + 2),
+            fit_label(draw, f"{label}: {file_name}", font, cell.width - PADDING - 8),
+            fill="white",
+            font=font,
+        )
+        with Image.open(file_path["file_path"]) as image:
+            image = image.convert("RGBA")
+            # transparent areas show the white sheet
+            sheets[cell.sheet].paste(image, (cell.x, cell.y + LABEL_HEIGHT), image)
+        width, height = used[cell.sheet]
+        used[cell.sheet] = (
+            max(width, cell.x + cell.width),
+            max(height, cell.y + cell.height),
+        )
+
+    legend = {str(index + 1): upload_name(file_path) for index, file_path in small}
+    packed: List[dict] = []
+    for index, sheet in enumerate(sheets):
+        sheet_path = output_dir / f"contact_sheet_{index + 1}.jpeg"
+        # trim the unused margin of partly filled sheets
+        sheet.crop((0, 0, *used[index])).save(sheet_path, quality=SHEET_JPEG_QUALITY)
+        packed.append({"file_path": str(sheet_path), "file_type": "image/jpeg"})
+    logger.info(
+        "Packed %d images into %d contact sheets, %d images sent unpacked",
+        len(small),
+        sheet_count,
+        len(passthrough),
+    )
+    return packed + passthrough, legend
+
+
+def legend_text(legend: Dict[str, str]) -> str:
+    """Describes the contact sheet labels for the prompt."""
+
+    lines = "\n".join(f"- {label}: {file_name}" for label, file_name in legend.items())
+    return (
+        "Some images are contact sheets of several ads. Each ad is labeled with a "
+        "number and file name above it. Refer to the ads by file name:\n" + lines
+    )
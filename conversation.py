@@ -0,0 +1,168 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Multi-turn conversation helpers: token budgeting of the message history and
+# serializing each message once, so follow-ups do not re-encode earlier attachments.
+
+import json
+import logging
+from typing import Dict, List, Tuple
+
+from request_body import Segments, dumps_segments, write_body
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+# Claude 3 models have a 200K token context window; leave room for the response
+DEFAULT_CONVERSATION_TOKEN_BUDGET: int = 150_000
+
+# approximate cost of one image resized to the ~1.15 megapixel maximum
+IMAGE_TOKENS_ESTIMATE: int = 1600
+
+# older assistant answers are cut to this many characters when trimming is not enough
+SUMMARY_EXCERPT_CHARS: int = 1000
+#################################################
+
+
+def estimate_message_tokens(message: dict) -> int:
+    """
+    Estimates the input tokens of one Messages API message.
+    Args:
+        message (dict): A message with a "content" string or list of content blocks.
+    Returns:
+        int: Roughly 4 characters per text token plus a flat cost per image.
+    """
+
+    content = message["content"]
+    if isinstance(content, str):
+        return len(content) // 4
+    tokens = 0
+    for block in content:
+        if block["type"] == "text":
+            tokens += len(block["text"]) // 4
+        elif block["type"] == "image":
+            tokens += IMAGE_TOKENS_ESTIMATE
+    return tokens
+
+
+def summarize_message(message: dict) -> dict:
+    """
+    Returns a copy of an assistant message with its text cut to a short excerpt.
+    """
+
+    text = "".join(
+        block["text"] for block in message["content"] if block["type"] == "text"
+    )
+    if len(text) <= SUMMARY_EXCERPT_CHARS:
+        return message
+    excerpt = text[:SUMMARY_EXCERPT_CHARS].rsplit(" ", 1)[0]
+    return {
+        "role": message["role"],
+        "content": [{"type": "text", "text": f"{excerpt} [...]"}],
+    }
+
+
+def trim_conversation(
+    messages: List[dict], token_budget: int = DEFAULT_CONVERSATION_TOKEN_BUDGET
+) -> List[dict]:
+    """
+    Fits a conversation into a token budget. The first exchange, which carries the
+    attachments, and the newest turns are kept; the oldest follow-up exchanges in
+    between are dropped first, then the retained older answers are cut to excerpts.
+    Messages are kept as the same objects where possible, so serialized JSON can be
+    reused across turns.
+    Args:
+        messages (List[dict]): Alternating user and assistant messages, ending with a
+            user message.
+        token_budget (int): The maximum estimated input tokens.
+    Returns:
+        List[dict]: The trimmed conversation, still alternating and ending with a user message.
+    """
+
+    tokens = [estimate_message_tokens(message) for message in messages]
+    if sum(tokens) <= token_budget or len(messages) <= 3:
+        return messages
+
+    # messages[0:2] is the first exchange; follow-up exchanges are user/assistant pairs
+    head, middle, last = messages[:2], messages[2:-1], messages[-1]
+    head_tokens, last_tokens = sum(tokens[:2]), tokens[-1]
+    pairs: List[Tuple[dict, dict]] = list(zip(middle[0::2], middle[1::2]))
+    pair_tokens = [
+        estimate_message_tokens(user) + estimate_message_tokens(assistant)
+        for user, assistant in pairs
+    ]
+
+    kept: List[Tuple[dict, dict]] = []
+    used = head_tokens + last_tokens
+    for pair, cost in zip(reversed(pairs), reversed(pair_tokens)):
+        if used + cost > token_budget:
+            break
+        kept.insert(0, pair)
+        used += cost
+    dropped = len(pairs) - len(kept)
+
+    trimmed = head + [message for pair in kept for message in pair] + [last]
+    if used > token_budget:
+        trimmed = [
+            summarize_message(message) if message["role"] == "assistant" else message
+            for message in trimmed
+        ]
+    logger.info(
+        "Trimmed conversation: dropped %d earlier exchanges (~%d tokens kept)",
+        dropped,
+        sum(estimate_message_tokens(message) for message in trimmed),
+    )
+    return trimmed
+
+
+class MessageJsonCache:
+    """
+    Caches the JSON serialization of each message object in a conversation, so a
+    follow-up request re-serializes only its new messages. Image data is not held
+    in the cache; it is encoded into each request body as it is written (see
+    request_body.py). Messages must not be mutated after they are first sent.
+    """
+
+    def __init__(self) -> None:
+        self._entries: Dict[int, Tuple[dict, Segments]] = {}
+
+    def dumps(self, message: dict) -> Segments:
+        entry = self._entries.get(id(message))
+        if entry is None or entry[0] is not message:
+            # keep a reference to the message so its id cannot be reused
+            entry = (message, dumps_segments(message))
+            self._entries[id(message)] = entry
+        return entry[1]
+
+    def retain(self, messages: List[dict]) -> None:
+        """Forgets cached messages that are no longer part of the conversation."""
+
+        keep = {id(message) for message in messages}
+        self._entries = {
+            key: entry for key, entry in self._entries.items() if key in keep
+        }
+
+
+def build_request_body(
+    envelope: dict, messages: List[dict], cache: MessageJsonCache = None
+) -> bytearray:
+    """
+    Serializes a Messages API request, reusing cached JSON for previously sent messages.
+    Args:
+        envelope (dict): Every request field except "messages".
+        messages (List[dict]): The messages to send.
+        cache (MessageJsonCache): Cache of serialized messages; if None, every message
+            is serialized.
+    Returns:
+        bytearray: The JSON request body, with image data encoded in place.
+    """
+
+    if cache is None:
+        return write_body(dumps_segments({**envelope, "messages": messages}))
+    cache.retain(messages)
+    segments: Segments = [json.dumps(envelope)[:-1].encode("utf-8"), b', "messages": [']
+    for index, message in enumerate(messages):
+        if index:
+            segments.append(b", ")
+        segments.extend(cache.dumps(message))
+    segments.append(b"]}")
+    return write_body(segments)
@@ -0,0 +1,261 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Keyframe sampling of animated GIFs, so the model sees an animation's sequence of
+# frames at a bounded image cost, as separate keyframes or packed into one filmstrip.
+
+import logging
+import math
+import os
+from pathlib import Path
+from typing import List, Tuple
+
+from lazy_imports import lazy_import
+from request_body import MAX_IMAGE_BYTES
+
+Image = lazy_import("PIL.Image")
+ImageChops = lazy_import("PIL.ImageChops")
+ImageDraw = lazy_import("PIL.ImageDraw")
+ImageFont = lazy_import("PIL.ImageFont")
+ImageStat = lazy_import("PIL.ImageStat")
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+# how animated GIFs are sent: the first frame only, sampled keyframes as separate
+# images, or sampled keyframes packed into one filmstrip image
+GIF_FIRST_FRAME: str = "first frame"
+GIF_KEYFRAMES: str = "keyframes"
+GIF_FILMSTRIP: str = "filmstrip"
+GIF_MODES: List[str] = [GIF_FIRST_FRAME, GIF_KEYFRAMES, GIF_FILMSTRIP]
+GIF_MODE_DEFAULT: str = os.environ.get("GIF_MODE_DEFAULT", GIF_FIRST_FRAME)
+
+# keyframes sampled from an animation, including its first and last distinct frames
+GIF_KEYFRAME_COUNT: int = int(os.environ.get("GIF_KEYFRAME_COUNT", 4))
+
+# frames whose mean pixel difference (0-255) from the last kept frame is below this
+# are dropped as near-duplicates
+FRAME_DIFF_THRESHOLD: float = float(os.environ.get("FRAME_DIFF_THRESHOLD", 6))
+
+# frames are compared as grayscale thumbnails of this size
+DIFF_THUMBNAIL_SIZE: Tuple[int, int] = (64, 64)
+
+# filmstrips are scaled down to at most this many pixels, as Claude downscales
+# larger images (see SHEET_DIMENSION in contact_sheets.py)
+FILMSTRIP_MAX_PIXELS: int = 1092 * 1092
+FILMSTRIP_PADDING: int = 4
+LABEL_FONT_SIZE: int = 14
+
+# frames whose PNG exceeds MAX_IMAGE_BYTES are re-encoded as JPEG at this quality
+FRAME_JPEG_QUALITY: int = 85
+
+# GIF frames without a duration are shown for this long by most browsers
+DEFAULT_FRAME_MS: int = 100
+#################################################
+
+
+class Keyframe:
+    """A distinct frame of an animation and when it is first shown."""
+
+    def __init__(self, index: int, start_ms: int) -> None:
+        self.index = index
+        self.start_ms = start_ms
+
+    @property
+    def label(self) -> str:
+        return f"{self.start_ms / 1000:.1f}s"
+
+
+def is_animated(image_file) -> bool:
+    """True if the image file has more than one frame."""
+
+    with Image.open(image_file) as image:
+        animated = getattr(image, "n_frames", 1) > 1
+    image_file.seek(0)
+    return animated
+
+
+def distinct_frames(image) -> Tuple[List[Keyframe], int, int]:
+    """
+    Decodes an animation one frame at a time and keeps the frames that differ
+    visibly from the last kept frame. Only small grayscale thumbnails are held in
+    memory, not the decoded frames.
+    Args:
+        image (Image.Image): The opened animated image.
+    Returns:
+        Tuple[List[Keyframe], int, int]:
+            - The distinct frames, in order.
+            - The total number of frames.
+            - The total duration of the animation in milliseconds.
+    """
+
+    frames: List[Keyframe] = []
+    last_thumbnail = None
+    elapsed_ms = 0
+    for index in range(image.n_frames):
+        image.seek(index)
+        thumbnail = image.convert("L").resize(DIFF_THUMBNAIL_SIZE)
+        if last_thumbnail is None or (
+            ImageStat.Stat(ImageChops.difference(thumbnail, last_thumbnail)).mean[0]
+            >= FRAME_DIFF_THRESHOLD
+        ):
+            frames.append(Keyframe(index, elapsed_ms))
+            last_thumbnail = thumbnail
+        elapsed_ms += image.info.get("duration") or DEFAULT_FRAME_MS
+    return frames, image.n_frames, elapsed_ms
+
+
+def sample_keyframes(frames: List[Keyframe], count: int) -> List[Keyframe]:
+    """Picks `count` frames evenly spaced through the sequence, first and last too."""
+
+    if len(frames) <= count:
+        return frames
+    if count == 1:
+        return frames[:1]
+    return [frames[round(i * (len(frames) - 1) / (count - 1))] for i in range(count)]
+
+
+def filmstrip_layout(count: int, width: int, height: int) -> Tuple[int, int]:
+    """Returns the columns and rows that make a grid of frames closest to square."""
+
+    def squareness(columns: int) -> float:
+        rows = math.ceil(count / columns)
+        return abs(math.log((columns * width) / (rows * height)))
+
+    columns = min(range(1, count + 1), key=squareness)
+    return columns, math.ceil(count / columns)
+
+
+def build_filmstrip(image, keyframes: List[Keyframe]):
+    """
+    Packs keyframes into one image, in reading order, each labeled with the time it
+    is first shown, scaled down to at most FILMSTRIP_MAX_PIXELS.
+    """
+
+    width, height = image.size
+    columns, rows = filmstrip_layout(len(keyframes), width, height)
+    strip_width = columns * (width + FILMSTRIP_PADDING) - FILMSTRIP_PADDING
+    strip_height = rows * (height + FILMSTRIP_PADDING) - FILMSTRIP_PADDING
+    filmstrip = Image.new("RGB", (strip_width, strip_height), "white")
+    draw = ImageDraw.Draw(filmstrip)
+    font = ImageFont.load_default(size=LABEL_FONT_SIZE)
+    for number, keyframe in enumerate(keyframes):
+        x = (number % columns) * (width + FILMSTRIP_PADDING)
+        y = (number // columns) * (height + FILMSTRIP_PADDING)
+        image.seek(keyframe.index)
+        filmstrip.paste(image.convert("RGB"), (x, y))
+        label = f"{number + 1}: {keyframe.label}"
+        left, top, right, bottom = draw.textbbox((x + 3, y + 2), label, font=font)
+        draw.rectangle([left - 2, top - 2, right + 2, bottom + 2], fill="black")
+        draw.text((x + 3, y + 2), label, fill="white", font=font)
+    scale = math.sqrt(FILMSTRIP_MAX_PIXELS / (strip_width * strip_height))
+    if scale < 1:
+        filmstrip = filmstrip.resize(
+            (int(strip_width * scale), int(strip_height * scale)), Image.LANCZOS
+        )
+    return filmstrip
+
+
+def save_frame(frame, image_path: Path) -> Tuple[Path, str]:
+    """
+    Saves a frame as PNG, or as JPEG if the PNG is too large to send to Bedrock.
+    Args:
+        frame: The RGB image to save.
+        image_path (Path): The PNG path; the JPEG takes the same name with a .jpg suffix.
+    Returns:
+        Tuple[Path, str]: The path and MIME type of the saved image.
+    Raises:
+        ValueError: If the image exceeds MAX_IMAGE_BYTES even as JPEG.
+    """
+
+    frame.save(image_path)
+    if image_path.stat().st_size <= MAX_IMAGE_BYTES:
+        return image_path, "image/png"
+    image_path.unlink()
+    jpeg_path = image_path.with_suffix(".jpg")
+    frame.save(jpeg_path, "JPEG", quality=FRAME_JPEG_QUALITY)
+    if jpeg_path.stat().st_size <= MAX_IMAGE_BYTES:
+        return jpeg_path, "image/jpeg"
+    jpeg_path.unlink()
+    raise ValueError(f"{image_path.name} exceeds the 5MB image limit")
+
+
+def save_keyframes(
+    image_file, file_name: str, output_dir: Path, mode: str = GIF_KEYFRAMES
+) -> Tuple[List[dict], str]:
+    """
+    Samples the keyframes of an animated GIF and saves them as PNG images, or JPEG
+    images where a PNG would exceed MAX_IMAGE_BYTES.
+    Args:
+        image_file: The GIF file or file-like object.
+        file_name (str): The uploaded file name, used to name and describe the frames.
+        output_dir (Path): The directory to write the images to.
+        mode (str): GIF_KEYFRAMES to save one image per keyframe, or GIF_FILMSTRIP to
+            pack them into one image.
+    Returns:
+        Tuple[List[dict], str]:
+            - File path, type, and name, e.g. "banner.gif, frame 2 at 0.4s", of each
+              image to send.
+            - A description of the frames for the prompt.
+    Raises:
+        ValueError: If a keyframe or the filmstrip exceeds MAX_IMAGE_BYTES even as JPEG;
+            frames already saved are deleted.
+    """
+
+    stem = Path(file_name).stem
+    saved: List[Tuple[Path, str]] = []
+    with Image.open(image_file) as image:
+        frames, frame_count, duration_ms = distinct_frames(image)
+        keyframes = sample_keyframes(frames, GIF_KEYFRAME_COUNT)
+        try:
+            if mode == GIF_FILMSTRIP:
+                saved.append(
+                    save_frame(
+                        build_filmstrip(image, keyframes),
+                        output_dir / f"{stem}_filmstrip.png",
+                    )
+                )
+            else:
+                for number, keyframe in enumerate(keyframes):
+                    image.seek(keyframe.index)
+                    saved.append(
+                        save_frame(
+                            image.convert("RGB"),
+                            output_dir / f"{stem}_frame_{number + 1}.png",
+                        )
+                    )
+        except ValueError:
+            for image_path, _ in saved:
+                image_path.unlink()
+            raise
+
+    logger.info(
+        "Sampled %d keyframes from %d distinct of %d frames in %s",
+        len(keyframes),
+        len(frames),
+        frame_count,
+        file_name,
+    )
+    times = ", ".join(
+        f"{number + 1}: {keyframe.label}" for number, keyframe in enumerate(keyframes)
+    )
+    shown_as = (
+        "one labeled filmstrip image, in reading order"
+        if mode == GIF_FILMSTRIP
+        else "separate images, in order"
+    )
+    description = (
+        f"[{file_name}] is an animated GIF of {frame_count} frames lasting "
+        f"{duration_ms / 1000:.1f}s. {len(keyframes)} keyframes are shown as "
+        f"{shown_as}, first shown at: {times}."
+    )
+    if mode == GIF_FILMSTRIP:
+        image_names = [f"{file_name}, filmstrip"]
+    else:
+        image_names = [
+            f"{file_name}, frame {number + 1} at {keyframe.label}"
+            for number, keyframe in enumerate(keyframes)
+        ]
+    return [
+        {"file_path": str(image_path), "file_type": file_type, "file_name": name}
+        for (image_path, file_type), name in zip(saved, image_names)
+    ], description
@@ -0,0 +1,98 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Deferred loading of heavy dependencies (boto3, PyMuPDF, Pillow, Docling) to keep cold starts fast.
+
+import importlib
+import logging
+import os
+import threading
+import time
+from types import ModuleType
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+# set PREWARM_IMPORTS=false to load heavy dependencies strictly on first use
+PREWARM_IMPORTS: bool = os.environ.get("PREWARM_IMPORTS", "true").lower() == "true"
+#################################################
+
+
+class LazyModule(ModuleType):
+    """
+    A stand-in for a module that is imported the first time one of its attributes
+    is accessed, e.g. `pymupdf.open(...)`. Loading is thread-safe, so a background
+    prewarm and a first use on the script thread never import twice.
+    """
+
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self._lock = threading.Lock()
+        self._module: Optional[ModuleType] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def load(self) -> ModuleType:
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    start_time = time.perf_counter()
+                    self._module = importlib.import_module(self.__name__)
+                    logger.info(
+                        "Imported %s in %.3fs",
+                        self.__name__,
+                        time.perf_counter() - start_time,
+                    )
+        return self._module
+
+    def __getattr__(self, attr: str):
+        if attr.startswith("__") and attr.endswith("__"):
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.loaded else "not loaded"
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+_registry: Dict[str, LazyModule] = {}
+_registry_lock = threading.Lock()
+
+
+def lazy_import(name: str) -> LazyModule:
+    """
+    Returns a lazily loaded module proxy, shared by every caller asking for `name`.
+    Args:
+        name (str): The dotted module name, e.g. "PIL.Image".
+    Returns:
+        LazyModule: A proxy that imports the module on first attribute access.
+    """
+
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = LazyModule(name)
+        return _registry[name]
+
+
+def prewarm(*modules: LazyModule) -> threading.Thread:
+    """
+    Loads the given lazy modules on a background daemon thread, so the first request
+    usually finds them imported without having delayed startup.
+    Args:
+        *modules (LazyModule): The modules to load, in order.
+    Returns:
+        threading.Thread: The started prewarm thread.
+    """
+
+    def load_all() -> None:
+        for module in modules:
+            try:
+                module.load()
+            except ImportError as err:
+                logger.warning("Prewarm of %s failed: %s", module.__name__, err)
+
+    thread = threading.Thread(target=load_all, name="prewarm-imports", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,214 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Append-only local store of Bedrock invocation metrics, shared by the Streamlit app
+# and the API server, for latency, throughput, and error-rate reporting.
+
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+METRICS_DB: str = os.environ.get("METRICS_DB", "_metrics/invocations.db")
+
+# records are written by a background thread in batches of up to this many
+WRITE_BATCH_SIZE: int = 500
+
+# records waiting to be written before new ones are dropped, so a stuck disk
+# never blocks an analysis
+MAX_PENDING_RECORDS: int = 100_000
+
+OUTCOME_OK: str = "ok"
+
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS invocations (
+    id INTEGER PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    source TEXT NOT NULL,
+    model_id TEXT NOT NULL,
+    region TEXT NOT NULL,
+    payload_bytes INTEGER,
+    image_count INTEGER,
+    document_count INTEGER,
+    latency_sec REAL,
+    total_sec REAL,
+    input_tokens INTEGER,
+    output_tokens INTEGER,
+    retries INTEGER,
+    outcome TEXT NOT NULL,
+    stage_timings TEXT
+);
+CREATE INDEX IF NOT EXISTS invocations_timestamp ON invocations (timestamp);
+"""
+
+COLUMNS: List[str] = [
+    "timestamp",
+    "source",
+    "model_id",
+    "region",
+    "payload_bytes",
+    "image_count",
+    "document_count",
+    "latency_sec",
+    "total_sec",
+    "input_tokens",
+    "output_tokens",
+    "retries",
+    "outcome",
+    "stage_timings",
+]
+#################################################
+
+
+def connect(path: str = METRICS_DB) -> sqlite3.Connection:
+    """
+    Opens the metrics database, creating it and its schema if needed.
+    """
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30)
+    # readers (the dashboard) do not block the writers of other processes
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class MetricsStore:
+    """
+    Records one row per model invocation. record() only enqueues; a daemon thread
+    owns the SQLite connection and inserts in batches, one transaction per batch.
+    Args:
+        path (str): The SQLite database file.
+    """
+
+    def __init__(self, path: str = METRICS_DB) -> None:
+        self.path = path
+        self._queue: queue.Queue = queue.Queue(maxsize=MAX_PENDING_RECORDS)
+        self._thread = threading.Thread(
+            target=self._write_loop, name="metrics-writer", daemon=True
+        )
+        self._thread.start()
+
+    def record(
+        self,
+        source: str,
+        model_id: str,
+        region: str,
+        outcome: str,
+        payload_bytes: Optional[int] = None,
+        image_count: int = 0,
+        document_count: int = 0,
+        latency_sec: Optional[float] = None,
+        total_sec: Optional[float] = None,
+        input_tokens: Optional[int] = None,
+        output_tokens: Optional[int] = None,
+        retries: int = 0,
+        stage_timings: Optional[Dict[str, float]] = None,
+    ) -> None:
+        """
+        Queues one invocation for writing.
+        Args:
+            source (str): "app" or "api".
+            model_id (str): The model invoked.
+            region (str): The AWS region invoked.
+            outcome (str): "ok", or the error code of a failed invocation.
+            payload_bytes (Optional[int]): Size of the request body.
+            image_count (int): Image blocks in the request.
+            document_count (int): PDF, CSV, and text attachments in the request.
+            latency_sec (Optional[float]): Time spent in the model call, including retries.
+            total_sec (Optional[float]): End-to-end analysis time.
+            input_tokens (Optional[int]): Input tokens reported by the model.
+            output_tokens (Optional[int]): Output tokens reported by the model.
+            retries (int): Throttled or failed attempts retried before the outcome.
+            stage_timings (Optional[Dict[str, float]]): Seconds per pipeline stage.
+        """
+
+        row = (
+            time.time(),
+            source,
+            model_id,
+            region,
+            payload_bytes,
+            image_count,
+            document_count,
+            latency_sec,
+            total_sec,
+            input_tokens,
+            output_tokens,
+            retries,
+            outcome,
+            json.dumps(stage_timings or {}),
+        )
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            logger.warning("Metrics queue full, dropping invocation record")
+
+    def _write_loop(self) -> None:
+        connection = connect(self.path)
+        insert = (
+            f"INSERT INTO invocations ({', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(COLUMNS))})"
+        )
+        while True:
+            rows = [self._queue.get()]
+            while len(rows) < WRITE_BATCH_SIZE:
+                try:
+                    rows.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            batch = [row for row in rows if row is not None]
+            try:
+                with connection:
+                    connection.executemany(insert, batch)
+            except sqlite3.Error as err:
+                logger.error("Failed to write %d metrics records: %s", len(batch), err)
+            for _ in rows:
+                self._queue.task_done()
+            if len(batch) < len(rows):
+                connection.close()
+                return
+
+    def flush(self) -> None:
+        """Blocks until every queued record is written."""
+
+        self._queue.join()
+
+    def close(self) -> None:
+        """Writes the remaining records and stops the writer thread."""
+
+        self._queue.put(None)
+        self._thread.join()
+
+
+def load_invocations(since: float, path: str = METRICS_DB) -> List[dict]:
+    """
+    Reads the invocations recorded since a point in time, oldest first.
+    Args:
+        since (float): A Unix timestamp.
+        path (str): The SQLite database file.
+    Returns:
+        List[dict]: One dictionary per invocation, with stage_timings decoded.
+    """
+
+    if not os.path.exists(path):
+        return []
+    connection = connect(path)
+    connection.row_factory = sqlite3.Row
+    try:
+        rows = connection.execute(
+            "SELECT * FROM invocations WHERE timestamp >= ? ORDER BY timestamp",
+            (since,),
+        ).fetchall()
+    finally:
+        connection.close()
+    invocations = [dict(row) for row in rows]
+    for invocation in invocations:
+        invocation["stage_timings"] = json.loads(invocation["stage_timings"] or "{}")
+    return invocations
@@ -0,0 +1,282 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Local OCR of image-based PDF pages, so text-dense scanned pages can be sent to the
+# model as text instead of as images.
+
+import contextvars
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import List, Optional
+
+from lazy_imports import lazy_import
+from tracing import trace_span
+
+pymupdf = lazy_import("pymupdf")
+Image = lazy_import("PIL.Image")
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+# "tesseract" runs Tesseract on each page in parallel; "docling" runs Docling's OCR
+# pipeline over the whole document
+OCR_ENGINE: str = os.environ.get("OCR_ENGINE", "tesseract")
+
+# pages OCR'd at once across all uploads; Tesseract runs in a subprocess, so
+# threads run in parallel
+OCR_WORKERS: int = int(os.environ.get("OCR_WORKERS", os.cpu_count() or 4))
+
+# pages are rendered at this resolution for OCR
+OCR_DPI: int = 300
+
+# pages sent as images are saved at this resolution, that of convert_pdf_to_images
+PAGE_IMAGE_DPI: int = 72
+
+# mean word confidence (0-100) at or above which a page is sent as text
+OCR_MIN_CONFIDENCE: float = float(os.environ.get("OCR_MIN_CONFIDENCE", 85))
+
+# pages with less text than this are sent as images, e.g. photos with a caption
+OCR_MIN_CHARS: int = 40
+#################################################
+
+
+class PageOcr:
+    """The OCR result of one PDF page."""
+
+    def __init__(
+        self,
+        page: int,
+        text: str,
+        confidence: Optional[float],
+        seconds: float,
+        image_path: Optional[Path] = None,
+    ) -> None:
+        self.page = page
+        self.text = text
+        self.confidence = confidence
+        self.seconds = seconds
+        # the page's image, saved only if the page is not accepted as text
+        self.image_path = image_path
+
+    @property
+    def accepted(self) -> bool:
+        """True if the page is confident and dense enough to be sent as text."""
+
+        return (
+            self.confidence is not None
+            and self.confidence >= OCR_MIN_CONFIDENCE
+            and len(self.text.strip()) >= OCR_MIN_CHARS
+        )
+
+    def report(self, file_name: str) -> dict:
+        return {
+            "file_name": file_name,
+            "page": self.page,
+            "confidence": (
+                round(self.confidence, 1) if self.confidence is not None else None
+            ),
+            "seconds": round(self.seconds, 3),
+            "sent_as": "text" if self.accepted else "image",
+        }
+
+
+def page_image_path(image_dir: Path, page_number: int) -> Path:
+    return image_dir / f"page_{page_number}.png"
+
+
+def render_page(pdf_bytes: bytes, page_number: int):
+    """Renders one PDF page as an RGB PIL image at OCR_DPI."""
+
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        pixmap = doc[page_number].get_pixmap(dpi=OCR_DPI)
+        return Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+
+
+def tesseract_page(
+    pdf_bytes: bytes, page_number: int, image_dir: Optional[Path] = None
+) -> PageOcr:
+    """
+    OCRs one PDF page with Tesseract. The page is rendered once: if it is not
+    accepted as text and image_dir is given, the OCR render is downscaled to
+    PAGE_IMAGE_DPI and saved there, instead of rasterizing the page again.
+    Returns:
+        PageOcr: The page's text, with lines rebuilt from Tesseract's word boxes, and
+            the mean word confidence weighted by word length.
+    """
+
+    import pytesseract  # optional; requires the tesseract binary
+
+    start = time.perf_counter()
+    with trace_span("ocr.page", page=page_number, engine="tesseract") as span:
+        image = render_page(pdf_bytes, page_number)
+        data = pytesseract.image_to_data(
+            image.convert("L"), output_type=pytesseract.Output.DICT
+        )
+
+        lines: dict = {}
+        weighted, chars = 0.0, 0
+        for index, word in enumerate(data["text"]):
+            confidence = float(data["conf"][index])
+            if confidence < 0 or not word.strip():
+                continue
+            key = (
+                data["block_num"][index],
+                data["par_num"][index],
+                data["line_num"][index],
+            )
+            lines.setdefault(key, []).append(word)
+            weighted += confidence * len(word)
+            chars += len(word)
+        text = "\n".join(" ".join(words) for words in lines.values())
+        confidence = weighted / chars if chars else None
+        if span:
+            span.attributes["confidence"] = confidence
+        page = PageOcr(page_number, text, confidence, 0.0)
+        if image_dir is not None and not page.accepted:
+            scale = PAGE_IMAGE_DPI / OCR_DPI
+            image = image.resize(
+                (round(image.width * scale), round(image.height * scale)),
+                Image.LANCZOS,
+            )
+            page.image_path = page_image_path(image_dir, page_number)
+            image.save(page.image_path)
+    page.seconds = time.perf_counter() - start
+    return page
+
+
+_ocr_executor: Optional[ThreadPoolExecutor] = None
+_ocr_executor_lock = threading.Lock()
+
+
+def get_ocr_executor() -> ThreadPoolExecutor:
+    """
+    Returns the process-wide pool that OCRs pages. It is shared by every ingestion
+    job, so concurrent PDFs never run more than OCR_WORKERS Tesseract processes in
+    total, whatever the number of ingestion slots.
+    """
+
+    global _ocr_executor  # pylint: disable=global-statement
+    with _ocr_executor_lock:
+        if _ocr_executor is None:
+            _ocr_executor = ThreadPoolExecutor(
+                max_workers=OCR_WORKERS, thread_name_prefix="ocr"
+            )
+        return _ocr_executor
+
+
+def tesseract_pages(
+    pdf_bytes: bytes, page_count: int, image_dir: Optional[Path] = None
+) -> List[PageOcr]:
+    executor = get_ocr_executor()
+    # each page runs in a copy of the caller's context, so its spans are traced
+    jobs = [
+        executor.submit(
+            contextvars.copy_context().run, tesseract_page, pdf_bytes, page, image_dir
+        )
+        for page in range(page_count)
+    ]
+    return [job.result() for job in jobs]
+
+
+def docling_pages(pdf_bytes: bytes, page_count: int) -> List[PageOcr]:
+    """
+    OCRs every page with Docling's OCR pipeline. Docling reports a confidence score
+    per page (0-1) in recent versions; pages without one are sent as images. Timing
+    is measured for the whole document, so each page is reported with its share.
+    """
+
+    # imported here as Docling pulls in torch and torchvision
+    from docling.datamodel.base_models import InputFormat
+    from docling.datamodel.pipeline_options import PdfPipelineOptions
+    from docling.document_converter import DocumentConverter, PdfFormatOption
+
+    pipeline_options = PdfPipelineOptions()
+    pipeline_options.do_ocr = True
+    pipeline_options.ocr_options.force_full_page_ocr = True
+    pipeline_options.do_table_structure = True
+
+    doc_converter = DocumentConverter(
+        format_options={
+            InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
+        }
+    )
+
+    start = time.perf_counter()
+    with (
+        trace_span("ocr.document", engine="docling"),
+        NamedTemporaryFile(suffix=".pdf") as temp,
+    ):
+        temp.write(pdf_bytes)
+        temp.flush()
+        conv_result = doc_converter.convert(temp.name)
+    seconds = (time.perf_counter() - start) / max(page_count, 1)
+
+    page_scores = getattr(getattr(conv_result, "confidence", None), "pages", {})
+    pages = []
+    for page in range(page_count):
+        score = getattr(page_scores.get(page), "ocr_score", None)
+        if score is not None and math.isnan(score):
+            score = None
+        pages.append(
+            PageOcr(
+                page,
+                # the exported document numbers pages from 1
+                conv_result.document.export_to_markdown(page_no=page + 1),
+                score * 100 if score is not None else None,
+                seconds,
+            )
+        )
+    return pages
+
+
+def save_page_images(pdf_bytes: bytes, pages: List[PageOcr], image_dir: Path) -> None:
+    """
+    Rasterizes the pages not accepted as text at PAGE_IMAGE_DPI, for engines that
+    render pages themselves.
+    """
+
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for page in pages:
+            if not page.accepted:
+                page.image_path = page_image_path(image_dir, page.page)
+                doc[page.page].get_pixmap(dpi=PAGE_IMAGE_DPI).save(page.image_path)
+
+
+def ocr_pdf(
+    pdf_bytes: bytes, engine: str = OCR_ENGINE, image_dir: Optional[Path] = None
+) -> List[PageOcr]:
+    """
+    OCRs every page of an image-based PDF with the configured engine.
+    Args:
+        pdf_bytes (bytes): The PDF file contents.
+        engine (str): "tesseract" or "docling".
+        image_dir (Optional[Path]): If given, each page not accepted as text is saved
+            there as `page_<n>.png`, named and sized as by convert_pdf_to_images, and
+            its path set on the page's result.
+    Returns:
+        List[PageOcr]: One result per page, in page order. Empty if the engine is not
+            installed, in which case every page should be sent as an image.
+    """
+
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        page_count = doc.page_count
+    if not page_count:
+        return []
+    try:
+        match engine:
+            case "docling":
+                pages = docling_pages(pdf_bytes, page_count)
+                if image_dir is not None:
+                    save_page_images(pdf_bytes, pages, image_dir)
+                return pages
+            case _:
+                return tesseract_pages(pdf_bytes, page_count, image_dir)
+    except (ImportError, OSError) as err:
+        # OSError includes pytesseract's TesseractNotFoundError
+        logger.warning("OCR engine %s is not available: %s", engine, err)
+        return []
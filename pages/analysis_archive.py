@@ -0,0 +1,56 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Search of archived analyses by brand, prompt text, file name, or response.
+
+import datetime
+import time
+
+import streamlit as st
+
+from archive import ARCHIVE_DB, get_archive
+
+
+def main() -> None:
+    st.set_page_config(page_title="Analysis Archive", page_icon="analysis.png")
+    st.markdown("## Analysis Archive")
+
+    query = st.text_input(
+        "Search past analyses by brand, prompt text, file name, or response:"
+    )
+    start = time.perf_counter()
+    analyses = get_archive().search(query)
+    search_ms = (time.perf_counter() - start) * 1000
+    if not analyses:
+        st.info(
+            f"No analyses in {ARCHIVE_DB} match your search."
+            if query.strip()
+            else f"No analyses have been archived in {ARCHIVE_DB} yet."
+        )
+        return
+    st.caption(
+        f"{len(analyses)} {'matches' if query.strip() else 'most recent analyses'}, "
+        f"newest first, in {search_ms:.2f} ms"
+    )
+
+    for analysis in analyses:
+        analyzed_at = datetime.datetime.fromtimestamp(analysis["timestamp"])
+        file_names = analysis["file_names"].replace("\n", ", ") or "no files"
+        with st.expander(
+            f"{analyzed_at:%Y-%m-%d %H:%M} · {analysis['model_id']} · {file_names}"
+        ):
+            st.markdown(analysis["snippet"])
+            st.caption(f"User prompt: {analysis['user_prompt']}")
+            st.caption(f"System prompt: {analysis['system_prompt']}")
+            st.caption(
+                f"Input tokens: {analysis['input_tokens']} · "
+                f"Output tokens: {analysis['output_tokens']}"
+            )
+            st.text_area(
+                "Model Response:",
+                value=analysis["response_text"],
+                height=400,
+                key=f"archived_response_{analysis['id']}",
+            )
+
+
+main()
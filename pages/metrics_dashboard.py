@@ -0,0 +1,120 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Dashboard of recorded Bedrock invocations: latency percentiles, throughput, and
+# error rate per model and region over time.
+
+import time
+from typing import Dict
+
+import pandas as pd
+import streamlit as st
+
+from metrics import METRICS_DB, OUTCOME_OK, load_invocations
+
+################### Constants ###################
+# time window shown, mapped to its length in seconds and the chart bucket size
+TIME_WINDOWS: Dict[str, tuple] = {
+    "Last hour": (3600, "1min"),
+    "Last 24 hours": (86_400, "15min"),
+    "Last 7 days": (7 * 86_400, "1h"),
+    "Last 30 days": (30 * 86_400, "1D"),
+}
+
+DEFAULT_TIME_WINDOW: str = "Last 24 hours"
+#################################################
+
+
+def summarize(invocations: pd.DataFrame) -> pd.DataFrame:
+    """
+    Aggregates invocations per model and region.
+    Args:
+        invocations (pd.DataFrame): Recorded invocations.
+    Returns:
+        pd.DataFrame: Counts, error rate, latency percentiles, and tokens/sec.
+    """
+
+    grouped = invocations.groupby(["model_id", "region"])
+    summary = pd.DataFrame(
+        {
+            "invocations": grouped.size(),
+            "error_rate": grouped["failed"].mean().round(4),
+            "retries": grouped["retries"].sum(),
+            "p50_latency_sec": grouped["latency_sec"].quantile(0.50).round(3),
+            "p95_latency_sec": grouped["latency_sec"].quantile(0.95).round(3),
+            "p99_latency_sec": grouped["latency_sec"].quantile(0.99).round(3),
+            "tokens_per_sec": grouped["tokens_per_sec"].median().round(1),
+            "mean_payload_kb": (grouped["payload_bytes"].mean() / 1024).round(1),
+        }
+    )
+    return summary.reset_index()
+
+
+def over_time(invocations: pd.DataFrame, bucket: str) -> pd.DataFrame:
+    """
+    Aggregates invocations per time bucket and model/region series.
+    Returns:
+        pd.DataFrame: One row per bucket and series with latency percentiles,
+            median tokens/sec, and error rate.
+    """
+
+    grouped = invocations.groupby(
+        [pd.Grouper(key="time", freq=bucket), "series"], observed=True
+    )
+    return pd.DataFrame(
+        {
+            "p50": grouped["latency_sec"].quantile(0.50),
+            "p95": grouped["latency_sec"].quantile(0.95),
+            "p99": grouped["latency_sec"].quantile(0.99),
+            "tokens_per_sec": grouped["tokens_per_sec"].median(),
+            "error_rate": grouped["failed"].mean(),
+        }
+    ).reset_index()
+
+
+def main() -> None:
+    st.set_page_config(page_title="Invocation Metrics", page_icon="analysis.png")
+    st.markdown("## Invocation Metrics")
+
+    time_window = st.selectbox(
+        "Time window",
+        options=list(TIME_WINDOWS),
+        index=list(TIME_WINDOWS).index(DEFAULT_TIME_WINDOW),
+    )
+    window_sec, bucket = TIME_WINDOWS[time_window]
+    invocations = pd.DataFrame(load_invocations(time.time() - window_sec))
+    if invocations.empty:
+        st.info(f"No invocations recorded in {METRICS_DB} for this time window.")
+        return
+
+    invocations["time"] = pd.to_datetime(invocations["timestamp"], unit="s")
+    invocations["failed"] = invocations["outcome"] != OUTCOME_OK
+    ok = ~invocations["failed"] & (invocations["latency_sec"] > 0)
+    invocations["tokens_per_sec"] = (
+        invocations["output_tokens"] / invocations["latency_sec"]
+    ).where(ok)
+    invocations["series"] = (
+        invocations["model_id"].str.split(".").str[1] + " / " + invocations["region"]
+    )
+
+    st.markdown("### Per Model and Region")
+    st.dataframe(summarize(invocations), hide_index=True)
+
+    trend = over_time(invocations, bucket)
+    percentile = st.radio("Latency percentile", ["p50", "p95", "p99"], horizontal=True)
+    st.markdown(f"### {percentile} Latency (sec)")
+    st.line_chart(trend, x="time", y=percentile, color="series")
+    st.markdown("### Output Tokens/sec (median)")
+    st.line_chart(trend, x="time", y="tokens_per_sec", color="series")
+    st.markdown("### Error Rate")
+    st.line_chart(trend, x="time", y="error_rate", color="series")
+
+    errors = invocations[invocations["failed"]]
+    if not errors.empty:
+        st.markdown("### Errors by Outcome")
+        st.dataframe(
+            errors.groupby(["series", "outcome"]).size().rename("count").reset_index(),
+            hide_index=True,
+        )
+
+
+main()
@@ -0,0 +1,454 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# The analysis pipeline shared by the Streamlit app and the API server: ingesting
+# uploads into text and images, and composing them into a model request.
+
+import hashlib
+import logging
+import os
+from io import StringIO
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Dict, List, Optional, Union
+
+from keyframes import GIF_FIRST_FRAME, is_animated, save_keyframes
+from lazy_imports import PREWARM_IMPORTS, lazy_import, prewarm
+from ocr import ocr_pdf
+from relevance import CHUNK_TOKENS, estimate_tokens, get_chunk_index
+from request_body import MAX_IMAGE_BYTES, Base64Attachment
+from scratch import DEFAULT_SESSION, get_scratch_store
+from tracing import Tracer, set_active_tracer, trace_span
+
+# heavy dependencies are imported on first use; Docling (torch) only if called
+pymupdf = lazy_import("pymupdf")
+Image = lazy_import("PIL.Image")
+
+if PREWARM_IMPORTS:
+    prewarm(pymupdf, Image)
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+AWS_REGIONS: str = ["us-west-2", "us-east-1"]
+
+DEFAULT_AWS_REGION: int = AWS_REGIONS[0]
+
+# model ids: https://docs.aws.amazon.com/bedrock/latest/userguide/model-ids.html
+MODELS: list[str] = [
+    "anthropic.claude-3-5-sonnet-20241022-v2:0",  # currently only available in us-west-2!
+    "anthropic.claude-3-5-sonnet-20240620-v1:0",
+    "anthropic.claude-3-haiku-20240307-v1:0",
+    "anthropic.claude-3-sonnet-20240229-v1:0",
+    "anthropic.claude-3-opus-20240229-v1:0",
+]
+
+DEFAULT_MODEL_ID: int = MODELS[0]
+
+DEFAULT_MAX_TOKENS: int = 2048
+DEFAULT_TEMPERATURE: float = 0.2
+DEFAULT_TOP_P: float = 0.999
+DEFAULT_TOP_K: int = 250
+
+# OCR image-based PDFs by default (see ocr.py for the engine and confidence threshold)
+OCR_DEFAULT: bool = os.environ.get("OCR_DEFAULT", "false").lower() == "true"
+
+# send only the sections of long text attachments relevant to the prompt by default
+RELEVANCE_DEFAULT: bool = os.environ.get("RELEVANCE_DEFAULT", "false").lower() == "true"
+
+DEFAULT_SYSTEM_PROMPT: str = (
+    """You are an experienced Creative Director at a top-tier advertising agency. You are an expert at advertising analysis, the process of examining advertising to understand its effects on consumers."""
+)
+#################################################
+
+
+def attachment_key(file_path: dict) -> str:
+    """
+    Returns a cache key for an image file that changes if the file is overwritten.
+    """
+
+    stat = os.stat(file_path["file_path"])
+    return f"{file_path['file_path']}:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def compose_message(
+    user_prompt: str,
+    file_paths: List[dict],
+    attachment_cache: Optional[Dict[str, dict]] = None,
+) -> List[dict]:
+    """
+    Composes a message dictionary for a user prompt and optional file paths.
+    Args:
+        user_prompt (str): The text prompt provided by the user.
+        file_paths (List[dict]): A list of dictionaries, each containing:
+            - "file_path" (str): The path to the file.
+            - "file_type" (str): The MIME type of the file.
+        attachment_cache (Optional[Dict[str, dict]]): Image content blocks already read,
+            keyed by `attachment_key`. Cached blocks are reused by reference instead of
+            re-reading the file, and new blocks are added to the cache.
+    Returns:
+        List[dict]: A list containing a single message dictionary. The message dictionary
+        includes the user prompt as text and optionally includes images, whose data is
+        base64-encoded when the request body is built (see request_body.py).
+    """
+
+    message = {"role": "user", "content": [{"type": "text", "text": user_prompt}]}
+
+    if file_paths:
+        for file_path in file_paths:
+            key = attachment_key(file_path) if attachment_cache is not None else None
+            if key is not None and key in attachment_cache:
+                message["content"].append(attachment_cache[key])
+                continue
+            with trace_span("attachment.read", file_path=file_path["file_path"]):
+                image_block = {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": file_path["file_type"],
+                        "data": Base64Attachment.from_file(file_path["file_path"]),
+                    },
+                }
+            message["content"].append(image_block)
+            if key is not None:
+                attachment_cache[key] = image_block
+
+    messages = [message] if message else []
+    return messages
+
+
+def is_pdf_image_based(uploaded_file: Union[NamedTemporaryFile, StringIO]) -> bool:
+    """
+    Determines if a PDF file is image-based (i.e., contains no text content).
+    Args:
+        uploaded_file (Union[NamedTemporaryFile, StringIO]): The uploaded PDF file to check.
+            It can be a NamedTemporaryFile or a StringIO object.
+    Returns:
+        bool: True if the PDF is image-based (contains no text content), False otherwise.
+    """
+
+    is_image_based = True
+
+    with NamedTemporaryFile(suffix="pdf") as temp:
+        temp.write(uploaded_file.getvalue())
+        temp.seek(0)
+        doc = pymupdf.open(temp.name)
+
+    for page in doc:
+        text = page.get_text()
+        if text.strip():  # Check if there is any text content
+            is_image_based = False
+            break
+
+    doc.close()
+    return is_image_based
+
+
+def convert_pdf_to_images(
+    uploaded_file: Union[NamedTemporaryFile, StringIO],
+    scratch_dir: Optional[Path] = None,
+) -> List[Path]:
+    """
+    Convert a PDF file to a list of images, one for each page.
+
+    Args:
+        uploaded_file (Union[NamedTemporaryFile, StringIO]): The uploaded PDF file to be converted.
+        scratch_dir (Optional[Path]): The scratch namespace to write the images to;
+            a new one is created if None.
+
+    Returns:
+        List[Path]: A list of paths to the generated image files, one for each page of the PDF.
+    """
+
+    images = []
+    zoom = 4
+    mat = pymupdf.Matrix(zoom, zoom)
+    store = get_scratch_store()
+    namespace = scratch_dir or store.namespace(DEFAULT_SESSION)
+
+    with NamedTemporaryFile(suffix="pdf") as temp:
+        temp.write(uploaded_file.getvalue())
+        temp.seek(0)
+        doc = pymupdf.open(temp.name)
+
+        for i, page in enumerate(doc):
+            image = page.get_pixmap()
+            image_path = namespace / f"page_{i}.png"
+            image.save(image_path)
+            images.append(image_path)
+        doc.close()
+
+    if scratch_dir is None:
+        store.commit(namespace)
+
+    return images
+
+
+def extract_text_from_pdf_pymupdf(
+    uploaded_file: Union[NamedTemporaryFile, StringIO],
+) -> str:
+    """
+    Extracts text from a PDF file using PyMuPDF.
+    Args:
+        uploaded_file (Union[NamedTemporaryFile, StringIO]): The uploaded PDF file,
+        which can be a NamedTemporaryFile or a StringIO object.
+    Returns:
+        str: The extracted text from the PDF.
+    """
+
+    with NamedTemporaryFile(suffix="pdf") as temp:
+        temp.write(uploaded_file.getvalue())
+        temp.seek(0)
+        doc = pymupdf.open(temp.name)
+        extract_text = "".join(page.get_text() for page in doc)
+        return extract_text
+
+
+def extract_text_from_pdf_docling(
+    uploaded_file: Union[NamedTemporaryFile, StringIO],
+) -> str:
+    """
+    Extracts text from a PDF file using OCR and table structure recognition.
+
+    Args:
+        uploaded_file (Union[NamedTemporaryFile, StringIO]): The uploaded PDF file to be processed.
+
+    Returns:
+        str: The extracted text from the PDF in Markdown format.
+
+    This function uses a document conversion pipeline with OCR and table structure options enabled
+    to extract text from the provided PDF file. The extracted text is then exported to Markdown format.
+    """
+
+    # imported here as Docling pulls in torch and torchvision
+    from docling.datamodel.base_models import InputFormat
+    from docling.datamodel.pipeline_options import PdfPipelineOptions
+    from docling.document_converter import DocumentConverter, PdfFormatOption
+
+    pipeline_options = PdfPipelineOptions()
+    pipeline_options.do_ocr = False
+    pipeline_options.do_table_structure = True
+    pipeline_options.table_structure_options.do_cell_matching = True
+
+    doc_converter = DocumentConverter(
+        format_options={
+            InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
+        }
+    )
+
+    with NamedTemporaryFile(suffix="pdf") as temp:
+        temp.write(uploaded_file.getvalue())
+        temp.seek(0)
+        conv_result = doc_converter.convert(temp.name)
+        extract_text = conv_result.document.export_to_markdown()
+        return extract_text
+
+
+def extract_text_from_text(uploaded_file: Union[NamedTemporaryFile, StringIO]) -> str:
+    """
+    Extracts text content from an uploaded file.
+    This function takes an uploaded file, which can be either a NamedTemporaryFile or a StringIO object,
+    and extracts its text content as a string.
+    Args:
+        uploaded_file (Union[NamedTemporaryFile, StringIO]): The uploaded file from which to extract text.
+    Returns:
+        str: The extracted text content of the uploaded file.
+    """
+
+    extract_text = StringIO(uploaded_file.getvalue().decode("utf-8"))
+    return extract_text.getvalue()
+
+
+def save_image(
+    uploaded_file: Union[NamedTemporaryFile, StringIO],
+    file_paths: List[dict],
+    scratch_dir: Optional[Path] = None,
+) -> None:
+    """
+    Save an uploaded image file to a scratch directory and update the file paths list.
+    Args:
+        uploaded_file (Union[NamedTemporaryFile, StringIO]): The uploaded image file.
+        file_paths (List[dict]): A list to store file path information dictionaries.
+        scratch_dir (Optional[Path]): The scratch namespace to write the image to;
+            a new one is created if None.
+    Returns:
+        None
+    Raises:
+        None
+    Logs:
+        - Error if the file size exceeds 5MB.
+        - Info when the image is successfully saved.
+    Notes:
+        - The function checks if the uploaded file size exceeds 5MB and logs an error if it does.
+        - The image is saved in a scratch namespace (see scratch.py), so uploads with
+          the same name in other sessions or requests are not overwritten.
+        - The file path, type, and uploaded file name are appended to the `file_paths`
+          list.
+    """
+
+    if uploaded_file.size > MAX_IMAGE_BYTES:
+        logger.error("File size exceeds 5MB limit")
+        return
+    image = Image.open(uploaded_file)
+    store = get_scratch_store()
+    namespace = scratch_dir or store.namespace(DEFAULT_SESSION)
+    image_path = namespace / os.path.basename(uploaded_file.name)
+    image.save(image_path)
+    if scratch_dir is None:
+        store.commit(namespace)
+    file_paths.append(
+        {
+            "file_path": str(image_path),
+            "file_type": uploaded_file.type,
+            "file_name": uploaded_file.name,
+        }
+    )
+    logger.info("Image saved: %s (%s)", image_path, uploaded_file.type)
+
+
+def ingest_file(
+    uploaded_file: Union[NamedTemporaryFile, StringIO],
+    scratch_dir: Optional[Path] = None,
+    ocr: bool = False,
+    gif_mode: str = GIF_FIRST_FRAME,
+) -> dict:
+    """
+    Processes a single uploaded file based on its MIME type, timing each stage.
+    Runs on an ingestion worker thread, so it reports errors in its result rather
+    than writing to the page.
+    Args:
+        uploaded_file (Union[NamedTemporaryFile, StringIO]): The uploaded file to process.
+        scratch_dir (Optional[Path]): The scratch namespace for the file's images; a new
+            one is created if None.
+        ocr (bool): Whether to OCR image-based PDFs and send confident pages as text.
+        gif_mode (str): How to send animated GIFs; one of GIF_MODES.
+    Returns:
+        dict: The ingestion result, containing:
+            - "text" (Optional[str]): Text extracted from the file, if any.
+            - "file_paths" (List[dict]): File path and type of each image to send.
+            - "error" (Optional[str]): Why the file could not be processed, if it failed.
+            - "stage_timings" (Dict[str, float]): Seconds spent in each ingestion stage.
+            - "scratch_dir" (Path): The scratch namespace holding the file's images.
+            - "ocr_pages" (List[dict]): Confidence, timing, and outcome of each OCR'd page.
+            - "text_index" (Optional[ChunkIndex]): The relevance index of a text longer
+                than one chunk.
+    """
+
+    store = get_scratch_store()
+    scratch_dir = scratch_dir or store.namespace(DEFAULT_SESSION)
+    result = {
+        "text": None,
+        "file_paths": [],
+        "error": None,
+        "stage_timings": {},
+        "scratch_dir": scratch_dir,
+        "ocr_pages": [],
+        "text_index": None,
+    }
+    tracer = Tracer()
+    set_active_tracer(tracer)
+
+    try:
+        with (
+            store.pin(scratch_dir),
+            trace_span(
+                "ingest.file",
+                file_name=uploaded_file.name,
+                file_type=uploaded_file.type,
+            ),
+        ):
+            match uploaded_file.type:
+                case "text/csv" | "text/plain" | "application/octet-stream":
+                    with trace_span("text.extract"):
+                        result["text"] = extract_text_from_text(uploaded_file)
+                case "application/pdf":
+                    with trace_span("pdf.is_image_based"):
+                        is_image: bool = is_pdf_image_based(uploaded_file)
+                    logger.info("is_image: %s", is_image)
+                    if is_image:
+                        pages = []
+                        if ocr:
+                            # pages are rendered once, for OCR; those not sent as
+                            # text are saved as images from the same render
+                            with trace_span("pdf.ocr"):
+                                pages = ocr_pdf(
+                                    uploaded_file.getvalue(), image_dir=scratch_dir
+                                )
+                        if pages:
+                            images = [page.image_path for page in pages]
+                        else:
+                            with trace_span("pdf.rasterize"):
+                                images = convert_pdf_to_images(
+                                    uploaded_file, scratch_dir
+                                )
+                        # confidently OCR'd pages are sent as text, the rest as images
+                        text_pages = {
+                            page.page: page for page in pages if page.accepted
+                        }
+                        if text_pages:
+                            result["text"] = "\n\n".join(
+                                f"[{uploaded_file.name}, page {number + 1}]\n{page.text}"
+                                for number, page in sorted(text_pages.items())
+                            )
+                        result["ocr_pages"] = [
+                            page.report(uploaded_file.name) for page in pages
+                        ]
+                        for number, image in enumerate(images):
+                            if number in text_pages:
+                                continue
+                            result["file_paths"].append(
+                                {
+                                    "file_path": str(image),
+                                    "file_type": "image/png",
+                                    "file_name": f"{uploaded_file.name}, page {number + 1}",
+                                }
+                            )
+                    else:
+                        with trace_span("pdf.extract_text"):
+                            result["text"] = extract_text_from_pdf_pymupdf(
+                                uploaded_file
+                            )
+                case "image/gif" if gif_mode != GIF_FIRST_FRAME and is_animated(
+                    uploaded_file
+                ):
+                    try:
+                        with trace_span("gif.keyframes", mode=gif_mode):
+                            result["file_paths"], result["text"] = save_keyframes(
+                                uploaded_file, uploaded_file.name, scratch_dir, gif_mode
+                            )
+                    except ValueError as err:
+                        # keyframes too large to send even as JPEG; send the GIF as is
+                        logger.warning("%s, sending the first frame", err)
+                        uploaded_file.seek(0)
+                        with trace_span("image.save"):
+                            save_image(uploaded_file, result["file_paths"], scratch_dir)
+                        if not result["file_paths"]:
+                            result["error"] = (
+                                f"{uploaded_file.name}: File size exceeds 5MB limit"
+                            )
+                case "image/jpeg" | "image/png" | "image/webp" | "image/gif":
+                    with trace_span("image.save"):
+                        save_image(uploaded_file, result["file_paths"], scratch_dir)
+                    if not result["file_paths"]:
+                        result["error"] = (
+                            f"{uploaded_file.name}: File size exceeds 5MB limit"
+                        )
+                case _:
+                    result["error"] = (
+                        f"{uploaded_file.name}: Invalid file type. Please upload a valid file type."
+                    )
+            if result["text"] and estimate_tokens(result["text"]) > CHUNK_TOKENS:
+                with trace_span("text.index"):
+                    file_hash = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+                    result["text_index"] = get_chunk_index(
+                        f"{file_hash}:ocr={ocr}", result["text"]
+                    )
+    except Exception as err:  # pylint: disable=broad-except
+        logger.error("Failed to process %s: %s", uploaded_file.name, err)
+        result["error"] = f"{uploaded_file.name}: {err}"
+    finally:
+        set_active_tracer(None)
+        result["stage_timings"] = tracer.stage_breakdown()
+        tracer.flush()
+        store.commit(scratch_dir)
+
+    return result
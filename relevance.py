@@ -0,0 +1,244 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Local BM25 retrieval over long text attachments, so only the sections relevant to
+# the user prompt are sent to the model, within a token budget.
+
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+# input tokens of extracted text sent per request when relevance mode is on
+RELEVANCE_TOKEN_BUDGET: int = int(os.environ.get("RELEVANCE_TOKEN_BUDGET", 8_000))
+
+# target size of one chunk; paragraphs are kept whole where possible
+CHUNK_TOKENS: int = 300
+
+# same estimate as conversation.estimate_message_tokens
+CHARS_PER_TOKEN: int = 4
+
+# indexes kept in memory, keyed by file hash
+INDEX_CACHE_SIZE: int = 64
+
+# BM25 term-frequency saturation and document-length normalization
+BM25_K1: float = 1.5
+BM25_B: float = 0.75
+
+STOP_WORDS: frozenset = frozenset(
+    "a an and are as at be by for from has have how in is it its of on or that the "
+    "their this to was what which with".split()
+)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# joins the chunks chosen from one text; its tokens count against the budget
+EXCERPT_SEPARATOR: str = "\n\n[...]\n\n"
+EXCERPT_HEADER_TOKENS: int = 20
+#################################################
+
+
+def tokenize(text: str) -> List[str]:
+    return [
+        term for term in TOKEN_PATTERN.findall(text.lower()) if term not in STOP_WORDS
+    ]
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN
+
+
+def split_chunks(text: str, chunk_tokens: int = CHUNK_TOKENS) -> List[str]:
+    """
+    Splits text into chunks of about `chunk_tokens`, on paragraph boundaries; a
+    paragraph longer than a chunk is split on line, then word, boundaries.
+    """
+
+    chunk_chars = chunk_tokens * CHARS_PER_TOKEN
+    pieces: List[str] = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        if len(paragraph) <= chunk_chars:
+            pieces.append(paragraph)
+            continue
+        for line in paragraph.splitlines():
+            while len(line) > chunk_chars:
+                cut = line.rfind(" ", 0, chunk_chars)
+                cut = cut if cut > 0 else chunk_chars
+                pieces.append(line[:cut])
+                line = line[cut:].lstrip()
+            pieces.append(line)
+
+    chunks: List[str] = []
+    current = ""
+    for piece in pieces:
+        if not piece.strip():
+            continue
+        if current and len(current) + len(piece) + 2 > chunk_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class ChunkIndex:
+    """
+    A BM25 index over the chunks of one extracted text.
+    Args:
+        text (str): The extracted text.
+    """
+
+    def __init__(self, text: str) -> None:
+        self.chunks = split_chunks(text)
+        self._term_counts = [Counter(tokenize(chunk)) for chunk in self.chunks]
+        self._lengths = [sum(counts.values()) for counts in self._term_counts]
+        self._average_length = sum(self._lengths) / max(len(self.chunks), 1)
+        document_frequency: Counter = Counter()
+        for counts in self._term_counts:
+            document_frequency.update(counts.keys())
+        chunk_count = len(self.chunks)
+        self._idf = {
+            term: math.log(1 + (chunk_count - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequency.items()
+        }
+
+    def scores(self, query: str) -> List[float]:
+        """Returns the BM25 score of every chunk for the query."""
+
+        terms = [term for term in set(tokenize(query)) if term in self._idf]
+        scores = []
+        for counts, length in zip(self._term_counts, self._lengths):
+            score = 0.0
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / self._average_length)
+            for term in terms:
+                frequency = counts.get(term, 0)
+                if frequency:
+                    score += (
+                        self._idf[term] * frequency * (BM25_K1 + 1) / (frequency + norm)
+                    )
+            scores.append(score)
+        return scores
+
+
+_indexes: "OrderedDict[str, ChunkIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_chunk_index(file_hash: str, text: str) -> ChunkIndex:
+    """
+    Returns the index of a file's extracted text, building it on first use. Indexes
+    are shared by every session, so re-uploading a file does not re-index it.
+    Args:
+        file_hash (str): A hash of the file contents and how its text was extracted.
+        text (str): The extracted text.
+    Returns:
+        ChunkIndex: The index.
+    """
+
+    with _indexes_lock:
+        if file_hash in _indexes:
+            _indexes.move_to_end(file_hash)
+            return _indexes[file_hash]
+    index = ChunkIndex(text)
+    with _indexes_lock:
+        _indexes[file_hash] = index
+        while len(_indexes) > INDEX_CACHE_SIZE:
+            _indexes.popitem(last=False)
+    return index
+
+
+def select_relevant_texts(
+    texts: List[str],
+    indexes: List[Optional[ChunkIndex]],
+    query: str,
+    token_budget: int = RELEVANCE_TOKEN_BUDGET,
+) -> Tuple[List[str], str]:
+    """
+    Cuts extracted texts down to the chunks most relevant to the query. If all the
+    texts fit in the budget, they are returned unchanged. Otherwise, chunks of the
+    indexed texts are ranked together by BM25 score and taken, best first, until the
+    budget is spent, after first taking each text's best chunk, so no attachment is
+    left out; each text's chosen chunks are kept in document order. A text none of
+    whose chunks fit is replaced by a note that it was left out. Texts without an
+    index are always sent whole.
+    Args:
+        texts (List[str]): The extracted text of each attachment.
+        indexes (List[Optional[ChunkIndex]]): The index of each text, or None.
+        query (str): The user prompt.
+        token_budget (int): Estimated input tokens to spend on the texts.
+    Returns:
+        Tuple[List[str], str]:
+            - The texts to send.
+            - A summary of what was selected, for display.
+    """
+
+    total_tokens = sum(estimate_tokens(text) for text in texts)
+    if total_tokens <= token_budget:
+        return texts, ""
+
+    budget = token_budget - sum(
+        estimate_tokens(text) if index is None else EXCERPT_HEADER_TOKENS
+        for text, index in zip(texts, indexes)
+    )
+    ranked = []
+    for text_number, index in enumerate(indexes):
+        if index is None:
+            continue
+        for chunk_number, score in enumerate(index.scores(query)):
+            ranked.append((score, text_number, chunk_number))
+    # best first; ties, including chunks no query term matches, in document order
+    ranked.sort(key=lambda item: (-item[0], item[1], item[2]))
+
+    # each text's best chunk first, then the best of the rest across all texts
+    best = {}
+    for item in ranked:
+        best.setdefault(item[1], item)
+    selected = {}
+    for _, text_number, chunk_number in list(best.values()) + ranked:
+        if chunk_number in selected.get(text_number, []):
+            continue
+        chunk_tokens = estimate_tokens(
+            indexes[text_number].chunks[chunk_number] + EXCERPT_SEPARATOR
+        )
+        if chunk_tokens > budget:
+            continue
+        budget -= chunk_tokens
+        selected.setdefault(text_number, []).append(chunk_number)
+
+    results = []
+    chunk_total, chunk_sent = 0, 0
+    for text_number, (text, index) in enumerate(zip(texts, indexes)):
+        if index is None:
+            results.append(text)
+            continue
+        chunk_total += len(index.chunks)
+        chunk_numbers = sorted(selected.get(text_number, []))
+        chunk_sent += len(chunk_numbers)
+        if len(chunk_numbers) == len(index.chunks):
+            results.append(text)
+        elif chunk_numbers:
+            results.append(
+                f"[Excerpts relevant to the prompt, {len(chunk_numbers)} of "
+                f"{len(index.chunks)} sections]\n\n"
+                + EXCERPT_SEPARATOR.join(
+                    index.chunks[number] for number in chunk_numbers
+                )
+            )
+        else:
+            results.append(
+                f"[A long attachment of {len(index.chunks)} sections was left out; "
+                "none of its sections fit in the token budget]"
+            )
+    sent_tokens = sum(estimate_tokens(text) for text in results)
+    summary = (
+        f"Sent {chunk_sent} of {chunk_total} sections of long attachments most "
+        f"relevant to the prompt, about {sent_tokens:,} of {total_tokens:,} tokens."
+    )
+    logger.info(summary)
+    return results, summary
@@ -0,0 +1,120 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Low-memory construction of Bedrock request bodies: attachments keep their raw bytes
+# and are base64-encoded in chunks straight into one pre-sized body buffer.
+
+import binascii
+import json
+import logging
+import re
+import uuid
+from typing import List, Union
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+# raw bytes encoded at a time; a multiple of 3, so the chunks' base64 concatenates
+ENCODE_CHUNK_BYTES: int = 3 * 256 * 1024
+
+# Bedrock rejects image attachments larger than this
+MAX_IMAGE_BYTES: int = 5 * 1024 * 1024
+#################################################
+
+
+class Base64Attachment:
+    """
+    The data of an image content block, kept as raw bytes until the request body is
+    built, instead of as a base64 string, which is a third larger and would be
+    copied again by `json.dumps`.
+    Args:
+        data (bytes): The raw file contents.
+    """
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+    @classmethod
+    def from_file(cls, path: str) -> "Base64Attachment":
+        with open(path, "rb") as attachment_file:
+            return cls(attachment_file.read())
+
+    @property
+    def encoded_length(self) -> int:
+        return (len(self.data) + 2) // 3 * 4
+
+    def encode_into(self, buffer: memoryview) -> None:
+        """Writes the base64 encoding into `buffer`, one chunk at a time."""
+
+        source = memoryview(self.data)
+        offset = 0
+        for start in range(0, len(source), ENCODE_CHUNK_BYTES):
+            encoded = binascii.b2a_base64(
+                source[start : start + ENCODE_CHUNK_BYTES], newline=False
+            )
+            buffer[offset : offset + len(encoded)] = encoded
+            offset += len(encoded)
+
+
+# a serialized JSON value, as literal JSON bytes with attachments still to be encoded
+Segments = List[Union[bytes, Base64Attachment]]
+
+
+def dumps_segments(value) -> Segments:
+    """
+    Serializes a JSON value whose image data may be Base64Attachments, leaving
+    each attachment in place to be encoded when the body is written.
+    Args:
+        value: The value to serialize, e.g. a message or a whole request.
+    Returns:
+        Segments: JSON bytes, with the attachments between them.
+    """
+
+    nonce = uuid.uuid4().hex
+    attachments: List[Base64Attachment] = []
+
+    def placeholder(obj) -> str:
+        if isinstance(obj, Base64Attachment):
+            attachments.append(obj)
+            return f"{nonce}:{len(attachments) - 1}"
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    parts = re.split(f"{nonce}:(\\d+)", json.dumps(value, default=placeholder))
+    segments: Segments = []
+    for index, part in enumerate(parts):
+        if index % 2:
+            segments.append(attachments[int(part)])
+        elif part:
+            segments.append(part.encode("utf-8"))
+    return segments
+
+
+def write_body(segments: Segments) -> bytearray:
+    """
+    Writes serialized segments into a single buffer, sized up front, so the body is
+    never copied as it grows; boto3 and aiohttp send a bytearray without copying it.
+    Args:
+        segments (Segments): The request body's JSON bytes and attachments, in order.
+    Returns:
+        bytearray: The request body.
+    """
+
+    size = sum(
+        (
+            segment.encoded_length
+            if isinstance(segment, Base64Attachment)
+            else len(segment)
+        )
+        for segment in segments
+    )
+    body = bytearray(size)
+    with memoryview(body) as view:
+        offset = 0
+        for segment in segments:
+            if isinstance(segment, Base64Attachment):
+                end = offset + segment.encoded_length
+                segment.encode_into(view[offset:end])
+            else:
+                end = offset + len(segment)
+                view[offset:end] = segment
+            offset = end
+    return body
@@ -0,0 +1,248 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Cost- and latency-aware routing of requests to an Anthropic Claude 3 model on Amazon Bedrock.
+
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from conversation import estimate_message_tokens
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+AUTO_MODEL_ID: str = "auto"
+
+HAIKU_3: str = "anthropic.claude-3-haiku-20240307-v1:0"
+SONNET_3: str = "anthropic.claude-3-sonnet-20240229-v1:0"
+SONNET_3_5_V1: str = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+SONNET_3_5_V2: str = "anthropic.claude-3-5-sonnet-20241022-v2:0"
+OPUS_3: str = "anthropic.claude-3-opus-20240229-v1:0"
+
+# on-demand USD per 1M input/output tokens, typical time to first token, and
+# typical generation speed in output tokens/sec, used until generation speed has
+# been observed for a model in a region
+MODEL_PROFILES: Dict[str, dict] = {
+    HAIKU_3: {
+        "input_cost": 0.25,
+        "output_cost": 1.25,
+        "first_token_sec": 0.5,
+        "tokens_per_sec": 120.0,
+    },
+    SONNET_3: {
+        "input_cost": 3.0,
+        "output_cost": 15.0,
+        "first_token_sec": 1.0,
+        "tokens_per_sec": 60.0,
+    },
+    SONNET_3_5_V1: {
+        "input_cost": 3.0,
+        "output_cost": 15.0,
+        "first_token_sec": 1.0,
+        "tokens_per_sec": 55.0,
+    },
+    SONNET_3_5_V2: {
+        "input_cost": 3.0,
+        "output_cost": 15.0,
+        "first_token_sec": 1.0,
+        "tokens_per_sec": 55.0,
+    },
+    OPUS_3: {
+        "input_cost": 15.0,
+        "output_cost": 75.0,
+        "first_token_sec": 2.0,
+        "tokens_per_sec": 25.0,
+    },
+}
+
+# models not offered in every region
+REGIONAL_MODELS: Dict[str, List[str]] = {SONNET_3_5_V2: ["us-west-2"]}
+
+# candidate models per request class, most capable first
+ROUTES: Dict[str, List[str]] = {
+    "simple": [HAIKU_3],
+    "standard": [SONNET_3_5_V2, SONNET_3_5_V1, HAIKU_3],
+    "complex": [SONNET_3_5_V2, SONNET_3_5_V1, OPUS_3],
+}
+
+# a request is "simple" below these limits, and "complex" at or above these; the
+# output limit applies to the expected output, so the default max_tokens qualifies
+SIMPLE_MAX_INPUT_TOKENS: int = 2_000
+SIMPLE_MAX_OUTPUT_TOKENS: int = 1_024
+COMPLEX_MIN_INPUT_TOKENS: int = 20_000
+COMPLEX_MIN_IMAGES: int = 3
+
+# skip a candidate whose predicted latency is this many times its usual latency
+SLOWDOWN_FALLBACK_FACTOR: float = 2.0
+
+# weight of the newest observation in the moving average
+EWMA_ALPHA: float = 0.3
+
+# an observed speed counts half as much after this long without a new observation,
+# so a model routed away from for being slow is tried again once it is forgotten
+OBSERVATION_HALF_LIFE_SEC: float = 300.0
+
+# output tokens assumed when predicting latency, as a fraction of max_tokens
+EXPECTED_OUTPUT_FRACTION: float = 0.5
+#################################################
+
+
+class LatencyTracker:
+    """
+    Keeps an exponentially weighted moving average of the observed generation speed,
+    in output tokens/sec, of each model per region, shared by all sessions in the
+    process. Observations fade back to the model's typical speed over time.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # (model_id, region) -> (tokens/sec, time of the last observation)
+        self._tokens_per_sec: Dict[Tuple[str, str], Tuple[float, float]] = {}
+
+    def record(
+        self, model_id: str, region: str, latency_sec: float, output_tokens: int
+    ) -> None:
+        """
+        Records one completed model call. InvokeModel reports only the total time,
+        so the model's typical time to first token is subtracted to get its
+        generation speed, comparable with MODEL_PROFILES.
+        Args:
+            model_id (str): The model that was invoked.
+            region (str): The AWS region it was invoked in.
+            latency_sec (float): Wall time of the InvokeModel call.
+            output_tokens (int): Tokens generated.
+        """
+
+        if model_id not in MODEL_PROFILES or latency_sec <= 0 or output_tokens <= 0:
+            return
+        profile = MODEL_PROFILES[model_id]
+        generation_sec = latency_sec - profile["first_token_sec"]
+        # an answer faster than the usual first token says only that the model is
+        # not slow, not how fast it generates
+        tokens_per_sec = (
+            output_tokens / generation_sec
+            if generation_sec > 0
+            else profile["tokens_per_sec"]
+        )
+        with self._lock:
+            previous = self._current(model_id, region)
+            self._tokens_per_sec[(model_id, region)] = (
+                previous + EWMA_ALPHA * (tokens_per_sec - previous),
+                time.monotonic(),
+            )
+
+    def _current(self, model_id: str, region: str) -> float:
+        typical = MODEL_PROFILES[model_id]["tokens_per_sec"]
+        if (model_id, region) not in self._tokens_per_sec:
+            return typical
+        observed, observed_at = self._tokens_per_sec[(model_id, region)]
+        weight = 0.5 ** ((time.monotonic() - observed_at) / OBSERVATION_HALF_LIFE_SEC)
+        return typical + weight * (observed - typical)
+
+    def tokens_per_sec(self, model_id: str, region: str) -> float:
+        """Returns the observed generation speed, or the model's typical speed."""
+
+        with self._lock:
+            return self._current(model_id, region)
+
+
+def classify_request(
+    input_tokens: int, image_count: int, expected_output: int
+) -> Tuple[str, str]:
+    """
+    Classifies a request as "simple", "standard", or "complex".
+    Args:
+        input_tokens (int): Estimated input tokens.
+        image_count (int): Images in the request.
+        expected_output (int): Expected output tokens, a fraction of max_tokens.
+    Returns:
+        Tuple[str, str]: The request class and a short explanation.
+    """
+
+    if (
+        image_count == 0
+        and input_tokens < SIMPLE_MAX_INPUT_TOKENS
+        and expected_output <= SIMPLE_MAX_OUTPUT_TOKENS
+    ):
+        return "simple", f"text-only, ~{input_tokens} input tokens"
+    if image_count >= COMPLEX_MIN_IMAGES or input_tokens >= COMPLEX_MIN_INPUT_TOKENS:
+        return "complex", f"{image_count} images, ~{input_tokens} input tokens"
+    return "standard", f"{image_count} images, ~{input_tokens} input tokens"
+
+
+def estimate_cost(model_id: str, input_tokens: int, output_tokens: int) -> float:
+    profile = MODEL_PROFILES[model_id]
+    return (
+        input_tokens * profile["input_cost"] + output_tokens * profile["output_cost"]
+    ) / 1_000_000
+
+
+def route_model(
+    messages: List[dict],
+    max_tokens: int,
+    region: str,
+    tracker: Optional[LatencyTracker] = None,
+) -> Tuple[str, str]:
+    """
+    Picks a model for a request from its pre-flight size, attachment types, requested
+    max_tokens, and recently observed per-model latency.
+    Args:
+        messages (List[dict]): The composed Messages API messages.
+        max_tokens (int): The requested maximum output tokens.
+        region (str): The AWS region the request will be sent to.
+        tracker (Optional[LatencyTracker]): Observed latencies; typical speeds if None.
+    Returns:
+        Tuple[str, str]: The chosen model ID and the reason for the choice.
+    """
+
+    input_tokens = sum(estimate_message_tokens(message) for message in messages)
+    image_count = sum(
+        1
+        for message in messages
+        if isinstance(message["content"], list)
+        for block in message["content"]
+        if block["type"] == "image"
+    )
+    expected_output = int(max_tokens * EXPECTED_OUTPUT_FRACTION)
+    request_class, explanation = classify_request(
+        input_tokens, image_count, expected_output
+    )
+
+    candidates = [
+        model_id
+        for model_id in ROUTES[request_class]
+        if region in REGIONAL_MODELS.get(model_id, [region])
+    ]
+
+    def tokens_per_sec(model_id: str) -> float:
+        if tracker is None:
+            return MODEL_PROFILES[model_id]["tokens_per_sec"]
+        return max(tracker.tokens_per_sec(model_id, region), 1e-3)
+
+    def predicted_latency(model_id: str, typical: bool = False) -> float:
+        profile = MODEL_PROFILES[model_id]
+        speed = profile["tokens_per_sec"] if typical else tokens_per_sec(model_id)
+        return profile["first_token_sec"] + expected_output / speed
+
+    def slowdown(model_id: str) -> float:
+        return predicted_latency(model_id) / predicted_latency(model_id, typical=True)
+
+    # take the most capable candidate that is not running far below its usual speed
+    reason = f"{request_class} request ({explanation})"
+    model_id = min(candidates, key=slowdown)
+    for candidate in candidates:
+        if slowdown(candidate) <= SLOWDOWN_FALLBACK_FACTOR:
+            model_id = candidate
+            break
+        reason += (
+            f"; {candidate.split('.')[1]} recently slow "
+            f"({slowdown(candidate):.1f}x its usual latency)"
+        )
+
+    reason += (
+        f"; ~{predicted_latency(model_id):.0f}s, "
+        f"~${estimate_cost(model_id, input_tokens, expected_output):.4f} predicted"
+    )
+    logger.info("Routed to %s: %s", model_id, reason)
+    return model_id, reason
@@ -0,0 +1,198 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Process-wide admission control shared by all Streamlit sessions, with priority and
+# fair queuing per session, for CPU-bound ingestion and network-bound model calls.
+
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+# concurrent CPU-bound ingestion jobs (PDF parsing, rasterization, image saving)
+INGESTION_SLOTS: int = int(os.environ.get("INGESTION_SLOTS", os.cpu_count() or 4))
+
+# concurrent Bedrock model calls across all sessions, to stay under account quotas
+MODEL_CALL_SLOTS: int = int(os.environ.get("MODEL_CALL_SLOTS", 8))
+
+# lower values are served first
+PRIORITY_INTERACTIVE: int = 0
+PRIORITY_BULK: int = 1
+
+# fairness history is reset for idle sessions beyond this many
+MAX_TRACKED_SESSIONS: int = 10_000
+
+# how often waiters wake up to report their queue position
+WAIT_POLL_SEC: float = 0.5
+#################################################
+
+
+class Ticket:
+    """A request waiting for, or holding, a scheduler slot."""
+
+    def __init__(self, session_id: str, priority: int, seq: int) -> None:
+        self.session_id = session_id
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.perf_counter()
+        self.granted_at: Optional[float] = None
+
+    @property
+    def wait_sec(self) -> float:
+        end = self.granted_at if self.granted_at is not None else time.perf_counter()
+        return end - self.enqueued_at
+
+
+def arrival_key(ticket: Ticket):
+    return (ticket.priority, ticket.seq)
+
+
+class FairScheduler:
+    """
+    A counting semaphore with an ordered wait queue. When a slot frees up, the next
+    request is chosen by priority first, then by the session that was served least
+    recently, then by arrival. A session submitting many requests therefore takes
+    turns with other sessions rather than holding everyone else back.
+    Args:
+        name (str): Name used in logs, e.g. "ingestion" or "model".
+        capacity (int): Maximum number of slots held at once.
+    """
+
+    def __init__(self, name: str, capacity: int) -> None:
+        self.name = name
+        self.capacity = capacity
+        self._cond = threading.Condition()
+        self._waiting: List[Ticket] = []
+        self._active = 0
+        self._seq = itertools.count()
+        self._clock = itertools.count(1)
+        self._last_served: Dict[str, int] = {}
+        # bumped whenever a slot or queue position may have changed, so a waiter
+        # that was outside the lock, reporting its position, does not miss a wakeup
+        self._changes = 0
+
+    def _notify(self) -> None:
+        self._changes += 1
+        self._cond.notify_all()
+
+    def _order_key(self, ticket: Ticket):
+        return (
+            ticket.priority,
+            self._last_served.get(ticket.session_id, 0),
+            ticket.seq,
+        )
+
+    def _queue(self) -> List[Ticket]:
+        # only each session's oldest ticket competes; the rest follow in arrival order
+        heads: Dict[str, Ticket] = {}
+        for ticket in self._waiting:
+            head = heads.get(ticket.session_id)
+            if head is None or arrival_key(ticket) < arrival_key(head):
+                heads[ticket.session_id] = ticket
+        ordered = sorted(heads.values(), key=self._order_key)
+        rest = sorted(
+            (t for t in self._waiting if heads[t.session_id] is not t),
+            key=arrival_key,
+        )
+        return ordered + rest
+
+    def position(self, ticket: Ticket) -> int:
+        """Returns the 1-based position of a waiting ticket, or 0 once it holds a slot."""
+
+        with self._cond:
+            if ticket not in self._waiting:
+                return 0
+            return self._queue().index(ticket) + 1
+
+    @property
+    def queue_depth(self) -> int:
+        with self._cond:
+            return len(self._waiting)
+
+    @property
+    def active(self) -> int:
+        with self._cond:
+            return self._active
+
+    @contextmanager
+    def acquire(
+        self,
+        session_id: str,
+        priority: int = PRIORITY_INTERACTIVE,
+        on_wait: Optional[Callable[[int, float], None]] = None,
+    ) -> Iterator[Ticket]:
+        """
+        Waits for a slot, then holds it for the duration of the block.
+        Args:
+            session_id (str): The session making the request, for fair queuing.
+            priority (int): Lower values are served first.
+            on_wait (Optional[Callable[[int, float], None]]): Called periodically while
+                waiting with the queue position and seconds waited so far. It is
+                called without holding the scheduler's lock, so slow callbacks, such
+                as UI updates, do not hold up other sessions.
+        Yields:
+            Ticket: The granted ticket, recording how long the request waited.
+        """
+
+        with self._cond:
+            ticket = Ticket(session_id, priority, next(self._seq))
+            self._waiting.append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    if self._grant(ticket):
+                        break
+                    position = self._queue().index(ticket) + 1
+                    changes = self._changes
+                if on_wait:
+                    on_wait(position, ticket.wait_sec)
+                with self._cond:
+                    if self._changes == changes:
+                        self._cond.wait(timeout=WAIT_POLL_SEC)
+        except BaseException:
+            with self._cond:
+                self._waiting.remove(ticket)
+                self._notify()
+            raise
+
+        if ticket.wait_sec > WAIT_POLL_SEC:
+            logger.info(
+                "%s slot granted to session %s after %.2fs",
+                self.name,
+                session_id,
+                ticket.wait_sec,
+            )
+        try:
+            yield ticket
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._notify()
+
+    def _grant(self, ticket: Ticket) -> bool:
+        """
+        Gives a waiting ticket a slot if one is free and the ticket is first in the
+        queue. Called with the lock held.
+        """
+
+        if not (self._active < self.capacity and self._queue()[0] is ticket):
+            return False
+        self._waiting.remove(ticket)
+        self._active += 1
+        self._last_served[ticket.session_id] = next(self._clock)
+        if len(self._last_served) > MAX_TRACKED_SESSIONS:
+            # sessions with nothing queued can safely start over as new
+            queued = {t.session_id for t in self._waiting}
+            self._last_served = {
+                s: c for s, c in self._last_served.items() if s in queued
+            }
+        ticket.granted_at = time.perf_counter()
+        if self._waiting and self._active < self.capacity:
+            # several slots may have freed at once; the next waiter can take one now
+            self._notify()
+        return True
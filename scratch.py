@@ -0,0 +1,257 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Scratch storage for uploaded images and rasterized PDF pages: a namespace per
+# request under a directory per session, a byte quota with least-recently-used
+# sweeping, and cleanup when a session ends.
+
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import weakref
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+# "disk" keeps scratch files under SCRATCH_DIR; "tmpfs" keeps them in memory under
+# /dev/shm, falling back to disk where it is not available
+SCRATCH_BACKING: str = os.environ.get("SCRATCH_BACKING", "disk")
+SCRATCH_DIR: str = os.environ.get("SCRATCH_DIR", "_temp_images")
+TMPFS_DIR: str = "/dev/shm/creative-analysis"
+
+# total bytes kept before the least recently used request namespaces are deleted
+SCRATCH_QUOTA_BYTES: int = int(os.environ.get("SCRATCH_QUOTA_MB", 1024)) * 1024 * 1024
+
+# namespaces unused for this long are deleted, e.g. those of a crashed process
+SCRATCH_TTL_SEC: int = int(os.environ.get("SCRATCH_TTL_SEC", 6 * 3600))
+
+# namespace for files written outside of a session, e.g. by benchmarks
+DEFAULT_SESSION: str = "default"
+#################################################
+
+
+def directory_size(path: Path) -> int:
+    return sum(entry.stat().st_size for entry in path.rglob("*") if entry.is_file())
+
+
+def last_modified(path: Path) -> float:
+    return max(entry.stat().st_mtime for entry in [path, *path.rglob("*")])
+
+
+class ScratchStore:
+    """
+    Tracks scratch files by request namespace, `<root>/<session_id>/<request_id>/`,
+    so concurrent sessions and requests never overwrite each other's files. When the
+    quota is exceeded, whole namespaces are deleted, least recently used first;
+    pinned namespaces, which are being written or read, are never deleted.
+    Args:
+        root (Path): The directory holding every session's scratch files.
+        quota_bytes (int): The total size kept before sweeping.
+        ttl_sec (int): Namespaces unused for this long are deleted on the next sweep.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        quota_bytes: int = SCRATCH_QUOTA_BYTES,
+        ttl_sec: int = SCRATCH_TTL_SEC,
+    ) -> None:
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.ttl_sec = ttl_sec
+        self._lock = threading.RLock()
+        # namespace -> (bytes, last used), least recently used first
+        self._namespaces: "OrderedDict[Path, list]" = OrderedDict()
+        self._pins: Counter = Counter()
+        self._adopt_existing()
+
+    def _adopt_existing(self) -> None:
+        # only files unchanged for the TTL, e.g. left by a crashed process, are swept;
+        # newer ones may belong to another live process sharing the root, such as
+        # server.py and the app, and are left to that process
+        self.root.mkdir(parents=True, exist_ok=True)
+        expired = time.time() - self.ttl_sec
+        existing = {
+            namespace: last_modified(namespace)
+            for session_dir in self.root.iterdir()
+            if session_dir.is_dir()
+            for namespace in session_dir.iterdir()
+            if namespace.is_dir()
+        }
+        for namespace, modified in sorted(existing.items(), key=lambda item: item[1]):
+            if modified < expired:
+                self._namespaces[namespace] = [directory_size(namespace), modified]
+        self.sweep()
+
+    @property
+    def used_bytes(self) -> int:
+        with self._lock:
+            return sum(size for size, _ in self._namespaces.values())
+
+    def session_dir(self, session_id: str) -> Path:
+        return self.root / Path(session_id).name
+
+    def namespace(self, session_id: str, request_id: Optional[str] = None) -> Path:
+        """
+        Creates a new, empty namespace for one request's files.
+        Args:
+            session_id (str): The session the request belongs to.
+            request_id (Optional[str]): A unique request id; generated if None.
+        Returns:
+            Path: The namespace directory.
+        """
+
+        namespace = (
+            self.session_dir(session_id)
+            / Path(request_id or uuid.uuid4().hex[:12]).name
+        )
+        namespace.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._namespaces[namespace] = [0, time.time()]
+        return namespace
+
+    def commit(self, namespace: Path) -> None:
+        """
+        Accounts for the files written to a namespace, then sweeps if over quota.
+        A namespace nothing was written to, e.g. for a text file, is deleted.
+        """
+
+        size = directory_size(namespace) if namespace.exists() else 0
+        if not size:
+            self.release(namespace)
+            return
+        with self._lock:
+            if namespace in self._namespaces:
+                self._namespaces[namespace] = [size, time.time()]
+                self._namespaces.move_to_end(namespace)
+        self.sweep()
+
+    def touch(self, *paths: Path) -> None:
+        """Marks namespaces, or every namespace under a session directory, as used."""
+
+        now = time.time()
+        with self._lock:
+            for namespace in list(self._namespaces):
+                if any(self._covers(path, namespace) for path in paths):
+                    self._namespaces[namespace][1] = now
+                    self._namespaces.move_to_end(namespace)
+
+    @contextmanager
+    def pin(self, *paths: Path) -> Iterator[None]:
+        """
+        Keeps namespaces, or every namespace under a session directory, from being
+        swept for the duration of the block.
+        """
+
+        with self._lock:
+            self._pins.update(paths)
+        self.touch(*paths)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins.subtract(paths)
+                self._pins += Counter()
+
+    @staticmethod
+    def _covers(path: Path, namespace: Path) -> bool:
+        return path == namespace or path in namespace.parents
+
+    def _pinned(self, namespace: Path) -> bool:
+        return any(self._covers(path, namespace) for path in self._pins)
+
+    def release(self, namespace: Path) -> None:
+        """Deletes a namespace and its files."""
+
+        with self._lock:
+            self._namespaces.pop(namespace, None)
+        self._remove(namespace)
+
+    @staticmethod
+    def _remove(namespace: Path) -> None:
+        shutil.rmtree(namespace, ignore_errors=True)
+        try:
+            namespace.parent.rmdir()  # only succeeds once the session dir is empty
+        except OSError:
+            pass
+
+    def release_session(self, session_id: str) -> None:
+        """Deletes every namespace of a session, e.g. when the session ends."""
+
+        session_dir = self.session_dir(session_id)
+        with self._lock:
+            for namespace in list(self._namespaces):
+                if namespace.parent == session_dir:
+                    del self._namespaces[namespace]
+        shutil.rmtree(session_dir, ignore_errors=True)
+        logger.info("Released scratch files of session %s", session_id)
+
+    def sweep(self) -> None:
+        """
+        Deletes namespaces unused for longer than the TTL, then the least recently
+        used namespaces until the total size is within the quota.
+        """
+
+        expired = time.time() - self.ttl_sec
+        evicted = []
+        with self._lock:
+            used = self.used_bytes
+            for namespace, (size, last_used) in list(self._namespaces.items()):
+                if used <= self.quota_bytes and last_used >= expired:
+                    break
+                if self._pinned(namespace):
+                    continue
+                del self._namespaces[namespace]
+                evicted.append(namespace)
+                used -= size
+        for namespace in evicted:
+            self._remove(namespace)
+        if evicted:
+            logger.info(
+                "Swept %d scratch namespaces, %d bytes in use", len(evicted), used
+            )
+
+
+class SessionScratch:
+    """
+    Owns a session's scratch directory: when this object is garbage collected along
+    with the session's state, the session's files are deleted.
+    Args:
+        store (ScratchStore): The process-wide scratch store.
+        session_id (str): The session.
+    """
+
+    def __init__(self, store: ScratchStore, session_id: str) -> None:
+        self.session_id = session_id
+        self.directory = store.session_dir(session_id)
+        weakref.finalize(self, store.release_session, session_id)
+
+
+_store: Optional[ScratchStore] = None
+_store_lock = threading.Lock()
+
+
+def scratch_root() -> Path:
+    if SCRATCH_BACKING == "tmpfs":
+        if Path(TMPFS_DIR).parent.is_dir():
+            return Path(TMPFS_DIR)
+        logger.warning(
+            "tmpfs is not available, using %s for scratch files", SCRATCH_DIR
+        )
+    return Path(SCRATCH_DIR)
+
+
+def get_scratch_store() -> ScratchStore:
+    """Returns the process-wide scratch store, creating it on first use."""
+
+    global _store  # pylint: disable=global-statement
+    with _store_lock:
+        if _store is None:
+            _store = ScratchStore(scratch_root())
+        return _store
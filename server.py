@@ -0,0 +1,707 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Headless async HTTP API for the multimodal analysis pipeline, for use by other tools.
+# Usage: python server.py --port 8080
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from io import BytesIO
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional
+from urllib.parse import quote
+
+import botocore.session
+from aiohttp import (
+    ClientConnectionError,
+    ClientError,
+    ClientSession,
+    ClientTimeout,
+    TCPConnector,
+    web,
+)
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.eventstream import EventStreamBuffer
+from yarl import URL
+
+import pipeline
+from contact_sheets import build_contact_sheets, legend_text
+from conversation import build_request_body
+from keyframes import GIF_MODE_DEFAULT, GIF_MODES
+from relevance import select_relevant_texts
+from metrics import OUTCOME_OK, MetricsStore
+from scratch import get_scratch_store
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+DEFAULT_PORT: int = 8080
+
+# model calls in flight across all tenants
+MAX_CONCURRENT_INVOCATIONS: int = int(os.environ.get("MAX_CONCURRENT_INVOCATIONS", 256))
+
+# requests waiting for a slot before new requests are rejected with 429
+MAX_QUEUE_DEPTH: int = int(os.environ.get("MAX_QUEUE_DEPTH", 1024))
+
+# requests in flight per tenant, identified by the X-Tenant-Id header
+TENANT_CONCURRENCY: int = int(os.environ.get("TENANT_CONCURRENCY", 32))
+
+# threads for CPU-bound ingestion (PDF parsing, image saving, base64 encoding)
+INGESTION_WORKERS: int = os.cpu_count() or 4
+
+MAX_RETRIES: int = 3
+RETRY_BASE_DELAY_SEC: float = 0.5
+BEDROCK_TIMEOUT_SEC: float = 300.0
+MAX_REQUEST_BYTES: int = 100 * 1024 * 1024
+
+# scratch storage session for the images of API requests
+SCRATCH_SESSION: str = "api"
+#################################################
+
+
+class QueueFullError(Exception):
+    """Raised when the admission queue is full and the request should be retried later."""
+
+
+class BedrockError(Exception):
+    """An error response from the Bedrock Runtime API."""
+
+    def __init__(self, status: int, error_type: str, message: str) -> None:
+        super().__init__(f"{error_type}: {message}")
+        self.status = status
+        self.error_type = error_type
+        self.message = message
+
+
+def transport_error(err: Exception) -> BedrockError:
+    """
+    Maps a failure to reach Bedrock, or to read its response, to a BedrockError, so it
+    is returned as a gateway error (502, or 504 on timeout) and recorded in metrics.
+    """
+
+    if isinstance(err, asyncio.TimeoutError):
+        return BedrockError(
+            504, "TimeoutError", f"No response within {BEDROCK_TIMEOUT_SEC:g}s"
+        )
+    return BedrockError(502, type(err).__name__, str(err))
+
+
+class AdmissionController:
+    """
+    Bounds the work in the server: at most `max_concurrency` requests run at once,
+    at most `tenant_concurrency` of them per tenant, and at most `max_queue_depth`
+    requests wait for a slot. Requests beyond that are rejected immediately, so
+    callers see backpressure (429) instead of unbounded latency.
+    """
+
+    def __init__(
+        self, max_concurrency: int, max_queue_depth: int, tenant_concurrency: int
+    ) -> None:
+        self.max_queue_depth = max_queue_depth
+        self.tenant_concurrency = tenant_concurrency
+        self._global = asyncio.Semaphore(max_concurrency)
+        self._tenants: Dict[str, asyncio.Semaphore] = {}
+        # requests waiting or in flight per tenant; a tenant's semaphore is dropped
+        # when it reaches zero, so arbitrary X-Tenant-Id values do not accumulate
+        self._tenant_requests: Dict[str, int] = {}
+        self.waiting = 0
+        self.in_flight = 0
+        self.tenant_in_flight: Dict[str, int] = {}
+
+    @asynccontextmanager
+    async def slot(self, tenant: str) -> AsyncIterator[None]:
+        if self.waiting >= self.max_queue_depth:
+            raise QueueFullError(f"Queue is full ({self.waiting} requests waiting)")
+
+        tenant_semaphore = self._tenants.setdefault(
+            tenant, asyncio.Semaphore(self.tenant_concurrency)
+        )
+        self._tenant_requests[tenant] = self._tenant_requests.get(tenant, 0) + 1
+        try:
+            self.waiting += 1
+            try:
+                await tenant_semaphore.acquire()
+                try:
+                    await self._global.acquire()
+                except BaseException:
+                    tenant_semaphore.release()
+                    raise
+            finally:
+                self.waiting -= 1
+
+            self.in_flight += 1
+            self.tenant_in_flight[tenant] = self.tenant_in_flight.get(tenant, 0) + 1
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+                self.tenant_in_flight[tenant] -= 1
+                if not self.tenant_in_flight[tenant]:
+                    del self.tenant_in_flight[tenant]
+                self._global.release()
+                tenant_semaphore.release()
+        finally:
+            self._tenant_requests[tenant] -= 1
+            if not self._tenant_requests[tenant]:
+                del self._tenant_requests[tenant]
+                del self._tenants[tenant]
+
+
+class Invocation:
+    """
+    Measurements of one analysis request, recorded to the metrics store when it completes.
+    Args:
+        model_id (str): The model the request is for.
+    """
+
+    def __init__(self, model_id: str) -> None:
+        self.model_id = model_id
+        self.payload_bytes: Optional[int] = None
+        self.image_count = 0
+        self.document_count = 0
+        self.retries = 0
+        self.stage_timings: Dict[str, float] = {}
+        self.started = time.perf_counter()
+        self._last_mark = self.started
+
+    def mark(self, stage: str) -> None:
+        """Records the time since the previous mark as the duration of `stage`."""
+
+        now = time.perf_counter()
+        self.stage_timings[stage] = round(now - self._last_mark, 4)
+        self._last_mark = now
+
+    def record(
+        self, metrics: MetricsStore, region: str, outcome: str, usage: dict = None
+    ) -> None:
+        usage = usage or {}
+        metrics.record(
+            source="api",
+            model_id=self.model_id,
+            region=region,
+            outcome=outcome,
+            payload_bytes=self.payload_bytes,
+            image_count=self.image_count,
+            document_count=self.document_count,
+            latency_sec=self.stage_timings.get("bedrock.invoke"),
+            total_sec=round(time.perf_counter() - self.started, 4),
+            input_tokens=usage.get("input_tokens"),
+            output_tokens=usage.get("output_tokens"),
+            retries=self.retries,
+            stage_timings=self.stage_timings,
+        )
+
+
+class AsyncBedrockRuntime:
+    """
+    A minimal asyncio client for InvokeModel and InvokeModelWithResponseStream.
+    Requests are signed with botocore's SigV4 signer using the standard credential
+    chain, and sent over a pooled aiohttp session. Throttled requests are retried
+    with exponential backoff. Honors AWS_ENDPOINT_URL_BEDROCK_RUNTIME, like boto3.
+    Signing hashes the whole body and may refresh credentials, so it runs on
+    `executor`, not the event loop.
+    """
+
+    def __init__(
+        self,
+        region: str,
+        session: ClientSession,
+        max_retries: int = MAX_RETRIES,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        self.region = region
+        self.max_retries = max_retries
+        self._session = session
+        self._executor = executor
+        self._credentials = botocore.session.get_session().get_credentials()
+        self.endpoint_url = os.environ.get(
+            "AWS_ENDPOINT_URL_BEDROCK_RUNTIME",
+            f"https://bedrock-runtime.{region}.amazonaws.com",
+        ).rstrip("/")
+
+    def _signed_headers(self, url: str, body: bytearray, accept: str) -> dict:
+        request = AWSRequest(
+            method="POST",
+            url=url,
+            data=body,
+            headers={"Content-Type": "application/json", "Accept": accept},
+        )
+        SigV4Auth(
+            self._credentials.get_frozen_credentials(), "bedrock", self.region
+        ).add_auth(request)
+        return dict(request.headers)
+
+    async def _post(
+        self,
+        model_id: str,
+        action: str,
+        body: bytearray,
+        accept: str,
+        invocation: Optional[Invocation] = None,
+    ):
+        # the request is signed over the percent-encoded path, as boto3 sends it;
+        # encoded=True stops yarl from decoding the %3A in model ids before sending
+        url = f"{self.endpoint_url}/model/{quote(model_id, safe='')}/{action}"
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            if invocation:
+                invocation.retries = attempt
+            headers = await loop.run_in_executor(
+                self._executor, self._signed_headers, url, body, accept
+            )
+            try:
+                response = await self._session.post(
+                    URL(url, encoded=True), data=body, headers=headers
+                )
+            except ClientConnectionError as err:
+                if attempt < self.max_retries:
+                    delay = RETRY_BASE_DELAY_SEC * 2**attempt
+                    logger.warning("%r, retrying in %.1fs", err, delay)
+                    await asyncio.sleep(delay)
+                    continue
+                raise transport_error(err) from err
+            except (ClientError, asyncio.TimeoutError) as err:
+                raise transport_error(err) from err
+            if response.status == 200:
+                return response
+            error_type = response.headers.get("x-amzn-ErrorType", "UnknownError")
+            error_type = error_type.split(":")[0]
+            try:
+                message = (await response.json(content_type=None)).get("message", "")
+            except (json.JSONDecodeError, ValueError):
+                message = await response.text()
+            response.release()
+            error = BedrockError(response.status, error_type, message)
+            if response.status in (429, 503) and attempt < self.max_retries:
+                delay = RETRY_BASE_DELAY_SEC * 2**attempt
+                logger.warning("%s, retrying in %.1fs", error, delay)
+                await asyncio.sleep(delay)
+                continue
+            raise error
+
+    async def invoke_model(
+        self, model_id: str, body: bytearray, invocation: Optional[Invocation] = None
+    ) -> dict:
+        response = await self._post(
+            model_id, "invoke", body, "application/json", invocation
+        )
+        async with response:
+            try:
+                return await response.json(content_type=None)
+            except (ClientError, asyncio.TimeoutError) as err:
+                raise transport_error(err) from err
+
+    async def invoke_model_stream(
+        self, model_id: str, body: bytearray, invocation: Optional[Invocation] = None
+    ) -> AsyncIterator[dict]:
+        """
+        Yields the decoded Anthropic stream events (message_start, content_block_delta, ...).
+        """
+
+        response = await self._post(
+            model_id,
+            "invoke-with-response-stream",
+            body,
+            "application/vnd.amazon.eventstream",
+            invocation,
+        )
+        async with response:
+            buffer = EventStreamBuffer()
+            try:
+                async for data in response.content.iter_any():
+                    buffer.add_data(data)
+                    for event in buffer:
+                        headers = event.headers
+                        payload = json.loads(event.payload)
+                        if headers.get(":message-type") == "exception":
+                            raise BedrockError(
+                                500,
+                                headers.get(":exception-type", "UnknownError"),
+                                payload.get("message", ""),
+                            )
+                        yield json.loads(base64.b64decode(payload["bytes"]))
+            except (ClientError, asyncio.TimeoutError) as err:
+                raise transport_error(err) from err
+
+
+class ServerUpload(BytesIO):
+    """An uploaded file from an API request, shaped like Streamlit's UploadedFile."""
+
+    def __init__(self, request_id: str, name: str, file_type: str, data: bytes) -> None:
+        super().__init__(data)
+        self.name = os.path.basename(name)
+        self.type = file_type
+        self.size = len(data)
+        self.file_id = f"{request_id}:{name}"
+
+
+def parse_analysis_request(payload: dict) -> dict:
+    """
+    Validates an analysis request body and fills in default inference parameters.
+    Args:
+        payload (dict): The decoded JSON request body, containing "user_prompt" and
+            optionally "system_prompt", "model_id", "max_tokens", "temperature",
+            "top_p", "top_k", "ocr" (OCR image-based PDFs), "gif_mode" (how to send
+            animated GIFs, one of GIF_MODES), "contact_sheets" (pack small images into
+            labeled contact sheets), "relevance" (send only the sections of long text
+            attachments relevant to the prompt), and "files" (a list of
+            {"name", "type", "data"} objects with base64-encoded data).
+    Returns:
+        dict: The validated request.
+    Raises:
+        web.HTTPBadRequest: If the request is invalid.
+    """
+
+    if not isinstance(payload, dict) or not payload.get("user_prompt"):
+        raise web.HTTPBadRequest(text="'user_prompt' is required")
+    model_id = payload.get("model_id", pipeline.DEFAULT_MODEL_ID)
+    if model_id not in pipeline.MODELS:
+        raise web.HTTPBadRequest(text=f"Unsupported model_id: {model_id}")
+    gif_mode = payload.get("gif_mode", GIF_MODE_DEFAULT)
+    if gif_mode not in GIF_MODES:
+        raise web.HTTPBadRequest(text=f"Unsupported gif_mode: {gif_mode}")
+    try:
+        files = [
+            {
+                "name": file["name"],
+                "type": file["type"],
+                "data": base64.b64decode(file["data"], validate=True),
+            }
+            for file in payload.get("files", [])
+        ]
+    except (KeyError, TypeError, ValueError) as err:
+        raise web.HTTPBadRequest(text=f"Invalid files: {err}") from err
+    parameters = {}
+    for field, cast, default in [
+        ("max_tokens", int, pipeline.DEFAULT_MAX_TOKENS),
+        ("temperature", float, pipeline.DEFAULT_TEMPERATURE),
+        ("top_p", float, pipeline.DEFAULT_TOP_P),
+        ("top_k", int, pipeline.DEFAULT_TOP_K),
+    ]:
+        try:
+            parameters[field] = cast(payload.get(field, default))
+        except (TypeError, ValueError) as err:
+            raise web.HTTPBadRequest(
+                text=f"Invalid {field}: {payload.get(field)!r}"
+            ) from err
+    return {
+        "user_prompt": payload["user_prompt"],
+        "system_prompt": payload.get("system_prompt", pipeline.DEFAULT_SYSTEM_PROMPT),
+        "model_id": model_id,
+        **parameters,
+        "ocr": bool(payload.get("ocr", pipeline.OCR_DEFAULT)),
+        "gif_mode": gif_mode,
+        "contact_sheets": bool(payload.get("contact_sheets", False)),
+        "relevance": bool(payload.get("relevance", pipeline.RELEVANCE_DEFAULT)),
+        "files": files,
+    }
+
+
+async def build_body(
+    analysis: dict,
+    executor: ThreadPoolExecutor,
+    invocation: Optional[Invocation] = None,
+) -> bytearray:
+    """
+    Ingests the request's files in parallel on the ingestion pool, using the same
+    extractors as the Streamlit app, then composes and serializes the Bedrock request.
+    Each file's images are written to its own scratch namespace, which is deleted
+    once the request body has been built.
+    """
+
+    request_id = uuid.uuid4().hex[:12]
+    store = get_scratch_store()
+    namespaces = [
+        store.namespace(SCRATCH_SESSION, f"{request_id}-{index}")
+        for index in range(len(analysis["files"]))
+    ]
+    try:
+        with store.pin(*namespaces):
+            return await ingest_and_compose(
+                analysis, executor, request_id, namespaces, invocation
+            )
+    finally:
+        for namespace in namespaces:
+            store.release(namespace)
+
+
+async def ingest_and_compose(
+    analysis: dict,
+    executor: ThreadPoolExecutor,
+    request_id: str,
+    namespaces: List[Path],
+    invocation: Optional[Invocation],
+) -> bytearray:
+    loop = asyncio.get_running_loop()
+    uploads = [
+        ServerUpload(request_id, file["name"], file["type"], file["data"])
+        for file in analysis["files"]
+    ]
+    results = await asyncio.gather(
+        *(
+            loop.run_in_executor(
+                executor,
+                pipeline.ingest_file,
+                upload,
+                namespace,
+                analysis["ocr"],
+                analysis["gif_mode"],
+            )
+            for upload, namespace in zip(uploads, namespaces)
+        )
+    )
+
+    file_paths: List[dict] = []
+    for result in results:
+        if result["error"]:
+            raise web.HTTPBadRequest(text=result["error"])
+        file_paths.extend(result["file_paths"])
+    texts = [result["text"] for result in results if result["text"] is not None]
+    if analysis["relevance"] and texts:
+        texts, _ = select_relevant_texts(
+            texts,
+            [result["text_index"] for result in results if result["text"] is not None],
+            analysis["user_prompt"],
+        )
+    user_prompt = analysis["user_prompt"] + "".join(f"\n\n{text}" for text in texts)
+    if analysis["contact_sheets"] and file_paths:
+        # sheets are written to the first file's namespace, released with the rest
+        file_paths, legend = await loop.run_in_executor(
+            executor, build_contact_sheets, file_paths, namespaces[0]
+        )
+        if legend:
+            user_prompt += f"\n\n{legend_text(legend)}"
+
+    if invocation:
+        invocation.image_count = len(file_paths)
+        invocation.document_count = sum(
+            1 for result in results if result["text"] is not None
+        )
+
+    messages = await loop.run_in_executor(
+        executor, pipeline.compose_message, user_prompt, file_paths
+    )
+    return await loop.run_in_executor(
+        executor,
+        build_request_body,
+        {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": analysis["max_tokens"],
+            "system": analysis["system_prompt"],
+            "temperature": analysis["temperature"],
+            "top_p": analysis["top_p"],
+            "top_k": analysis["top_k"],
+        },
+        messages,
+    )
+
+
+def error_response(err: Exception) -> web.Response:
+    if isinstance(err, QueueFullError):
+        return web.json_response(
+            {"error": "QueueFull", "message": str(err)},
+            status=429,
+            headers={"Retry-After": "1"},
+        )
+    if isinstance(err, BedrockError):
+        status = err.status if err.status in (400, 403, 429, 504) else 502
+        return web.json_response(
+            {"error": err.error_type, "message": err.message}, status=status
+        )
+    raise err
+
+
+async def read_analysis_request(request: web.Request) -> dict:
+    try:
+        payload = await request.json()
+    except json.JSONDecodeError as err:
+        raise web.HTTPBadRequest(text="Request body must be JSON") from err
+    return parse_analysis_request(payload)
+
+
+async def handle_analysis(request: web.Request) -> web.Response:
+    """POST /v1/analyses - runs an analysis and returns the complete response."""
+
+    analysis = await read_analysis_request(request)
+    tenant = request.headers.get("X-Tenant-Id", "default")
+    state = request.app["state"]
+    invocation = Invocation(analysis["model_id"])
+    try:
+        async with state["admission"].slot(tenant):
+            invocation.mark("queue.admission_wait")
+            body = await build_body(analysis, state["executor"], invocation)
+            invocation.payload_bytes = len(body)
+            invocation.mark("request.build")
+            response = await state["bedrock"].invoke_model(
+                analysis["model_id"], body, invocation
+            )
+            invocation.mark("bedrock.invoke")
+    except QueueFullError as err:
+        return error_response(err)
+    except BedrockError as err:
+        invocation.mark("bedrock.invoke")
+        invocation.record(state["metrics"], state["bedrock"].region, err.error_type)
+        return error_response(err)
+    invocation.record(
+        state["metrics"], state["bedrock"].region, OUTCOME_OK, response["usage"]
+    )
+
+    return web.json_response(
+        {
+            "model_id": analysis["model_id"],
+            "content": response["content"][0]["text"],
+            "stop_reason": response.get("stop_reason"),
+            "usage": response["usage"],
+            "analysis_time_sec": round(time.perf_counter() - invocation.started, 3),
+        }
+    )
+
+
+async def handle_analysis_stream(request: web.Request) -> web.StreamResponse:
+    """
+    POST /v1/analyses/stream - runs an analysis and relays the generated text as
+    server-sent events: `delta` events with text, then a final `done` event with usage.
+    """
+
+    analysis = await read_analysis_request(request)
+    tenant = request.headers.get("X-Tenant-Id", "default")
+    state = request.app["state"]
+    stream: Optional[web.StreamResponse] = None
+    invocation = Invocation(analysis["model_id"])
+
+    async def open_stream() -> web.StreamResponse:
+        # headers are sent once the model starts responding, so errors before
+        # that (queue full, throttling) can still be returned with a status code
+        nonlocal stream
+        if stream is None:
+            stream = web.StreamResponse(
+                headers={
+                    "Content-Type": "text/event-stream",
+                    "Cache-Control": "no-cache",
+                }
+            )
+            await stream.prepare(request)
+        return stream
+
+    try:
+        async with state["admission"].slot(tenant):
+            invocation.mark("queue.admission_wait")
+            body = await build_body(analysis, state["executor"], invocation)
+            invocation.payload_bytes = len(body)
+            invocation.mark("request.build")
+            usage = {}
+            async for event in state["bedrock"].invoke_model_stream(
+                analysis["model_id"], body, invocation
+            ):
+                await open_stream()
+                match event["type"]:
+                    case "message_start":
+                        usage.update(event["message"]["usage"])
+                    case "content_block_delta":
+                        data = json.dumps({"text": event["delta"].get("text", "")})
+                        await stream.write(f"event: delta\ndata: {data}\n\n".encode())
+                    case "message_delta":
+                        usage.update(event.get("usage", {}))
+            invocation.mark("bedrock.invoke")
+            invocation.record(
+                state["metrics"], state["bedrock"].region, OUTCOME_OK, usage
+            )
+            await open_stream()
+            await stream.write(
+                f"event: done\ndata: {json.dumps({'usage': usage})}\n\n".encode()
+            )
+            await stream.write_eof()
+            return stream
+    except (QueueFullError, BedrockError) as err:
+        if isinstance(err, BedrockError):
+            invocation.mark("bedrock.invoke")
+            invocation.record(state["metrics"], state["bedrock"].region, err.error_type)
+        if stream is None:
+            return error_response(err)
+        data = json.dumps({"error": type(err).__name__, "message": str(err)})
+        await stream.write(f"event: error\ndata: {data}\n\n".encode())
+        await stream.write_eof()
+        return stream
+
+
+async def handle_health(request: web.Request) -> web.Response:
+    """GET /healthz - liveness plus current queue and concurrency figures."""
+
+    admission: AdmissionController = request.app["state"]["admission"]
+    return web.json_response(
+        {
+            "status": "ok",
+            "waiting": admission.waiting,
+            "in_flight": admission.in_flight,
+            "tenant_in_flight": admission.tenant_in_flight,
+        }
+    )
+
+
+def create_app(
+    region: str = pipeline.DEFAULT_AWS_REGION,
+    max_concurrency: int = MAX_CONCURRENT_INVOCATIONS,
+    max_queue_depth: int = MAX_QUEUE_DEPTH,
+    tenant_concurrency: int = TENANT_CONCURRENCY,
+) -> web.Application:
+    """
+    Creates the aiohttp application. The Bedrock HTTP session, connection pool,
+    ingestion thread pool, and metrics writer are created on startup and closed on
+    shutdown.
+    """
+
+    application = web.Application(client_max_size=MAX_REQUEST_BYTES)
+    application["state"] = {}
+
+    async def lifecycle(application: web.Application) -> AsyncIterator[None]:
+        session = ClientSession(
+            connector=TCPConnector(limit=max_concurrency),
+            timeout=ClientTimeout(total=BEDROCK_TIMEOUT_SEC),
+        )
+        executor = ThreadPoolExecutor(
+            max_workers=INGESTION_WORKERS, thread_name_prefix="ingestion"
+        )
+        application["state"].update(
+            admission=AdmissionController(
+                max_concurrency, max_queue_depth, tenant_concurrency
+            ),
+            bedrock=AsyncBedrockRuntime(region, session, executor=executor),
+            executor=executor,
+            metrics=MetricsStore(),
+        )
+        yield
+        await session.close()
+        executor.shutdown(wait=False)
+        application["state"]["metrics"].close()
+
+    application.cleanup_ctx.append(lifecycle)
+    application.add_routes(
+        [
+            web.post("/v1/analyses", handle_analysis),
+            web.post("/v1/analyses/stream", handle_analysis_stream),
+            web.get("/healthz", handle_health),
+        ]
+    )
+    return application
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the analysis API server.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--region", default=pipeline.DEFAULT_AWS_REGION)
+    args = parser.parse_args()
+
+    web.run_app(create_app(region=args.region), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
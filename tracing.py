@@ -0,0 +1,269 @@
+# Author: Gary A. Stafford
+# Modified: 2024-10-25
+# Span-based latency instrumentation for the multimodal analysis pipeline.
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+################### Constants ###################
+# TRACE_SINK selects where finished spans are exported: "log", "jsonl", "otel", or "none"
+DEFAULT_TRACE_SINK: str = os.environ.get("TRACE_SINK", "log")
+DEFAULT_TRACE_JSONL_PATH: str = os.environ.get(
+    "TRACE_JSONL_PATH", "_traces/spans.jsonl"
+)
+#################################################
+
+
+class Span:
+    """
+    A single timed stage of the pipeline, e.g. rasterizing a PDF or calling Bedrock.
+    Field names follow the OpenTelemetry span data model so that exported records
+    can be loaded by OTLP-compatible tooling.
+    """
+
+    def __init__(
+        self, name: str, trace_id: str, parent_span_id: Optional[str], attributes: dict
+    ) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_span_id = parent_span_id
+        self.attributes = attributes
+        self.start_time_unix_nano = time.time_ns()
+        self.end_time_unix_nano: Optional[int] = None
+        self.status = "OK"
+        self._start_perf = time.perf_counter()
+        self.duration_sec: float = 0.0
+
+    def end(self) -> None:
+        self.duration_sec = time.perf_counter() - self._start_perf
+        self.end_time_unix_nano = self.start_time_unix_nano + int(
+            self.duration_sec * 1e9
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "name": self.name,
+            "start_time_unix_nano": self.start_time_unix_nano,
+            "end_time_unix_nano": self.end_time_unix_nano,
+            "duration_sec": round(self.duration_sec, 6),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class LogSink:
+    """Writes each finished span to the application log."""
+
+    def export(self, spans: List[Span]) -> None:
+        for span in spans:
+            logger.info(
+                "Span: %s %.4fs %s", span.name, span.duration_sec, span.attributes
+            )
+
+
+class JsonlSink:
+    """Appends each finished span as one JSON object per line."""
+
+    def __init__(self, path: str = DEFAULT_TRACE_JSONL_PATH) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[Span]) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock, open(self.path, "a", encoding="utf-8") as jsonl_file:
+            for span in spans:
+                jsonl_file.write(json.dumps(span.to_dict()) + "\n")
+
+
+class OpenTelemetrySink:
+    """
+    Re-emits finished spans through the OpenTelemetry API, so any configured
+    exporter (OTLP, Jaeger, console) receives them. Requires opentelemetry-api.
+    Each span is started in its parent's context, so the span tree is kept, and
+    top-level spans continue the tracer's trace ID, as if from a remote parent.
+    """
+
+    def __init__(self) -> None:
+        from opentelemetry import trace  # optional dependency
+
+        self._trace = trace
+        self._tracer = trace.get_tracer(__name__)
+
+    def _depth(self, span: Span, by_id: Dict[str, Span]) -> int:
+        depth = 0
+        while span.parent_span_id in by_id:
+            span = by_id[span.parent_span_id]
+            depth += 1
+        return depth
+
+    def export(self, spans: List[Span]) -> None:
+        trace = self._trace
+        by_id = {span.span_id: span for span in spans}
+        remote_parents: Dict[str, object] = {}
+        otel_spans: Dict[str, object] = {}
+        # spans finish, and are collected, children first; start parents first
+        for span in sorted(spans, key=lambda span: self._depth(span, by_id)):
+            parent = otel_spans.get(span.parent_span_id)
+            if parent is None:
+                if span.trace_id not in remote_parents:
+                    remote_parents[span.trace_id] = trace.NonRecordingSpan(
+                        trace.SpanContext(
+                            trace_id=int(span.trace_id, 16),
+                            span_id=int(uuid.uuid4().hex[:16], 16),
+                            is_remote=True,
+                            trace_flags=trace.TraceFlags(trace.TraceFlags.SAMPLED),
+                        )
+                    )
+                parent = remote_parents[span.trace_id]
+            otel_span = self._tracer.start_span(
+                span.name,
+                context=trace.set_span_in_context(parent),
+                start_time=span.start_time_unix_nano,
+                attributes={k: str(v) for k, v in span.attributes.items()},
+            )
+            if span.status == "ERROR":
+                otel_span.set_status(trace.Status(trace.StatusCode.ERROR))
+            otel_spans[span.span_id] = otel_span
+        for span in spans:
+            otel_spans[span.span_id].end(end_time=span.end_time_unix_nano)
+
+
+class NullSink:
+    """Discards spans; the per-stage breakdown is still available from the tracer."""
+
+    def export(self, spans: List[Span]) -> None:
+        pass
+
+
+def get_sink(name: str = DEFAULT_TRACE_SINK):
+    """
+    Returns the span sink for the given name.
+    Args:
+        name (str): One of "log", "jsonl", "otel", or "none".
+    Returns:
+        A sink object exposing an `export(spans)` method. Falls back to the log sink
+        if the name is unknown or the OpenTelemetry API is not installed.
+    """
+
+    match name:
+        case "jsonl":
+            return JsonlSink()
+        case "otel":
+            try:
+                return OpenTelemetrySink()
+            except ImportError:
+                logger.warning("opentelemetry-api not installed, using log sink")
+                return LogSink()
+        case "none":
+            return NullSink()
+        case _:
+            return LogSink()
+
+
+class Tracer:
+    """
+    Collects the spans of one analysis request (a trace) and exports them to a sink.
+    """
+
+    def __init__(self, sink=None) -> None:
+        self.sink = sink if sink is not None else get_sink()
+        self.trace_id = uuid.uuid4().hex
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+        self._stack: ContextVar[Optional[str]] = ContextVar(
+            f"span_stack_{self.trace_id}", default=None
+        )
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        parent_span_id = self._stack.get()
+        current = Span(name, self.trace_id, parent_span_id, attributes)
+        token = self._stack.set(current.span_id)
+        try:
+            yield current
+        except Exception:
+            current.status = "ERROR"
+            raise
+        finally:
+            current.end()
+            self._stack.reset(token)
+            with self._lock:
+                self.spans.append(current)
+
+    def stage_breakdown(self) -> Dict[str, float]:
+        """
+        Sums span durations by stage name, in the order each stage first finished.
+        Returns:
+            Dict[str, float]: Stage name mapped to total seconds spent in that stage.
+        """
+
+        breakdown: Dict[str, float] = {}
+        with self._lock:
+            for span in self.spans:
+                breakdown[span.name] = breakdown.get(span.name, 0.0) + span.duration_sec
+        return {name: round(total, 4) for name, total in breakdown.items()}
+
+    def flush(self) -> None:
+        with self._lock:
+            spans, self.spans = self.spans, []
+        if not spans:
+            return
+        try:
+            self.sink.export(spans)
+        except Exception as err:  # pylint: disable=broad-except
+            logger.error("Failed to export spans: %s", err)
+
+
+def merge_stage_timings(*breakdowns: Dict[str, float]) -> Dict[str, float]:
+    """
+    Combines stage breakdowns from several tracers, e.g. one per ingested file.
+    Returns:
+        Dict[str, float]: Stage name mapped to total seconds across all breakdowns.
+    """
+
+    merged: Dict[str, float] = {}
+    for breakdown in breakdowns:
+        for name, seconds in breakdown.items():
+            merged[name] = round(merged.get(name, 0.0) + seconds, 4)
+    return merged
+
+
+_active_tracer: ContextVar[Optional[Tracer]] = ContextVar("active_tracer", default=None)
+
+
+def set_active_tracer(tracer: Optional[Tracer]) -> None:
+    """Makes `tracer` the target of `trace_span` calls in the current context."""
+
+    _active_tracer.set(tracer)
+
+
+def get_active_tracer() -> Optional[Tracer]:
+    return _active_tracer.get()
+
+
+@contextmanager
+def trace_span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """
+    Times the enclosed block as a span on the active tracer. If no tracer is
+    active, the block runs untimed so helpers can be used outside of the app.
+    """
+
+    tracer = _active_tracer.get()
+    if tracer is None:
+        yield None
+        return
+    with tracer.span(name, **attributes) as current:
+        yield current